@@ -0,0 +1,245 @@
+import argparse
+import contextlib
+import importlib
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_comfyui import FakeComfyUI
+from fake_ftp import FakeFTPServer
+
+# Сквозной бенчмарк: настоящие run_worker (generate.py --worker) и run_pipeline
+# (generate.py --pipeline) против поддельных ComfyUI и FTP и тестовой таблицы
+# original_news (SQLite или PostgreSQL при заданном --dsn / BENCH_DSN).
+# Для каждой комбинации режима, размера очереди и числа промптов в работе выводит:
+# изображений в минуту, p50/p95 времени от захвата новости до записи в БД
+# и долю простоя "GPU" поддельных ComfyUI (среднюю по работающим серверам).
+# --backends N запускает N поддельных серверов (COMFY_URLS), --down-after T отключает
+# первый из них через T секунд после начала каждого прогона.
+#
+#   python bench/benchmark.py --backlog 20,100 --in-flight 1,3 --latency 0.5
+#   python bench/benchmark.py --backends 3 --in-flight 6 --down-after 2
+# --variants задаёт IMAGE_VARIANTS (поддельные серверы тогда отдают настоящий JPEG, нужен Pillow):
+#   python bench/benchmark.py --variants '{"thumb": {"width": 320, "format": "webp"}}'
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+# Время захвата и записи результата каждой новости
+class Recorder:
+    def __init__(self, total, max_attempts):
+        self.total = total
+        self.max_attempts = max_attempts
+        self.claimed_at = {}
+        self.attempts = {}
+        self.done_at = {}
+        self.failed = set()
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+
+    def wrap_claim(self, claim_news_batch):
+        def claim(*args, **kwargs):
+            batch = claim_news_batch(*args, **kwargs)
+            now = time.monotonic()
+            with self.lock:
+                for news in batch:
+                    self.claimed_at.setdefault(news['id'], now)
+                    self.attempts[news['id']] = news['attempts']
+            return batch
+        return claim
+
+    def writer_class(self, base):
+        recorder = self
+
+        class RecordingWriter(base):
+            def _execute(self, conn, images, errors):
+                super()._execute(conn, images, errors)
+                recorder.committed(images, errors)
+
+        return RecordingWriter
+
+    def committed(self, images, errors):
+        now = time.monotonic()
+        with self.lock:
+            for news_id in images:
+                self.done_at[news_id] = now
+            # Ошибка окончательная, только если попытка учтена и попытки исчерпаны
+            for news_id, (_, counted) in errors.items():
+                if counted and self.attempts.get(news_id, 0) >= self.max_attempts:
+                    self.failed.add(news_id)
+            if len(self.done_at) + len(self.failed) >= self.total:
+                self.finished.set()
+
+    def latencies(self):
+        with self.lock:
+            return [self.done_at[news_id] - self.claimed_at[news_id] for news_id in self.done_at]
+
+def idle_fraction(comfys):
+    alive = [comfy for comfy in comfys if not comfy.down]
+    return sum(comfy.idle_fraction() for comfy in alive) / len(alive) if alive else 1.0
+
+def run_case(mode, backlog, in_flight, comfys, news_db, args):
+    import settings
+    import generate
+    import pipeline
+
+    news_db.seed(backlog)
+    # id новостей совпадают между прогонами: журнал прошлого прогона к ним не относится
+    for suffix in ("", "-wal", "-shm"):
+        if args.journal and os.path.exists(args.journal + suffix):
+            os.remove(args.journal + suffix)
+    recorder = Recorder(backlog, settings.CLAIM_MAX_ATTEMPTS)
+    news_db.patch(generate, pipeline)
+    for module in (generate, pipeline):
+        module.claim_news_batch = recorder.wrap_claim(news_db.claim_news_batch)
+        module.ResultWriter = recorder.writer_class(news_db.writer_class())
+
+    result = {}
+
+    # Остановка воркера (как по Ctrl+C), когда все новости обработаны или истёк таймаут.
+    # Настоящий SIGINT, а не _thread.interrupt_main: он будит и цикл asyncio, ждущий в select
+    def watch():
+        finished = recorder.finished.wait(args.timeout)
+        result["idle_fraction"] = idle_fraction(comfys)
+        result["timed_out"] = not finished
+        os.kill(os.getpid(), signal.SIGINT)
+
+    # Отказ первого сервера посреди прогона
+    def take_down():
+        if not recorder.finished.wait(args.down_after):
+            comfys[0].set_down(True)
+
+    for comfy in comfys:
+        comfy.set_down(False)
+        comfy.reset_stats()
+    started = time.monotonic()
+    threading.Thread(target=watch, daemon=True).start()
+    if args.down_after is not None:
+        threading.Thread(target=take_down, daemon=True).start()
+    output = sys.stdout if args.verbose else open(os.devnull, "w")
+    with contextlib.redirect_stdout(output):
+        try:
+            if mode == "pipeline":
+                pipeline.run_pipeline(args.batch_size, args.idle_sleep, args.idle_sleep, in_flight)
+            else:
+                generate.run_worker(args.batch_size, args.idle_sleep, args.idle_sleep, in_flight)
+        except KeyboardInterrupt:
+            pass
+    if output is not sys.stdout:
+        output.close()
+
+    latencies = recorder.latencies()
+    last_done = max(recorder.done_at.values(), default=time.monotonic())
+    wall = max(last_done - started, 1e-9)
+    result.update({
+        "mode": mode,
+        "backlog": backlog,
+        "in_flight": in_flight,
+        "images": len(recorder.done_at),
+        "failed": len(recorder.failed),
+        "seconds": wall,
+        "images_per_minute": len(recorder.done_at) / wall * 60,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+    })
+    return result
+
+def print_row(row):
+    print(f"{row['mode']:>9} {row['backlog']:>8} {row['in_flight']:>9} {row['images']:>7} {row['failed']:>7} "
+          f"{row['seconds']:>8.1f} {row['images_per_minute']:>10.1f} {row['p50']:>7.2f} {row['p95']:>7.2f} "
+          f"{row['idle_fraction']:>12.1%}{'  (таймаут)' if row['timed_out'] else ''}")
+
+def int_list(value):
+    return [int(item) for item in value.split(",") if item]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Сквозной бенчмарк генерации изображений")
+    parser.add_argument("--modes", default="worker,pipeline", help="режимы через запятую: worker, pipeline")
+    parser.add_argument("--backlog", type=int_list, default=[20, 100], help="размеры очереди новостей")
+    parser.add_argument("--in-flight", type=int_list, default=[1, 3], help="числа промптов в работе")
+    parser.add_argument("--batch-size", type=int, default=10, help="сколько новостей забирать из БД за раз")
+    parser.add_argument("--idle-sleep", type=float, default=0.2, help="пауза воркера при пустой очереди")
+    parser.add_argument("--backends", type=int, default=1, help="число поддельных серверов ComfyUI")
+    parser.add_argument("--down-after", type=float, help="отключить первый сервер через столько секунд")
+    parser.add_argument("--latency", type=float, default=0.5, help="время рендера одного промпта, секунды")
+    parser.add_argument("--cold-start", type=float, default=0.0,
+                        help="загрузка моделей поддельным ComfyUI перед первым промптом, секунды")
+    parser.add_argument("--variants", default="{}", help="производные изображения (IMAGE_VARIANTS, JSON)")
+    parser.add_argument("--journal", default="", help="файл журнала задач (JOB_JOURNAL), пересоздаётся в каждом прогоне")
+    parser.add_argument("--warmup", action="store_true", help="прогрев моделей перед захватом новостей")
+    parser.add_argument("--jitter", type=float, default=0.1, help="разброс времени рендера, секунды")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="доля промптов с ошибкой")
+    parser.add_argument("--image-size", type=int, default=200_000, help="размер изображения, байт")
+    parser.add_argument("--ftp-latency", type=float, default=0.005, help="задержка каждой FTP команды")
+    parser.add_argument("--news-per-prompt", type=int, default=1, help="новостей в одном промпте")
+    parser.add_argument("--no-websocket", action="store_true", help="только опрос /history")
+    parser.add_argument("--dsn", default=os.environ.get("BENCH_DSN", ""),
+                        help="строка подключения PostgreSQL (по умолчанию SQLite в памяти)")
+    parser.add_argument("--timeout", type=float, default=600, help="ограничение времени одного прогона")
+    parser.add_argument("--json", help="сохранить результаты в файл JSON")
+    parser.add_argument("--verbose", action="store_true", help="не скрывать лог воркера")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    comfys = [FakeComfyUI(latency=args.latency, jitter=args.jitter, fail_rate=args.fail_rate,
+                          image_size=args.image_size, cold_start=args.cold_start,
+                          real_images=bool(json.loads(args.variants))).start()
+              for _ in range(args.backends)]
+    ftp = FakeFTPServer(command_latency=args.ftp_latency).start()
+
+    # Настройки читаются при импорте: окружение задаётся до импорта модулей воркера,
+    # а settings (уже импортирован поддельным ComfyUI через comfy_events) перечитывается
+    os.environ.update({
+        "COMFY_URL": comfys[0].url,
+        "COMFY_URLS": ",".join(comfy.url for comfy in comfys),
+        "FTP_HOST": ftp.host,
+        "FTP_PORT": str(ftp.port),
+        "FTP_USER": ftp.user,
+        "FTP_PASSWORD": ftp.password,
+        "USE_WEBSOCKET": "0" if args.no_websocket else "1",
+        "NEWS_PER_PROMPT": str(args.news_per_prompt),
+        "CLAIM_RETRY_DELAY": "0",
+        "RESULT_CACHE_DIR": "",
+        "WORKFLOW_PROFILE": "",
+        "WARMUP": "1" if args.warmup else "0",
+        "IMAGE_VARIANTS": args.variants,
+        "JOB_JOURNAL": args.journal,
+    })
+    import settings
+    importlib.reload(settings)
+    from fake_db import SQLiteNewsDB, PostgresNewsDB
+    news_db = PostgresNewsDB(args.dsn) if args.dsn else SQLiteNewsDB()
+
+    print(f"[LOG] ComfyUI: {', '.join(comfy.url for comfy in comfys)}, рендер {args.latency}±{args.jitter} с, ошибок {args.fail_rate:.0%}; "
+          f"FTP: {ftp.host}:{ftp.port}; БД: {'PostgreSQL' if args.dsn else 'SQLite'}")
+    print(f"{'режим':>9} {'очередь':>8} {'в работе':>9} {'готово':>7} {'ошибок':>7} "
+          f"{'время, с':>8} {'изобр/мин':>10} {'p50, с':>7} {'p95, с':>7} {'простой GPU':>12}")
+    results = []
+    try:
+        for mode in args.modes.split(","):
+            for backlog in args.backlog:
+                for in_flight in args.in_flight:
+                    row = run_case(mode, backlog, in_flight, comfys, news_db, args)
+                    print_row(row)
+                    results.append(row)
+    finally:
+        for comfy in comfys:
+            comfy.stop()
+        ftp.stop()
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+import argparse
+import json
+import os
+import queue
+import random
+import socket
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from comfy_events import ws_accept_key, ws_read_message, ws_send_frame, OP_TEXT, OP_CLOSE, OP_PING, OP_PONG
+
+# Поддельный сервер ComfyUI для локальной проверки и бенчмарков.
+# Реализует /prompt, /history, /view, /queue и WebSocket /ws с теми же
+# сообщениями, что и настоящий сервер. Промпты "рендерятся" по одному
+# (как на одном GPU) с задержкой latency +- jitter секунд, доля fail_rate
+# завершается ошибкой выполнения. В качестве изображения отдаются
+# image_size случайных байт с заголовком JPEG, а с real_images - настоящий JPEG
+# (нужен Pillow), который можно декодировать, например для производных изображений.
+# set_down(True) имитирует отказ сервера: соединения (и WebSocket) закрываются без ответа.
+# cold_start - дополнительное время первого промпта после запуска или отказа (загрузка моделей).
+
+def fake_jpeg(size):
+    return b"\xff\xd8\xff\xe0" + os.urandom(max(0, size - 6)) + b"\xff\xd9"
+
+# Настоящий JPEG 1024x576 с шумом (одно изображение на все промпты)
+def real_jpeg():
+    import io
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.effect_noise((1024, 576), 64).convert("RGB").save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+class FakeComfyUI:
+    def __init__(self, host="127.0.0.1", port=0, latency=1.0, jitter=0.0, fail_rate=0.0,
+                 image_size=200_000, history_delay=0.0, cold_start=0.0, real_images=False):
+        self.latency = latency
+        self.jitter = jitter
+        self.fail_rate = fail_rate
+        self.image_size = image_size
+        self.real_image = real_jpeg() if real_images else None
+        # Задержка записи /history после события о завершении (как в настоящем ComfyUI)
+        self.history_delay = history_delay
+        self.cold_start = cold_start
+        self.warm = False
+        self.history = {}
+        self.images = {}
+        self.queue = queue.Queue()
+        self.pending = []
+        self.running = None
+        self.clients = {}
+        self.lock = threading.Lock()
+        # Статистика занятости "GPU"
+        self.busy_time = 0.0
+        self.started_at = None
+        self.prompts_total = 0
+        self.down = False
+        self._stopped = False
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self.host, self.port = self.server.server_address[:2]
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def start(self):
+        self.started_at = time.monotonic()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        threading.Thread(target=self._render_loop, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopped = True
+        self.queue.put(None)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def set_down(self, down):
+        self.down = down
+        if down:
+            self.warm = False
+            for client in list(self.clients.values()):
+                try:
+                    client["sock"].shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    # Доля времени простоя "GPU" с момента запуска
+    def idle_fraction(self):
+        total = time.monotonic() - self.started_at
+        return 1 - self.busy_time / total if total > 0 else 0.0
+
+    def reset_stats(self):
+        with self.lock:
+            self.busy_time = 0.0
+            self.started_at = time.monotonic()
+
+    def queue_prompt(self, prompt, client_id):
+        prompt_id = str(uuid.uuid4())
+        with self.lock:
+            self.prompts_total += 1
+            number = self.prompts_total
+            self.pending.append(prompt_id)
+        self.queue.put((prompt_id, prompt, client_id))
+        return {"prompt_id": prompt_id, "number": number, "node_errors": {}}
+
+    def send_event(self, client_id, msg_type, data):
+        client = self.clients.get(client_id)
+        if client is None:
+            return
+        payload = json.dumps({"type": msg_type, "data": data}).encode()
+        try:
+            with client["lock"]:
+                ws_send_frame(client["sock"], OP_TEXT, payload, mask=False)
+        except OSError:
+            self.clients.pop(client_id, None)
+
+    # Узлы вывода промпта: SaveImage-подобные узлы (есть вход images)
+    @staticmethod
+    def output_nodes(prompt):
+        return [node_id for node_id, node in prompt.items()
+                if isinstance(node, dict) and "images" in node.get("inputs", {})] or ["9"]
+
+    @staticmethod
+    def batch_size(prompt):
+        for node in prompt.values():
+            if isinstance(node, dict) and node.get("class_type") == "EmptyLatentImage":
+                return int(node["inputs"].get("batch_size", 1))
+        return 1
+
+    def _render_loop(self):
+        while not self._stopped:
+            item = self.queue.get()
+            if item is None:
+                return
+            prompt_id, prompt, client_id = item
+            with self.lock:
+                self.pending.remove(prompt_id)
+                self.running = prompt_id
+            started = time.monotonic()
+            self.send_event(client_id, "execution_start", {"prompt_id": prompt_id})
+            duration = max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+            if not self.warm:
+                duration += self.cold_start
+                self.warm = True
+            steps = 4
+            for step in range(steps):
+                time.sleep(duration / steps)
+                self.send_event(client_id, "progress", {"value": step + 1, "max": steps, "prompt_id": prompt_id, "node": "13"})
+
+            failed = random.random() < self.fail_rate
+            outputs = {}
+            if failed:
+                self.send_event(client_id, "execution_error", {
+                    "prompt_id": prompt_id, "node_id": "13", "exception_message": "injected failure"})
+            else:
+                for node_id in self.output_nodes(prompt):
+                    images = []
+                    for i in range(self.batch_size(prompt)):
+                        filename = f"ComfyUI_{prompt_id[:8]}_{node_id}_{i:05d}_.jpg"
+                        self.images[filename] = self.real_image or fake_jpeg(self.image_size)
+                        images.append({"filename": filename, "subfolder": "", "type": "output"})
+                    outputs[node_id] = {"images": images}
+                    self.send_event(client_id, "executed", {"node": node_id, "output": outputs[node_id], "prompt_id": prompt_id})
+                self.send_event(client_id, "executing", {"node": None, "prompt_id": prompt_id})
+
+            with self.lock:
+                self.busy_time += time.monotonic() - started
+                self.running = None
+            if self.history_delay:
+                time.sleep(self.history_delay)
+            self.history[prompt_id] = {
+                "prompt": [0, prompt_id, prompt, {}, list(outputs)],
+                "outputs": outputs,
+                "status": {
+                    "status_str": "error" if failed else "success",
+                    "completed": not failed,
+                    "messages": [],
+                },
+            }
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, data, code=200):
+                body = json.dumps(data).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # Сервер "упал": соединение закрывается без ответа
+            def refuse(self):
+                if fake.down:
+                    self.close_connection = True
+                return fake.down
+
+            def do_POST(self):
+                if self.refuse():
+                    return
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if urlsplit(self.path).path == "/prompt":
+                    if not isinstance(body.get("prompt"), dict):
+                        self.send_json({"error": "no prompt"}, 400)
+                        return
+                    self.send_json(fake.queue_prompt(body["prompt"], body.get("client_id")))
+                else:
+                    self.send_json({"error": "not found"}, 404)
+
+            def do_GET(self):
+                if self.refuse():
+                    return
+                parts = urlsplit(self.path)
+                params = parse_qs(parts.query)
+                if parts.path == "/ws":
+                    self.handle_websocket(params.get("clientId", [uuid.uuid4().hex])[0])
+                elif parts.path.startswith("/history/"):
+                    prompt_id = parts.path[len("/history/"):]
+                    entry = fake.history.get(prompt_id)
+                    self.send_json({prompt_id: entry} if entry else {})
+                elif parts.path == "/history":
+                    self.send_json(fake.history)
+                elif parts.path == "/queue":
+                    with fake.lock:
+                        running = [[0, fake.running]] if fake.running else []
+                        pending = [[0, pid] for pid in fake.pending]
+                    self.send_json({"queue_running": running, "queue_pending": pending})
+                elif parts.path == "/system_stats":
+                    self.send_json({"system": {"os": "fake"}, "devices": []})
+                elif parts.path == "/view":
+                    data = fake.images.get(params.get("filename", [""])[0])
+                    if data is None:
+                        self.send_json({"error": "not found"}, 404)
+                        return
+                    self.send_response(200)
+                    self.send_header("Content-Type", "image/jpeg")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                else:
+                    self.send_json({"error": "not found"}, 404)
+
+            def handle_websocket(self, client_id):
+                key = self.headers.get("Sec-WebSocket-Key")
+                if not key:
+                    self.send_json({"error": "websocket key required"}, 400)
+                    return
+                self.send_response(101)
+                self.send_header("Upgrade", "websocket")
+                self.send_header("Connection", "Upgrade")
+                self.send_header("Sec-WebSocket-Accept", ws_accept_key(key))
+                self.end_headers()
+                self.wfile.flush()
+                fake.clients[client_id] = {"sock": self.connection, "lock": threading.Lock()}
+                fake.send_event(client_id, "status", {"status": {"exec_info": {"queue_remaining": fake.queue.qsize()}}, "sid": client_id})
+                try:
+                    while not fake._stopped:
+                        opcode, payload = ws_read_message(self.rfile)
+                        if opcode == OP_CLOSE:
+                            break
+                        if opcode == OP_PING:
+                            with fake.clients[client_id]["lock"]:
+                                ws_send_frame(self.connection, OP_PONG, payload, mask=False)
+                except (ConnectionError, OSError):
+                    pass
+                finally:
+                    fake.clients.pop(client_id, None)
+                    self.close_connection = True
+
+        return Handler
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Поддельный сервер ComfyUI")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8888)
+    parser.add_argument("--latency", type=float, default=1.0, help="время рендера, секунды")
+    parser.add_argument("--jitter", type=float, default=0.0, help="разброс времени рендера, секунды")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="доля промптов с ошибкой")
+    parser.add_argument("--image-size", type=int, default=200_000, help="размер изображения, байт")
+    parser.add_argument("--history-delay", type=float, default=0.0,
+                        help="задержка записи /history после события о завершении, секунды")
+    parser.add_argument("--cold-start", type=float, default=0.0,
+                        help="дополнительное время первого промпта (загрузка моделей), секунды")
+    parser.add_argument("--real-images", action="store_true", help="отдавать настоящий JPEG (нужен Pillow)")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    server = FakeComfyUI(args.host, args.port, args.latency, args.jitter, args.fail_rate,
+                         args.image_size, args.history_delay, args.cold_start, args.real_images).start()
+    print(f"[LOG] Поддельный ComfyUI запущен на {server.url}")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        server.stop()
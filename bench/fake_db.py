@@ -0,0 +1,231 @@
+import datetime
+import glob
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import settings
+from metrics import TRACER
+
+# Тестовая таблица original_news для бенчмарков.
+# Если задан DSN PostgreSQL, используется настоящая база и функции db.py без изменений
+# (таблица создаётся, к ней применяются migrations/*.sql). Без DSN таблица создаётся
+# в SQLite, а функции db.py, использующие синтаксис PostgreSQL, заменяются
+# эквивалентами ниже с теми же сигнатурами (см. SQLiteNewsDB.patch)
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "migrations")
+
+TITLES = [
+    "Курс рубля укрепился на открытии торгов", "В Москве ожидается снегопад",
+    "Сборная выиграла товарищеский матч", "Учёные нашли новый вид лягушек",
+    "Открылась выставка современного искусства", "Цены на бензин остались без изменений",
+]
+
+def news_title(index):
+    return f"{TITLES[index % len(TITLES)]} #{index}"
+
+# Соединение SQLite с интерфейсом, который ожидает код воркера (closed, commit, rollback, close).
+# Все соединения фикстуры работают с одной базой, close() только помечает соединение закрытым
+class SQLiteConnection:
+    def __init__(self, news_db):
+        self.news_db = news_db
+        self.closed = False
+
+    def cursor(self):
+        return self.news_db.conn.cursor()
+
+    def commit(self):
+        self.news_db.conn.commit()
+
+    def rollback(self):
+        self.news_db.conn.rollback()
+
+    def close(self):
+        self.closed = True
+
+class SQLiteNewsDB:
+    def __init__(self, path=":memory:"):
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # Воркер и конвейер обращаются к базе из разных потоков
+        self.lock = threading.RLock()
+        self.conn.execute("""
+            CREATE TABLE original_news (
+                id INTEGER PRIMARY KEY,
+                title TEXT NOT NULL,
+                date_time TEXT NOT NULL,
+                image_url TEXT,
+                image_variants TEXT,
+                error_message TEXT,
+                claimed_by TEXT,
+                claimed_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                priority INTEGER NOT NULL DEFAULT 0,
+                deadline REAL
+            )
+        """)
+
+    def seed(self, count):
+        now = datetime.datetime.now()
+        with self.lock:
+            self.conn.execute("DELETE FROM original_news")
+            self.conn.executemany(
+                "INSERT INTO original_news (id, title, date_time) VALUES (?, ?, ?)",
+                [(i + 1, news_title(i), now.isoformat()) for i in range(count)]
+            )
+
+    def counts(self):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COUNT(image_url), COUNT(*) - COUNT(image_url) FROM original_news").fetchone()
+
+    def connect_to_db(self):
+        return SQLiteConnection(self)
+
+    def claim_news_batch(self, conn, worker_id, limit, lease_seconds, max_attempts):
+        started = time.monotonic()
+        now = time.time()
+        with self.lock:
+            rows = self.conn.execute("""
+                UPDATE original_news
+                SET claimed_by = ?, claimed_until = ?, attempts = attempts + 1
+                WHERE id IN (
+                    SELECT id FROM original_news
+                    WHERE image_url IS NULL AND attempts < ?
+                      AND (claimed_until IS NULL OR claimed_until < ?)
+                    ORDER BY priority DESC, date_time DESC, id LIMIT ?
+                )
+                RETURNING id, title, date_time, attempts, priority, deadline
+            """, (worker_id, now + lease_seconds, max_attempts, now, limit)).fetchall()
+        news_ids = [row[0] for row in rows]
+        TRACER.start(news_ids, started)
+        TRACER.mark(news_ids, "claim")
+        batch = []
+        for news_id, title, date_time, attempts, priority, deadline in rows:
+            date_time = datetime.datetime.fromisoformat(date_time)
+            if deadline is None and settings.NEWS_DEADLINE:
+                deadline = date_time.timestamp() + settings.NEWS_DEADLINE
+            batch.append({"id": news_id, "title": title, "date_time": date_time, "attempts": attempts,
+                          "priority": priority, "stale": deadline is not None and deadline < now})
+        # RETURNING не сохраняет порядок подзапроса
+        batch.sort(key=lambda news: (-news["priority"], -news["date_time"].timestamp(), news["id"]))
+        return batch
+
+    def extend_claims(self, conn, worker_id, news_ids, lease_seconds):
+        with self.lock:
+            self.conn.executemany(
+                "UPDATE original_news SET claimed_until = ? WHERE id = ? AND claimed_by = ? AND image_url IS NULL",
+                [(time.time() + lease_seconds, news_id, worker_id) for news_id in news_ids]
+            )
+
+    def reclaim_news(self, conn, worker_id, news_ids, previous_ids, lease_seconds):
+        now = time.time()
+        owned = set()
+        with self.lock:
+            for news_id in news_ids:
+                row = self.conn.execute(
+                    "UPDATE original_news SET claimed_by = ?, claimed_until = ? "
+                    "WHERE id = ? AND image_url IS NULL "
+                    "AND (claimed_by IN (SELECT value FROM json_each(?)) OR claimed_until IS NULL OR claimed_until < ?) "
+                    "RETURNING id",
+                    (worker_id, now + lease_seconds, news_id, json.dumps(list(previous_ids)), now)).fetchone()
+                if row:
+                    owned.add(row[0])
+        return owned
+
+    # ResultWriter с записью в SQLite
+    def writer_class(self):
+        news_db = self
+
+        class SQLiteResultWriter(db.ResultWriter):
+            def _execute(self, conn, images, errors):
+                with news_db.lock:
+                    news_db.conn.execute("BEGIN")
+                    try:
+                        news_db.conn.executemany(
+                            "UPDATE original_news SET image_url = ?, image_variants = ?, "
+                            "claimed_by = NULL, claimed_until = NULL WHERE id = ?",
+                            [(url, json.dumps(variants) if variants else None, news_id)
+                             for news_id, (url, variants) in images.items()])
+                        news_db.conn.executemany(
+                            "UPDATE original_news SET error_message = ?, claimed_by = NULL, claimed_until = ?, "
+                            "attempts = CASE WHEN ? THEN attempts ELSE MAX(attempts - 1, 0) END "
+                            "WHERE id = ? AND claimed_by = ?",
+                            [(message, time.time() + self.retry_delay, counted, news_id, self.worker_id)
+                             for news_id, (message, counted) in errors.items()])
+                        news_db.conn.execute("COMMIT")
+                    except Exception:
+                        news_db.conn.execute("ROLLBACK")
+                        raise
+
+        return SQLiteResultWriter
+
+    # Замена функций db.py в модулях, которые их импортировали
+    def patch(self, *modules):
+        for module in modules:
+            module.connect_to_db = self.connect_to_db
+            module.claim_news_batch = self.claim_news_batch
+            module.extend_claims = self.extend_claims
+            module.reclaim_news = self.reclaim_news
+            module.ResultWriter = self.writer_class()
+
+# Та же таблица в PostgreSQL (dsn - строка подключения psycopg2), функции db.py без изменений
+class PostgresNewsDB:
+    claim_news_batch = staticmethod(db.claim_news_batch)
+    extend_claims = staticmethod(db.extend_claims)
+
+    def __init__(self, dsn):
+        import psycopg2
+
+        self.dsn = dsn
+        self._connect = psycopg2.connect
+        statements = ["""
+            CREATE TABLE IF NOT EXISTS original_news (
+                id serial PRIMARY KEY,
+                title text NOT NULL,
+                date_time timestamp NOT NULL,
+                image_url text,
+                error_message text
+            )
+        """]
+        for path in sorted(glob.glob(os.path.join(MIGRATIONS_DIR, "*.sql"))):
+            with open(path, encoding="utf-8") as f:
+                statements.append(f.read())
+        self._execute(statements)
+
+    def connect_to_db(self):
+        return self._connect(self.dsn)
+
+    # Выполнение запросов в отдельном соединении, возвращает результат последнего
+    def _execute(self, statements, many=None):
+        conn = self.connect_to_db()
+        try:
+            with conn, conn.cursor() as cursor:
+                for sql in statements:
+                    cursor.execute(sql)
+                if many:
+                    cursor.executemany(*many)
+                return cursor.fetchone() if cursor.description else None
+        finally:
+            conn.close()
+
+    def seed(self, count):
+        now = datetime.datetime.now()
+        self._execute(["TRUNCATE original_news RESTART IDENTITY"],
+                      ("INSERT INTO original_news (title, date_time) VALUES (%s, %s)",
+                       [(news_title(i), now) for i in range(count)]))
+
+    def counts(self):
+        return self._execute(["SELECT COUNT(image_url), COUNT(*) - COUNT(image_url) FROM original_news"])
+
+    def writer_class(self):
+        return db.ResultWriter
+
+    def patch(self, *modules):
+        for module in modules:
+            module.connect_to_db = self.connect_to_db
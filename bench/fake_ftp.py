@@ -0,0 +1,234 @@
+import argparse
+import posixpath
+import socket
+import socketserver
+import threading
+import time
+
+# Минимальный FTP сервер в памяти для локальной проверки и бенчмарков.
+# Поддерживает команды, которые использует ftplib при загрузке изображений:
+# USER/PASS, PWD/CWD/MKD, TYPE, PASV, STOR/RETR, SIZE, NLST, DELE, RNFR/RNTO, NOOP, QUIT.
+# Файлы и каталоги хранятся в словаре files и множестве dirs.
+# command_latency добавляет задержку к каждой команде (имитация сетевого RTT)
+
+class FakeFTPServer:
+    def __init__(self, host="127.0.0.1", port=0, user="user", password="password", command_latency=0.0):
+        self.user = user
+        self.password = password
+        self.command_latency = command_latency
+        self.files = {}
+        self.dirs = {"/"}
+        self.lock = threading.Lock()
+        # Статистика для бенчмарков
+        self.logins = 0
+        self.commands = {}
+        self.bytes_received = 0
+        self.server = socketserver.ThreadingTCPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self.host, self.port = self.server.server_address[:2]
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, command):
+        with self.lock:
+            self.commands[command] = self.commands.get(command, 0) + 1
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, text):
+                self.wfile.write(f"{text}\r\n".encode())
+
+            def path(self, arg):
+                return posixpath.normpath(posixpath.join(self.cwd, arg or "."))
+
+            def open_data(self):
+                if self.pasv is None:
+                    self.reply("425 Use PASV first.")
+                    return None
+                conn, _ = self.pasv.accept()
+                self.pasv.close()
+                self.pasv = None
+                return conn
+
+            def handle(self):
+                self.cwd = "/"
+                self.logged_in = False
+                self.pasv = None
+                self.rename_from = None
+                self.reply("220 Fake FTP ready.")
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    command, _, arg = line.decode("utf-8", "replace").strip().partition(" ")
+                    command = command.upper()
+                    fake.count(command)
+                    if fake.command_latency:
+                        time.sleep(fake.command_latency)
+                    if command == "QUIT":
+                        self.reply("221 Bye.")
+                        return
+                    handler = getattr(self, f"cmd_{command}", None)
+                    if handler is None:
+                        self.reply("502 Command not implemented.")
+                    elif not self.logged_in and command not in ("USER", "PASS"):
+                        self.reply("530 Not logged in.")
+                    else:
+                        handler(arg)
+
+            def cmd_USER(self, arg):
+                self.username = arg
+                self.reply("331 Password required.")
+
+            def cmd_PASS(self, arg):
+                if self.username == fake.user and arg == fake.password:
+                    self.logged_in = True
+                    with fake.lock:
+                        fake.logins += 1
+                    self.reply("230 Logged in.")
+                else:
+                    self.reply("530 Login incorrect.")
+
+            def cmd_SYST(self, arg):
+                self.reply("215 UNIX Type: L8")
+
+            def cmd_NOOP(self, arg):
+                self.reply("200 NOOP ok.")
+
+            def cmd_TYPE(self, arg):
+                self.reply("200 Type set.")
+
+            def cmd_PWD(self, arg):
+                self.reply(f'257 "{self.cwd}" is the current directory.')
+
+            def cmd_CWD(self, arg):
+                path = self.path(arg)
+                if path in fake.dirs:
+                    self.cwd = path
+                    self.reply("250 Directory changed.")
+                else:
+                    self.reply("550 No such directory.")
+
+            def cmd_MKD(self, arg):
+                path = self.path(arg)
+                with fake.lock:
+                    if path in fake.dirs or posixpath.dirname(path) not in fake.dirs:
+                        self.reply("550 Cannot create directory.")
+                        return
+                    fake.dirs.add(path)
+                self.reply(f'257 "{path}" created.')
+
+            def cmd_PASV(self, arg):
+                self.pasv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.pasv.bind((fake.host, 0))
+                self.pasv.listen(1)
+                host, port = self.pasv.getsockname()[:2]
+                h = host.replace(".", ",")
+                self.reply(f"227 Entering Passive Mode ({h},{port >> 8},{port & 0xFF}).")
+
+            def cmd_STOR(self, arg):
+                path = self.path(arg)
+                if posixpath.dirname(path) not in fake.dirs:
+                    self.reply("550 No such directory.")
+                    return
+                conn = self.open_data()
+                if conn is None:
+                    return
+                self.reply("150 Ok to send data.")
+                chunks = []
+                with conn:
+                    while True:
+                        chunk = conn.recv(65536)
+                        if not chunk:
+                            break
+                        chunks.append(chunk)
+                data = b"".join(chunks)
+                with fake.lock:
+                    fake.files[path] = data
+                    fake.bytes_received += len(data)
+                self.reply("226 Transfer complete.")
+
+            def cmd_RETR(self, arg):
+                data = fake.files.get(self.path(arg))
+                if data is None:
+                    self.reply("550 No such file.")
+                    return
+                conn = self.open_data()
+                if conn is None:
+                    return
+                self.reply("150 Opening data connection.")
+                with conn:
+                    conn.sendall(data)
+                self.reply("226 Transfer complete.")
+
+            def cmd_SIZE(self, arg):
+                data = fake.files.get(self.path(arg))
+                if data is None:
+                    self.reply("550 No such file.")
+                else:
+                    self.reply(f"213 {len(data)}")
+
+            def cmd_NLST(self, arg):
+                path = self.path(arg)
+                names = [p for p in list(fake.files) + list(fake.dirs)
+                         if posixpath.dirname(p) == path and p != path]
+                conn = self.open_data()
+                if conn is None:
+                    return
+                self.reply("150 Here comes the listing.")
+                with conn:
+                    conn.sendall("".join(f"{n}\r\n" for n in names).encode())
+                self.reply("226 Directory send OK.")
+
+            def cmd_DELE(self, arg):
+                with fake.lock:
+                    if fake.files.pop(self.path(arg), None) is None:
+                        self.reply("550 No such file.")
+                        return
+                self.reply("250 File deleted.")
+
+            def cmd_RNFR(self, arg):
+                path = self.path(arg)
+                if path not in fake.files:
+                    self.reply("550 No such file.")
+                    return
+                self.rename_from = path
+                self.reply("350 Ready for RNTO.")
+
+            def cmd_RNTO(self, arg):
+                if self.rename_from is None:
+                    self.reply("503 RNFR required first.")
+                    return
+                with fake.lock:
+                    fake.files[self.path(arg)] = fake.files.pop(self.rename_from)
+                self.rename_from = None
+                self.reply("250 Rename successful.")
+
+        return Handler
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Поддельный FTP сервер в памяти")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2121)
+    parser.add_argument("--user", default="user")
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--command-latency", type=float, default=0.0, help="задержка каждой команды, секунды")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    server = FakeFTPServer(args.host, args.port, args.user, args.password, args.command_latency).start()
+    print(f"[LOG] Поддельный FTP сервер запущен на {server.host}:{server.port}")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        server.stop()
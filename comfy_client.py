@@ -0,0 +1,199 @@
+import http.client
+import json
+import queue
+import random
+import socket
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit, urlencode
+
+import settings
+from metrics import COMFY_REQUEST_SECONDS, RETRIES_TOTAL
+
+# Ошибки соединения, после которых запрос можно безопасно повторить
+RETRYABLE_ERRORS = (ConnectionError, socket.timeout, http.client.RemoteDisconnected,
+                    http.client.BadStatusLine, http.client.IncompleteRead)
+
+# Ошибка HTTP ответа ComfyUI (код != 2xx)
+class ComfyHTTPError(Exception):
+    def __init__(self, code, message):
+        super().__init__(f"HTTP {code}: {message}")
+        self.code = code
+        self.message = message
+
+# Клиент ComfyUI с пулом keep-alive соединений.
+# Все запросы к серверу идут через несколько постоянных HTTP соединений вместо
+# нового TCP подключения на каждый вызов. Пул потокобезопасен.
+# Ошибки соединения повторяются до retries раз с экспоненциальной паузой и случайным
+# разбросом (jitter). POST /prompt повторяется только если запрос точно не дошёл
+# до сервера, чтобы не поставить один промпт дважды
+class ComfyClient:
+    def __init__(self, base_url=settings.COMFY_URL, timeout=settings.COMFY_TIMEOUT,
+                 retries=settings.COMFY_RETRIES, pool_size=settings.COMFY_POOL_SIZE):
+        self.base_url = base_url.rstrip("/")
+        parts = urlsplit(self.base_url)
+        self.https = parts.scheme == "https"
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.https else 80)
+        self.timeout = timeout
+        self.retries = retries
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+
+    def _new_connection(self):
+        conn_class = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        return conn_class(self.host, self.port, timeout=self.timeout)
+
+    # Свободное соединение из пула или новое. Второе значение - было ли соединение уже использовано
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait(), True
+        except queue.Empty:
+            return self._new_connection(), False
+
+    def _release(self, conn):
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def _sleep_before_retry(self, attempt):
+        delay = settings.COMFY_RETRY_BACKOFF * (2 ** attempt)
+        time.sleep(delay + random.uniform(0, delay))
+
+    # Выполнение запроса. Возвращает открытый ответ и соединение; соединение
+    # нужно вернуть через _finish после чтения тела ответа
+    def _open(self, method, path, body=None, headers=None, idempotent=True):
+        attempt = 0
+        endpoint = path.split("?")[0].split("/")[1]
+        while True:
+            conn, reused = self._acquire()
+            sent = False
+            started = time.monotonic()
+            try:
+                conn.request(method, path, body=body, headers=headers or {})
+                sent = True
+                response = conn.getresponse()
+                COMFY_REQUEST_SECONDS.observe(time.monotonic() - started, endpoint=endpoint)
+                return response, conn
+            except RETRYABLE_ERRORS + (OSError, http.client.HTTPException) as e:
+                conn.close()
+                # Сервер закрыл простаивающее keep-alive соединение - запрос не был обработан
+                stale = reused and isinstance(e, (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError))
+                safe = idempotent or not sent or stale
+                if attempt >= self.retries or not safe or not isinstance(e, RETRYABLE_ERRORS + (OSError,)):
+                    raise
+                if not stale:
+                    print(f"[ERROR] Ошибка соединения с ComfyUI ({e}), повтор {attempt + 1} из {self.retries}...")
+                    RETRIES_TOTAL.inc(target="comfy")
+                    self._sleep_before_retry(attempt)
+                    attempt += 1
+
+    def _finish(self, conn, response):
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(conn)
+
+    # Запрос с чтением всего тела ответа. При коде != 2xx - ComfyHTTPError
+    def request(self, method, path, body=None, headers=None, idempotent=True):
+        response, conn = self._open(method, path, body, headers, idempotent)
+        try:
+            data = response.read()
+        except Exception:
+            conn.close()
+            raise
+        self._finish(conn, response)
+        if not 200 <= response.status < 300:
+            raise ComfyHTTPError(response.status, data.decode(errors="replace"))
+        return data
+
+    # Потоковый запрос: тело ответа читается вызывающим кодом по частям.
+    # Соединение возвращается в пул, только если тело было прочитано полностью
+    @contextmanager
+    def stream(self, method, path):
+        response, conn = self._open(method, path)
+        if not 200 <= response.status < 300:
+            data = response.read()
+            self._finish(conn, response)
+            raise ComfyHTTPError(response.status, data.decode(errors="replace"))
+        try:
+            yield response
+        finally:
+            if response.isclosed():
+                self._finish(conn, response)
+            else:
+                conn.close()
+
+    def get_json(self, path):
+        return json.loads(self.request("GET", path).decode())
+
+    def post_json(self, path, payload):
+        data = json.dumps(payload).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        return json.loads(self.request("POST", path, data, headers, idempotent=False).decode())
+
+    # Функция отправки промпта
+    def queue_prompt(self, prompt_workflow, client_id=None):
+        print("[LOG] Отправка запроса на генерацию...")
+        p = {"prompt": prompt_workflow}
+        if client_id:
+            # События по этому промпту ComfyUI отправит в WebSocket с тем же client_id
+            p["client_id"] = client_id
+        try:
+            result = self.post_json("/prompt", p)
+            print("[LOG] Запрос на генерацию отправлен успешно.")
+            return result
+        except ComfyHTTPError as e:
+            # 5xx - сбой сервера, а не промпта: исключение, чтобы пул попробовал другой сервер
+            if e.code >= 500:
+                raise
+            print("[ERROR] Ошибка при отправке запроса на генерацию.")
+            print("Код ошибки: ", e.code)
+            print("Сообщение: ", e.message)
+            return None
+
+    # Функция для проверки статуса генерации
+    def get_generation_status(self, prompt_id):
+        print(f"[LOG] Проверка статуса генерации для ID: {prompt_id}")
+        try:
+            result = self.get_json(f"/history/{prompt_id}")
+            print("[LOG] Статус генерации получен успешно.")
+            return result
+        except ComfyHTTPError as e:
+            print("[ERROR] Ошибка при получении статуса.")
+            print("Код ошибки: ", e.code)
+            print("Сообщение: ", e.message)
+            return None
+
+    def view_path(self, filename, subfolder="", folder_type="output"):
+        return "/view?" + urlencode({"filename": filename, "type": folder_type, "subfolder": subfolder})
+
+    # Скачивание изображения через /view
+    def get_image(self, filename, subfolder="", folder_type="output"):
+        return self.request("GET", self.view_path(filename, subfolder, folder_type))
+
+    # Открытие изображения через /view для потоковой передачи (без чтения в память целиком)
+    def open_image(self, filename, subfolder="", folder_type="output"):
+        return self.stream("GET", self.view_path(filename, subfolder, folder_type))
+
+_default_client = None
+
+# Общий клиент процесса для адреса settings.COMFY_URL
+def get_client():
+    global _default_client
+    if _default_client is None:
+        _default_client = ComfyClient()
+    return _default_client
+
+def queue_prompt(prompt_workflow, client_id=None):
+    return get_client().queue_prompt(prompt_workflow, client_id)
+
+def get_generation_status(prompt_id):
+    return get_client().get_generation_status(prompt_id)
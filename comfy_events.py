@@ -0,0 +1,306 @@
+import base64
+import hashlib
+import json
+import os
+import socket
+import struct
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+import settings
+
+# Минимальная реализация WebSocket (RFC 6455) на стандартной библиотеке:
+# ComfyUI присылает по /ws?clientId=... события о ходе выполнения промптов,
+# что позволяет узнать о готовности изображения сразу, без опроса /history
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+# Сколько завершённых промптов помнит слушатель. Результаты, которые никто не забрал
+# (промпт снят по таймауту или перенесён на другой сервер), вытесняются старейшими первыми
+FINISHED_LIMIT = 1000
+
+# Значение Sec-WebSocket-Accept для ключа клиента
+def ws_accept_key(key):
+    return base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+
+def _read_exact(f, n):
+    data = f.read(n)
+    if data is None or len(data) < n:
+        raise ConnectionError("WebSocket соединение закрыто")
+    return data
+
+# Чтение одного фрейма: (fin, opcode, payload)
+def ws_read_frame(f):
+    b1, b2 = _read_exact(f, 2)
+    fin = bool(b1 & 0x80)
+    opcode = b1 & 0x0F
+    masked = bool(b2 & 0x80)
+    length = b2 & 0x7F
+    if length == 126:
+        length = struct.unpack("!H", _read_exact(f, 2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", _read_exact(f, 8))[0]
+    mask = _read_exact(f, 4) if masked else None
+    payload = _read_exact(f, length) if length else b""
+    if mask:
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    return fin, opcode, payload
+
+# Чтение целого сообщения с учётом фрагментации: (opcode, payload)
+def ws_read_message(f):
+    fin, opcode, payload = ws_read_frame(f)
+    while not fin:
+        fin, _, more = ws_read_frame(f)
+        payload += more
+    return opcode, payload
+
+# Отправка фрейма. Клиент обязан маскировать данные, сервер - нет
+def ws_send_frame(sock, opcode, payload, mask=True):
+    header = bytes([0x80 | opcode])
+    mask_bit = 0x80 if mask else 0
+    length = len(payload)
+    if length < 126:
+        header += bytes([mask_bit | length])
+    elif length < 65536:
+        header += bytes([mask_bit | 126]) + struct.pack("!H", length)
+    else:
+        header += bytes([mask_bit | 127]) + struct.pack("!Q", length)
+    if mask:
+        key = os.urandom(4)
+        payload = bytes(b ^ key[i % 4] for i, b in enumerate(payload))
+        header += key
+    sock.sendall(header + payload)
+
+# Открытие WebSocket соединения. Возвращает (сокет, файловый объект для чтения)
+def ws_connect(url, timeout):
+    parts = urlsplit(url)
+    host = parts.hostname
+    port = parts.port or 80
+    path = parts.path or "/"
+    if parts.query:
+        path += f"?{parts.query}"
+    sock = socket.create_connection((host, port), timeout=timeout)
+    try:
+        key = base64.b64encode(os.urandom(16)).decode()
+        sock.sendall((
+            f"GET {path} HTTP/1.1\r\n"
+            f"Host: {host}:{port}\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\n"
+            "Sec-WebSocket-Version: 13\r\n\r\n"
+        ).encode())
+        f = sock.makefile("rb")
+        status_line = f.readline().decode("latin-1")
+        if " 101 " not in status_line:
+            raise ConnectionError(f"Сервер отказал в WebSocket соединении: {status_line.strip()}")
+        headers = {}
+        while True:
+            line = f.readline().decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if headers.get("sec-websocket-accept") != ws_accept_key(key):
+            raise ConnectionError("Неверный Sec-WebSocket-Accept от сервера")
+        # После рукопожатия чтение блокирующее, остановка - через закрытие сокета
+        sock.settimeout(None)
+        return sock, f
+    except Exception:
+        sock.close()
+        raise
+
+# Слушатель событий ComfyUI. В фоновом потоке читает события по WebSocket
+# и запоминает завершённые промпты своего client_id. Если сокет недоступен,
+# connected == False и вызывающий код опрашивает /history сам (см. PollBackoff).
+# Результат завершения: {"state": "success" | "error", "outputs": {...}}.
+# outputs собираются из событий "executed"; если их нет (например, весь промпт
+# взят из кэша ComfyUI), outputs пустой и результат нужно взять из /history.
+# Завершение приходит двумя событиями (execution_success, затем executing с node == None):
+# id завершённых промптов хранятся в _done, поэтому второе событие не возвращает результат,
+# который уже забрали через pop_finished
+class CompletionListener:
+    # cond - общее условие ожидания, если слушателей несколько (см. comfy_pool.PoolListener)
+    def __init__(self, base_url=settings.COMFY_URL, client_id=None, cond=None):
+        self.client_id = client_id or uuid.uuid4().hex
+        parts = urlsplit(base_url)
+        scheme = "wss" if parts.scheme == "https" else "ws"
+        self.ws_url = f"{scheme}://{parts.netloc}/ws?clientId={self.client_id}"
+        self.connected = False
+        self._cond = cond or threading.Condition()
+        self._outputs = {}
+        self._finished = OrderedDict()
+        self._done = OrderedDict()
+        self._sock = None
+        self._stopped = False
+        self._thread = None
+        # Необязательный обработчик, вызывается из фонового потока при завершении
+        # промпта и при отключении сокета (чтобы ожидающий код перешёл на опрос)
+        self.on_change = None
+
+    # Запуск фонового потока. Ждём подключения, чтобы не пропустить события первого промпта
+    def start(self, wait=settings.WS_CONNECT_TIMEOUT):
+        if self.ws_url.startswith("wss://"):
+            print("[LOG] WebSocket через TLS не поддерживается, используется опрос /history.")
+            return False
+        self._thread = threading.Thread(target=self._run, name="comfy-events", daemon=True)
+        self._thread.start()
+        with self._cond:
+            self._cond.wait_for(lambda: self.connected, timeout=wait)
+        if not self.connected:
+            print("[LOG] WebSocket ComfyUI недоступен, используется опрос /history.")
+        return self.connected
+
+    def stop(self):
+        self._stopped = True
+        sock = self._sock
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+        with self._cond:
+            self._cond.notify_all()
+
+    def _run(self):
+        reconnect_delay = 1
+        while not self._stopped:
+            try:
+                sock, f = ws_connect(self.ws_url, settings.WS_CONNECT_TIMEOUT)
+            except Exception as e:
+                print(f"[ERROR] Ошибка подключения к WebSocket ComfyUI: {e}")
+                time.sleep(reconnect_delay)
+                reconnect_delay = min(reconnect_delay * 2, 30)
+                continue
+            reconnect_delay = 1
+            self._sock = sock
+            with self._cond:
+                self.connected = True
+                self._cond.notify_all()
+            print(f"[LOG] Подключено к WebSocket ComfyUI, client_id: {self.client_id}")
+            try:
+                while not self._stopped:
+                    opcode, payload = ws_read_message(f)
+                    if opcode == OP_TEXT:
+                        self._handle(json.loads(payload.decode("utf-8")))
+                    elif opcode == OP_PING:
+                        ws_send_frame(sock, OP_PONG, payload)
+                    elif opcode == OP_CLOSE:
+                        break
+                    # OP_BINARY - превью изображений, они нам не нужны
+            except Exception as e:
+                if not self._stopped:
+                    print(f"[ERROR] WebSocket ComfyUI отключился: {e}")
+            finally:
+                self._sock = None
+                try:
+                    sock.close()
+                except OSError:
+                    pass
+                # События, пришедшие во время переподключения, будут потеряны:
+                # вызывающий код в это время опрашивает /history
+                with self._cond:
+                    self.connected = False
+                    self._cond.notify_all()
+                self._notify_change()
+
+    def _finish(self, prompt_id, state):
+        self._finished[prompt_id] = {"state": state, "outputs": self._outputs.pop(prompt_id, {})}
+        self._done[prompt_id] = True
+        for remembered in (self._finished, self._done):
+            while len(remembered) > FINISHED_LIMIT:
+                remembered.popitem(last=False)
+        self._cond.notify_all()
+        self._notify_change()
+
+    def _notify_change(self):
+        if self.on_change is not None:
+            self.on_change()
+
+    def _handle(self, message):
+        msg_type = message.get("type")
+        data = message.get("data") or {}
+        prompt_id = data.get("prompt_id")
+        if not prompt_id:
+            return
+        with self._cond:
+            if prompt_id in self._done:
+                # Повторное событие завершения уже обработанного промпта
+                return
+            if msg_type == "executed":
+                # Узел вывода записал файл: запоминаем его изображения
+                node_output = data.get("output") or {}
+                self._outputs.setdefault(prompt_id, {})[data.get("node")] = node_output
+            elif msg_type == "executing" and data.get("node") is None:
+                # node == None означает, что выполнение промпта завершено
+                self._finish(prompt_id, "success")
+            elif msg_type == "execution_success":
+                self._finish(prompt_id, "success")
+            elif msg_type in ("execution_error", "execution_interrupted"):
+                self._finish(prompt_id, "error")
+            elif msg_type == "progress":
+                print(f"[LOG] Прогресс {prompt_id}: {data.get('value')}/{data.get('max')}")
+
+    def has_finished(self, prompt_ids):
+        with self._cond:
+            return any(pid in self._finished for pid in prompt_ids)
+
+    # Забрать результаты завершённых промптов из списка prompt_ids
+    def pop_finished(self, prompt_ids):
+        with self._cond:
+            return {pid: self._finished.pop(pid) for pid in prompt_ids if pid in self._finished}
+
+    # Ожидание завершения любого из prompt_ids, отключения сокета или таймаута
+    def wait(self, prompt_ids, timeout):
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._stopped or not self.connected or self.has_finished(prompt_ids),
+                timeout=timeout
+            )
+
+# Запуск слушателя событий ComfyUI (None, если WebSocket отключён в настройках)
+def start_listener(base_url=settings.COMFY_URL):
+    if not settings.USE_WEBSOCKET:
+        return None
+    listener = CompletionListener(base_url)
+    listener.start()
+    return listener
+
+# Адаптивный интервал опроса /history: начинаем с малого интервала
+# и удваиваем его до max_interval, пока задача не завершится
+class PollBackoff:
+    def __init__(self, min_interval=settings.POLL_MIN_INTERVAL, max_interval=settings.POLL_MAX_INTERVAL):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.next_poll = time.monotonic() + min_interval
+
+    def due(self, now):
+        return now >= self.next_poll
+
+    def backoff(self, now):
+        self.interval = min(self.interval * 2, self.max_interval)
+        self.next_poll = now + self.interval
+
+    # Запланировать опрос не раньше чем через delay (страховочный опрос при работающем WebSocket)
+    def defer(self, now, delay):
+        self.next_poll = now + delay
+
+    # Событие пришло, но /history ещё не записан: снова опрашиваем часто
+    def reset(self, now):
+        self.interval = self.min_interval
+        self.next_poll = now + self.interval
+
+    # WebSocket отключился: страховочный опрос не должен ждать дольше max_interval
+    def clamp(self, now):
+        if self.next_poll > now + self.max_interval:
+            self.reset(now)
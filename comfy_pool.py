@@ -0,0 +1,250 @@
+import threading
+import time
+import uuid
+
+import settings
+from comfy_client import ComfyClient
+from comfy_events import CompletionListener
+from metrics import REGISTRY, Gauge, RETRIES_TOTAL
+
+# Пул серверов ComfyUI (settings.COMFY_URLS).
+# Каждый промпт отправляется на наименее загруженный сервер: промпты этого воркера
+# в работе на сервере плюс чужие промпты в его очереди по последней проверке /queue.
+# Сервер, на который отправлен промпт, запоминается в задаче (Backend): статус и изображения
+# запрашиваются только у него. Фоновый поток раз в COMFY_HEALTH_INTERVAL секунд опрашивает /queue
+# всех серверов; после COMFY_EJECT_AFTER неудач подряд сервер исключается из распределения,
+# а вызывающий код переотправляет его промпты на другие серверы (см. should_reschedule).
+# Исключённый сервер продолжает проверяться и возвращается после первой успешной проверки.
+# С одним сервером поведение то же, что и без пула: промпты ждут его восстановления.
+# Сервер считается "холодным" (warm == False), пока на нём не выполнен ни один промпт
+# после запуска воркера или восстановления: промпты на нём ждут COLD_START_TIMEOUT (см. warmup.py)
+
+BACKEND_IN_FLIGHT = REGISTRY.add(Gauge(
+    "comfy_backend_in_flight", "Промпты воркера в работе на сервере ComfyUI", ("backend",)))
+BACKEND_HEALTHY = REGISTRY.add(Gauge(
+    "comfy_backend_healthy", "Сервер ComfyUI доступен (1) или исключён из распределения (0)", ("backend",)))
+
+class Backend:
+    def __init__(self, pool, url, retries):
+        self.pool = pool
+        self.url = url.rstrip("/")
+        self.client = ComfyClient(self.url, retries=retries)
+        # Для проверок - отдельный клиент без повторов: недоступный сервер должен обнаруживаться быстро
+        self.health_client = ComfyClient(self.url, timeout=settings.COMFY_HEALTH_INTERVAL, retries=0, pool_size=1)
+        self.listener = CompletionListener(self.url, pool.client_id, pool.cond) if settings.USE_WEBSOCKET else None
+        self.in_flight = 0
+        # Чужие промпты в очереди сервера по последней проверке /queue
+        self.foreign = 0
+        self.failures = 0
+        self.healthy = True
+        self.warm = False
+        # Время последней отправки или завершения промпта (для поддержания моделей в памяти)
+        self.last_used = time.monotonic()
+
+    def load(self):
+        return self.in_flight + self.foreign
+
+    # Ошибка запроса к серверу (учитывается при исключении сервера из пула)
+    def failed(self, error):
+        self.pool.mark_failed(self, error)
+
+    def __repr__(self):
+        return self.url
+
+# Слушатель событий всех серверов пула с тем же интерфейсом, что у CompletionListener.
+# У всех серверов один client_id; prompt_id уникальны, поэтому события можно объединять
+class PoolListener:
+    def __init__(self, pool):
+        self.pool = pool
+        self.client_id = pool.client_id
+        self._cond = pool.cond
+        self._stopped = False
+        self._version = 0
+        self.on_change = None
+        for backend in pool.backends:
+            backend.listener.on_change = self._notify_change
+
+    def _listeners(self):
+        active = [backend for backend in self.pool.backends if backend.healthy] or self.pool.backends
+        return [backend.listener for backend in active]
+
+    # События доступны, только если подключены слушатели всех доступных серверов
+    @property
+    def connected(self):
+        return all(listener.connected for listener in self._listeners())
+
+    def start(self):
+        for backend in self.pool.backends:
+            backend.listener.start()
+        return self.connected
+
+    def stop(self):
+        self._stopped = True
+        for backend in self.pool.backends:
+            backend.listener.stop()
+
+    # Изменение состава пула (сервер исключён или вернулся): ожидающий код должен проснуться
+    def _notify_change(self):
+        with self._cond:
+            self._version += 1
+            self._cond.notify_all()
+        if self.on_change is not None:
+            self.on_change()
+
+    def pop_finished(self, prompt_ids):
+        finished = {}
+        for backend in self.pool.backends:
+            finished.update(backend.listener.pop_finished(prompt_ids))
+        return finished
+
+    def wait(self, prompt_ids, timeout):
+        with self._cond:
+            version = self._version
+            self._cond.wait_for(
+                lambda: (self._stopped or not self.connected or self._version != version
+                         or any(backend.listener.has_finished(prompt_ids) for backend in self.pool.backends)),
+                timeout=timeout
+            )
+
+class BackendPool:
+    def __init__(self, urls=None, eject_after=None, health_interval=None):
+        self.client_id = uuid.uuid4().hex
+        self.cond = threading.Condition()
+        urls = urls or settings.COMFY_URLS
+        # С несколькими серверами запрос к недоступному не повторяется с паузами:
+        # промпт быстрее отправить на другой сервер, чем ждать этот
+        retries = settings.COMFY_RETRIES if len(urls) == 1 else 0
+        self.backends = [Backend(self, url, retries) for url in urls]
+        self.eject_after = eject_after or settings.COMFY_EJECT_AFTER
+        self.health_interval = health_interval or settings.COMFY_HEALTH_INTERVAL
+        self.listener = PoolListener(self) if settings.USE_WEBSOCKET else None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        for backend in self.backends:
+            BACKEND_HEALTHY.set(1, backend=backend.url)
+            BACKEND_IN_FLIGHT.set(0, backend=backend.url)
+
+    def start(self):
+        if self.listener:
+            self.listener.start()
+        self.check()
+        self._thread = threading.Thread(target=self._run, name="comfy-health", daemon=True)
+        self._thread.start()
+        print(f"[LOG] Серверы ComfyUI: {', '.join(backend.url for backend in self.backends)}")
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self.listener:
+            self.listener.stop()
+        for backend in self.backends:
+            backend.client.close()
+            backend.health_client.close()
+
+    def _run(self):
+        while not self._stopped.wait(self.health_interval):
+            self.check()
+
+    # Проверка всех серверов запросом /queue
+    def check(self):
+        for backend in self.backends:
+            try:
+                data = backend.health_client.get_json("/queue")
+            except Exception as e:
+                self.mark_failed(backend, e)
+                continue
+            queued = len(data.get("queue_running", [])) + len(data.get("queue_pending", []))
+            with self._lock:
+                # В очереди сервера есть и наши промпты, их учитывает in_flight
+                backend.foreign = max(0, queued - backend.in_flight)
+                backend.failures = 0
+                restored = not backend.healthy
+                backend.healthy = True
+                if restored:
+                    # Сервер мог быть перезапущен: модели придётся загружать заново
+                    backend.warm = False
+            if restored:
+                print(f"[LOG] Сервер ComfyUI {backend.url} снова доступен.")
+                BACKEND_HEALTHY.set(1, backend=backend.url)
+                self._notify_change()
+
+    def mark_failed(self, backend, error):
+        with self._lock:
+            backend.failures += 1
+            ejected = backend.healthy and backend.failures >= self.eject_after
+            if ejected:
+                backend.healthy = False
+        if ejected:
+            print(f"[ERROR] Сервер ComfyUI {backend.url} исключён после {backend.failures} ошибок подряд: {error}")
+            BACKEND_HEALTHY.set(0, backend=backend.url)
+            self._notify_change()
+
+    def _notify_change(self):
+        if self.listener:
+            self.listener._notify_change()
+
+    # Серверы в порядке отправки: сначала доступные, среди них - наименее загруженные
+    def _candidates(self):
+        with self._lock:
+            return sorted(self.backends, key=lambda backend: (not backend.healthy, backend.load()))
+
+    # Сервер пула по адресу (None, если его больше нет в COMFY_URLS)
+    def find(self, url):
+        url = url.rstrip("/")
+        return next((backend for backend in self.backends if backend.url == url), None)
+
+    def healthy_count(self):
+        return sum(backend.healthy for backend in self.backends)
+
+    # Отправка промпта на наименее загруженный сервер. Возвращает (Backend, ответ /prompt или None).
+    # Если сервер недоступен, промпт отправляется на следующий. Ошибка соединения после отправки
+    # может означать, что промпт всё же принят: тогда он будет выполнен дважды, но результат
+    # возьмётся только с сервера, ответившего prompt_id
+    def queue_prompt(self, prompt_workflow):
+        error = None
+        for backend in self._candidates():
+            try:
+                result = backend.client.queue_prompt(prompt_workflow, self.client_id)
+            except Exception as e:
+                print(f"[ERROR] Сервер ComfyUI {backend.url} не принял промпт: {e}")
+                self.mark_failed(backend, e)
+                error = e
+                continue
+            if result and result.get('prompt_id'):
+                self.acquire(backend)
+            # Ошибка HTTP (например, неверный workflow) повторится на любом сервере
+            return backend, result
+        raise error
+
+    def acquire(self, backend):
+        with self._lock:
+            backend.in_flight += 1
+            backend.last_used = time.monotonic()
+        BACKEND_IN_FLIGHT.set(backend.in_flight, backend=backend.url)
+
+    # Промпт завершён или снят с сервера. success - промпт выполнен, модели сервера загружены
+    def release(self, backend, success=False):
+        with self._lock:
+            backend.in_flight = max(0, backend.in_flight - 1)
+            backend.last_used = time.monotonic()
+            if success:
+                backend.warm = True
+        BACKEND_IN_FLIGHT.set(backend.in_flight, backend=backend.url)
+
+    # Сколько ждать промпт, отправленный на сервер: на холодном сервере сначала загружаются модели
+    def generation_timeout(self, backend):
+        return settings.GENERATION_TIMEOUT if backend.warm else settings.COLD_START_TIMEOUT
+
+    # Промпт нужно отправить заново, если его сервер исключён и есть другой доступный
+    def should_reschedule(self, backend):
+        return not backend.healthy and self.healthy_count() > 0
+
+    def reschedule(self, backend, news_ids):
+        self.release(backend)
+        RETRIES_TOTAL.inc(target="backend")
+        print(f"[LOG] Новости {news_ids} переотправляются: сервер {backend.url} недоступен.")
+
+# Запуск пула серверов ComfyUI из настроек (аналог comfy_events.start_listener)
+def start_backend_pool(urls=None):
+    return BackendPool(urls).start()
@@ -0,0 +1,285 @@
+import json
+import threading
+import time
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+import settings
+from journal import JOURNAL
+from metrics import DB_WRITE_SECONDS, TRACER
+
+# Подключение к базе данных PostgreSQL
+def connect_to_db():
+    try:
+        conn = psycopg2.connect(
+            user=settings.DB_USER,
+            host=settings.DB_HOST,
+            database=settings.DB_NAME,
+            password=settings.DB_PASSWORD,
+            port=settings.DB_PORT
+        )
+        print("[LOG] Подключение к базе данных установлено.")
+        return conn
+    except Exception as e:
+        print(f"[ERROR] Ошибка подключения к базе данных: {e}")
+        return None
+
+# Откат транзакции после ошибки, чтобы соединение можно было использовать дальше
+def rollback_quietly(conn):
+    try:
+        if not conn.closed:
+            conn.rollback()
+    except Exception as e:
+        print(f"[ERROR] Ошибка при откате транзакции: {e}")
+
+# Атомарный захват пачки новостей без изображения.
+# FOR UPDATE SKIP LOCKED позволяет нескольким воркерам на разных хостах
+# забирать разные строки без ожидания друг друга. Захваченная строка получает
+# аренду (claimed_until): если воркер упал, после её истечения строку заберёт другой.
+# Каждый захват увеличивает attempts, строки с attempts >= max_attempts больше не выбираются.
+# Новости выбираются по убыванию priority, затем от свежих к старым: при большой очереди
+# срочные новости не ждут за устаревшими. Порядок совпадает с частичным индексом
+# original_news_pending_idx (WHERE image_url IS NULL), поэтому захват не замедляется с ростом таблицы.
+# stale - истёк срок новости: колонка deadline или date_time + deadline_seconds (None - только колонка).
+# Требует колонок из migrations/001_claim_columns.sql и migrations/003_claim_priority.sql
+CLAIM_SQL = """
+WITH picked AS (
+    SELECT id
+    FROM original_news
+    WHERE image_url IS NULL
+      AND attempts < %(max_attempts)s
+      AND (claimed_until IS NULL OR claimed_until < now())
+    ORDER BY priority DESC, date_time DESC
+    LIMIT %(limit)s
+    FOR UPDATE SKIP LOCKED
+), claimed AS (
+    UPDATE original_news AS n
+    SET claimed_by = %(worker_id)s,
+        claimed_until = now() + make_interval(secs => %(lease_seconds)s),
+        attempts = n.attempts + 1
+    FROM picked
+    WHERE n.id = picked.id
+    RETURNING n.id, n.title, n.date_time, n.attempts, n.priority,
+        COALESCE(n.deadline, n.date_time + make_interval(secs => %(deadline_seconds)s)) < now() AS stale
+)
+SELECT * FROM claimed ORDER BY priority DESC, date_time DESC;
+"""
+
+def claim_news_batch(conn, worker_id, limit, lease_seconds, max_attempts):
+    deadline_seconds = settings.NEWS_DEADLINE or None
+    started = time.monotonic()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(CLAIM_SQL, {
+                "worker_id": worker_id,
+                "limit": limit,
+                "lease_seconds": lease_seconds,
+                "max_attempts": max_attempts,
+                "deadline_seconds": deadline_seconds,
+            })
+            rows = cursor.fetchall()
+        conn.commit()
+        # Трасса каждой новости начинается с захвата (см. metrics.Tracer)
+        news_ids = [row[0] for row in rows]
+        TRACER.start(news_ids, started)
+        TRACER.mark(news_ids, "claim")
+        return [{"id": row[0], "title": row[1], "date_time": row[2], "attempts": row[3],
+                 "priority": row[4], "stale": bool(row[5])} for row in rows]
+    except Exception as e:
+        print(f"[ERROR] Ошибка при захвате записей из базы данных: {e}")
+        rollback_quietly(conn)
+        return []
+
+# Повторный захват новостей из журнала задач после перезапуска (см. journal.py).
+# Строка захватывается, если у неё всё ещё нет изображения и её аренда принадлежит одному
+# из прежних воркеров (previous_ids) или истекла. Попытка не считается: работа продолжается,
+# а не начинается заново. Возвращает множество захваченных id или None при ошибке
+def reclaim_news(conn, worker_id, news_ids, previous_ids, lease_seconds):
+    if not news_ids:
+        return set()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "UPDATE original_news SET claimed_by = %s, claimed_until = now() + make_interval(secs => %s) "
+                "WHERE id = ANY(%s) AND image_url IS NULL "
+                "AND (claimed_by = ANY(%s) OR claimed_until IS NULL OR claimed_until < now()) "
+                "RETURNING id;",
+                (worker_id, lease_seconds, list(news_ids), list(previous_ids))
+            )
+            rows = cursor.fetchall()
+        conn.commit()
+        return {row[0] for row in rows}
+    except Exception as e:
+        print(f"[ERROR] Ошибка при повторном захвате записей из журнала: {e}")
+        rollback_quietly(conn)
+        return None
+
+# Продление аренды для ещё не обработанных строк воркера,
+# чтобы длинная пачка не была перехвачена другим воркером по истечении аренды
+def extend_claims(conn, worker_id, news_ids, lease_seconds):
+    if not news_ids:
+        return
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "UPDATE original_news SET claimed_until = now() + make_interval(secs => %s) "
+                "WHERE id = ANY(%s) AND claimed_by = %s AND image_url IS NULL;",
+                (lease_seconds, list(news_ids), worker_id)
+            )
+        conn.commit()
+    except Exception as e:
+        print(f"[ERROR] Ошибка при продлении аренды: {e}")
+        rollback_quietly(conn)
+
+# Причины неудачи (см. InFlightScheduler.fail), за которые расходуется попытка: ошибка генерации,
+# генерация без изображений, таймаут, промпт не построен или отклонён ComfyUI (rejected),
+# FTP или ComfyUI отказали в файле (upload_rejected, см. jobs.upload_failure_cause).
+# При недоступности ComfyUI или FTP (submit, upload) попытка возвращается, иначе сбой
+# инфраструктуры исчерпал бы попытки всех захваченных за это время строк
+COUNTED_FAILURES = {"generation", "no_images", "timeout", "rejected", "upload_rejected"}
+
+# Буфер результатов обработки для записи в БД пачками.
+# Вместо UPDATE + COMMIT на каждую новость результаты накапливаются и записываются
+# одним UPDATE ... FROM (VALUES ...) на все image_url и одним на все ошибки,
+# в одной транзакции. Запись происходит, когда в буфере max_batch строк или
+# самой старой строке больше max_delay секунд (см. should_flush), и при остановке (close).
+# Если запись не удалась, строки остаются в буфере до следующей попытки
+class ResultWriter:
+    def __init__(self, worker_id, max_batch=settings.RESULT_BATCH_SIZE, max_delay=settings.RESULT_FLUSH_INTERVAL,
+                 retry_delay=settings.CLAIM_RETRY_DELAY):
+        self.worker_id = worker_id
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.retry_delay = retry_delay
+        self._images = {}
+        self._errors = {}
+        self._first_added = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._images) + len(self._errors)
+
+    def _touch(self):
+        if self._first_added is None:
+            self._first_added = time.monotonic()
+
+    # variants - пути производных изображений {имя: путь} (см. variants.py) или None
+    def add_image(self, news_id, image_url, variants=None):
+        with self._lock:
+            self._errors.pop(news_id, None)
+            self._images[news_id] = (image_url, variants)
+            self._touch()
+
+    # counted=False - попытка возвращается строке (см. COUNTED_FAILURES)
+    def add_error(self, news_id, error_message, counted=True):
+        with self._lock:
+            self._images.pop(news_id, None)
+            self._errors[news_id] = (error_message, counted)
+            self._touch()
+
+    def pending_ids(self):
+        with self._lock:
+            return list(self._images) + list(self._errors)
+
+    # Через сколько секунд буфер нужно записать по времени (None - буфер пуст)
+    def time_to_flush(self):
+        with self._lock:
+            if self._first_added is None:
+                return None
+            return max(0.0, self._first_added + self.max_delay - time.monotonic())
+
+    def should_flush(self):
+        if len(self) >= self.max_batch:
+            return True
+        remaining = self.time_to_flush()
+        return remaining is not None and remaining <= 0
+
+    # Запись буфера одной транзакцией
+    def _execute(self, conn, images, errors):
+        with conn.cursor() as cursor:
+            if images and any(variants for _, variants in images.values()):
+                # Колонка image_variants (migrations/002_image_variants.sql) используется,
+                # только если производные изображения создаются
+                rows = [(news_id, image_url, json.dumps(variants) if variants else None)
+                        for news_id, (image_url, variants) in images.items()]
+                execute_values(cursor, """
+                    UPDATE original_news AS n
+                    SET image_url = v.image_url, image_variants = v.image_variants::jsonb,
+                        claimed_by = NULL, claimed_until = NULL
+                    FROM (VALUES %s) AS v(id, image_url, image_variants)
+                    WHERE n.id = v.id;
+                """, rows, page_size=len(rows))
+            elif images:
+                rows = [(news_id, image_url) for news_id, (image_url, _) in images.items()]
+                execute_values(cursor, """
+                    UPDATE original_news AS n
+                    SET image_url = v.image_url, claimed_by = NULL, claimed_until = NULL
+                    FROM (VALUES %s) AS v(id, image_url)
+                    WHERE n.id = v.id;
+                """, rows, page_size=len(rows))
+            if errors:
+                # Строка с ошибкой освобождается и станет доступна для повтора через retry_delay секунд,
+                # попытка, не связанная с самой новостью, не учитывается (attempts увеличен при захвате).
+                # execute_values допускает только один параметр %s (для VALUES),
+                # поэтому остальные параметры подставляются заранее через mogrify
+                sql = cursor.mogrify("""
+                    UPDATE original_news AS n
+                    SET error_message = v.error_message, claimed_by = NULL,
+                        claimed_until = now() + make_interval(secs => %s),
+                        attempts = CASE WHEN v.counted THEN n.attempts ELSE GREATEST(n.attempts - 1, 0) END
+                    FROM (VALUES %%s) AS v(id, error_message, counted)
+                    WHERE n.id = v.id AND n.claimed_by = %s;
+                """, (self.retry_delay, self.worker_id)).decode()
+                rows = [(news_id, error_message, counted) for news_id, (error_message, counted) in errors.items()]
+                execute_values(cursor, sql, rows, page_size=len(rows))
+        conn.commit()
+
+    # Запись всего буфера в БД. Возвращает True, если буфер записан
+    def flush(self, conn):
+        with self._lock:
+            images, self._images = self._images, {}
+            errors, self._errors = self._errors, {}
+            self._first_added = None
+        if not images and not errors:
+            return True
+        try:
+            started = time.monotonic()
+            self._execute(conn, images, errors)
+            DB_WRITE_SECONDS.observe(time.monotonic() - started)
+            TRACER.finish(list(images), "success")
+            TRACER.finish(list(errors), "error")
+            JOURNAL.committed(list(images) + list(errors))
+            print(f"[LOG] Записано в БД: изображений {len(images)}, ошибок {len(errors)}.")
+            return True
+        except Exception as e:
+            print(f"[ERROR] Ошибка при записи результатов в БД: {e}")
+            rollback_quietly(conn)
+            # Возвращаем строки в буфер, более новые результаты имеют приоритет
+            with self._lock:
+                for news_id, image in images.items():
+                    if news_id not in self._errors:
+                        self._images.setdefault(news_id, image)
+                for news_id, error in errors.items():
+                    if news_id not in self._images:
+                        self._errors.setdefault(news_id, error)
+                self._touch()
+            return False
+
+    # Запись при остановке. Строки, которые так и не удалось записать, выводятся в лог:
+    # после истечения аренды они будут обработаны заново. Повторы - только пока соединение живо
+    def close(self, conn, attempts=3):
+        if not len(self):
+            return True
+        for attempt in range(attempts):
+            if conn is None or conn.closed:
+                break
+            if self.flush(conn):
+                return True
+            if attempt + 1 < attempts:
+                time.sleep(attempt + 1)
+        lost = self.pending_ids()
+        if lost:
+            print(f"[ERROR] Не удалось записать результаты для ID: {lost}")
+        return not lost
@@ -0,0 +1,235 @@
+import ftplib
+import io
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from ftplib import FTP
+
+import settings
+from metrics import FTP_OPERATION_SECONDS, FTP_UPLOADED_BYTES, RETRIES_TOTAL
+
+# Ошибки, после которых FTP сессию нужно пересоздать
+CONNECTION_ERRORS = (OSError, EOFError, ftplib.error_temp, ftplib.error_proto, ftplib.error_reply)
+
+# Пул авторизованных FTP сессий.
+# Сессии не закрываются после загрузки, а возвращаются в пул; сессия, простоявшая
+# дольше keepalive секунд, проверяется командой NOOP и при ошибке пересоздаётся.
+# Пул запоминает каталоги, которые уже существуют или были созданы, поэтому
+# папка месяца проверяется один раз за время работы процесса, а не для каждого изображения
+class FtpPool:
+    def __init__(self, host=settings.FTP_HOST, user=settings.FTP_USER, password=settings.FTP_PASSWORD,
+                 port=settings.FTP_PORT, size=settings.FTP_POOL_SIZE, keepalive=settings.FTP_KEEPALIVE,
+                 timeout=settings.FTP_TIMEOUT, retries=settings.FTP_RETRIES):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.port = port
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.retries = retries
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._known_dirs = set()
+        self._dirs_lock = threading.Lock()
+
+    def _connect(self):
+        print(f"[LOG] Подключение к FTP серверу {self.host}:{self.port}...")
+        started = time.monotonic()
+        ftp = FTP()
+        ftp.connect(self.host, self.port, timeout=self.timeout)
+        ftp.login(user=self.user, passwd=self.password)
+        FTP_OPERATION_SECONDS.observe(time.monotonic() - started, operation="connect")
+        return ftp
+
+    @staticmethod
+    def _close(ftp):
+        try:
+            ftp.quit()
+        except Exception:
+            ftp.close()
+
+    # Живая сессия из пула: простоявшая долго проверяется NOOP, мёртвая пересоздаётся
+    def _acquire(self):
+        self._slots.acquire()
+        try:
+            while True:
+                try:
+                    ftp, last_used = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                if time.monotonic() - last_used < self.keepalive:
+                    return ftp
+                try:
+                    ftp.voidcmd("NOOP")
+                    return ftp
+                except CONNECTION_ERRORS:
+                    ftp.close()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _release(self, ftp, broken=False):
+        if broken:
+            ftp.close()
+        else:
+            self._idle.put((ftp, time.monotonic()))
+        self._slots.release()
+
+    @contextmanager
+    def session(self):
+        ftp = self._acquire()
+        broken = False
+        try:
+            yield ftp
+        except Exception as e:
+            # После error_perm управляющее соединение в порядке, после остальных ошибок
+            # (в том числе оборванной передачи) ответы сервера могли остаться непрочитанными
+            broken = not isinstance(e, ftplib.error_perm)
+            raise
+        finally:
+            self._release(ftp, broken)
+
+    # NOOP для простаивающих сессий, чтобы сервер не закрыл их по таймауту.
+    # Вызывается воркером, пока очередь новостей пуста
+    def send_keepalive(self):
+        sessions = []
+        while True:
+            try:
+                sessions.append(self._idle.get_nowait())
+            except queue.Empty:
+                break
+        for ftp, last_used in sessions:
+            if time.monotonic() - last_used < self.keepalive:
+                self._idle.put((ftp, last_used))
+                continue
+            try:
+                ftp.voidcmd("NOOP")
+                self._idle.put((ftp, time.monotonic()))
+            except CONNECTION_ERRORS:
+                ftp.close()
+
+    def close(self):
+        while True:
+            try:
+                ftp, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._close(ftp)
+
+    def forget_directory(self, path):
+        with self._dirs_lock:
+            self._known_dirs = {d for d in self._known_dirs if d != path and not d.startswith(f"{path}/")}
+
+    # Функция для создания пути на FTP с проверкой и созданием вложенных директорий.
+    # Уже подтверждённые каталоги пропускаются без обращения к серверу
+    def ensure_directory(self, ftp, path):
+        if path in self._known_dirs:
+            return
+        started = time.monotonic()
+        current_path = ""
+        for directory in path.split('/'):
+            if not directory:  # Пропускаем пустые части
+                continue
+            current_path += f"/{directory}"
+            if current_path in self._known_dirs:
+                continue
+            try:
+                ftp.cwd(current_path)
+                print(f"[LOG] Директория {current_path} уже существует на FTP.")
+            except ftplib.error_perm:
+                print(f"[LOG] Директория {current_path} не существует. Пытаюсь создать...")
+                try:
+                    ftp.mkd(current_path)
+                    print(f"[LOG] Директория {current_path} успешно создана.")
+                except ftplib.error_perm as e:
+                    # Каталог мог создать параллельный загрузчик
+                    try:
+                        ftp.cwd(current_path)
+                    except ftplib.error_perm:
+                        raise Exception(f"Не удалось создать директорию {current_path} на FTP сервере: {e}")
+            with self._dirs_lock:
+                self._known_dirs.add(current_path)
+        FTP_OPERATION_SECONDS.observe(time.monotonic() - started, operation="mkdir")
+
+    # Передача source в STOR блоками по blocksize байт со статистикой скорости
+    @staticmethod
+    def _store(ftp, remote_path, source, blocksize):
+        transferred = 0
+
+        def count(block):
+            nonlocal transferred
+            transferred += len(block)
+
+        started = time.monotonic()
+        ftp.storbinary(f'STOR {remote_path}', source, blocksize, callback=count)
+        seconds = time.monotonic() - started
+        FTP_OPERATION_SECONDS.observe(seconds, operation="stor")
+        FTP_UPLOADED_BYTES.inc(transferred)
+        return {
+            "bytes": transferred,
+            "seconds": seconds,
+            "bytes_per_second": transferred / seconds if seconds > 0 else 0.0,
+        }
+
+    # Потоковая загрузка на FTP по полному пути remote_path.
+    # open_source - функция, возвращающая контекстный менеджер с файловым объектом
+    # (например, ответ ComfyUI /view): данные идут из источника прямо в STOR блоками,
+    # без буферизации всего файла. При обрыве соединения сессия пересоздаётся,
+    # источник открывается заново и загрузка повторяется, при 550 (каталог удалён
+    # на сервере) кэш каталога сбрасывается. Возвращает статистику передачи
+    def upload_stream(self, remote_path, open_source, blocksize=settings.FTP_BLOCKSIZE):
+        base_path, filename = remote_path.rsplit('/', 1)
+        attempt = 0
+        while True:
+            try:
+                with self.session() as ftp:
+                    self.ensure_directory(ftp, base_path)
+                    with open_source() as source:
+                        stats = self._store(ftp, remote_path, source, blocksize)
+                print(f"[LOG] Изображение {filename} успешно загружено на FTP в {remote_path}: "
+                      f"{stats['bytes']} байт за {stats['seconds']:.2f} с "
+                      f"({stats['bytes_per_second'] / 1024:.1f} КБ/с).")
+                return stats
+            except ftplib.error_perm as e:
+                if attempt >= self.retries or not str(e).startswith("550"):
+                    raise
+                self.forget_directory(base_path)
+                RETRIES_TOTAL.inc(target="ftp")
+            except CONNECTION_ERRORS as e:
+                if attempt >= self.retries:
+                    raise
+                print(f"[ERROR] Ошибка FTP соединения ({e}), повтор {attempt + 1} из {self.retries}...")
+                RETRIES_TOTAL.inc(target="ftp")
+            attempt += 1
+
+    def upload_bytes(self, remote_path, data, blocksize=settings.FTP_BLOCKSIZE):
+        return self.upload_stream(remote_path, lambda: io.BytesIO(data), blocksize)
+
+    def upload_file(self, remote_path, local_path, blocksize=settings.FTP_BLOCKSIZE):
+        return self.upload_stream(remote_path, lambda: open(local_path, 'rb'), blocksize)
+
+    # Переименование файла на FTP (RNFR/RNTO), каталог old_path и new_path должен существовать
+    def rename(self, old_path, new_path):
+        started = time.monotonic()
+        with self.session() as ftp:
+            ftp.rename(old_path, new_path)
+        FTP_OPERATION_SECONDS.observe(time.monotonic() - started, operation="rename")
+
+    # Проверка наличия файла на FTP (команда SIZE)
+    def exists(self, remote_path):
+        with self.session() as ftp:
+            try:
+                ftp.voidcmd("TYPE I")
+                return ftp.size(remote_path) is not None
+            except ftplib.error_perm:
+                return False
+
+_default_pool = None
+
+# Общий пул процесса для сервера из settings
+def get_ftp_pool():
+    global _default_pool
+    if _default_pool is None:
+        _default_pool = FtpPool()
+    return _default_pool
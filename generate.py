@@ -1,254 +1,412 @@
-import json
 import time
-import psycopg2
-from urllib import request
-import urllib.error
-from datetime import datetime
-import io
-import re
-import random  # Подключаем модуль для работы со случайными числами
-from ftplib import FTP
-
-# Подключение к базе данных PostgreSQL
-def connect_to_db():
-    try:
-        conn = psycopg2.connect(
-            user='',
-            host='',
-            database='',
-            password='',
-            port=5432
-        )
-        print("[LOG] Подключение к базе данных установлено.")
-        return conn
-    except Exception as e:
-        print(f"[ERROR] Ошибка подключения к базе данных: {e}")
-        return None
-
-# Функция для выбора строки с Image_url=NULL
-def get_news_without_image(conn):
-    try:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT id, title, date_time FROM original_news WHERE image_url IS NULL LIMIT 1;")
-            row = cursor.fetchone()
-            if row:
-                return {"id": row[0], "title": row[1], "date_time": row[2]}
-            else:
-                print("[LOG] Нет записей с пустым image_url.")
-                return None
-    except Exception as e:
-        print(f"[ERROR] Ошибка при выборке из базы данных: {e}")
-        return None
-
-# Функция для обновления image_url
-def update_image_url(conn, news_id, image_url):
-    try:
-        with conn.cursor() as cursor:
-            cursor.execute("UPDATE original_news SET image_url = %s WHERE id = %s;", (image_url, news_id))
-            conn.commit()
-            print(f"[LOG] image_url обновлен для записи с ID: {news_id}.")
-    except Exception as e:
-        print(f"[ERROR] Ошибка при обновлении image_url: {e}")
-
-# Функция для обновления error_message
-def update_error_message(conn, news_id, error_message):
-    try:
-        with conn.cursor() as cursor:
-            cursor.execute("UPDATE original_news SET error_message = %s WHERE id = %s;", (error_message, news_id))
-            conn.commit()
-            print(f"[LOG] error_message обновлен для записи с ID: {news_id}.")
-    except Exception as e:
-        print(f"[ERROR] Ошибка при обновлении error_message: {e}")
-
-# Функция отправки промпта
-def queue_prompt(prompt_workflow):
-    print("[LOG] Отправка запроса на генерацию...")
-    p = {"prompt": prompt_workflow}
-    data = json.dumps(p).encode('utf-8')
-    headers = {'Content-Type': 'application/json'}
-    req = request.Request("http://localhost:8888/prompt", data=data, headers=headers)
-    try:
-        response = request.urlopen(req)
-        print("[LOG] Запрос на генерацию отправлен успешно.")
-        return json.loads(response.read().decode())
-    except urllib.error.HTTPError as e:
-        print("[ERROR] Ошибка при отправке запроса на генерацию.")
-        print("Код ошибки: ", e.code)
-        print("Сообщение: ", e.read().decode())
-        return None
-
-# Функция для проверки статуса генерации
-def get_generation_status(prompt_id):
-    print(f"[LOG] Проверка статуса генерации для ID: {prompt_id}")
-    try:
-        url = f"http://localhost:8888/history/{prompt_id}"
-        response = request.urlopen(url)
-        print("[LOG] Статус генерации получен успешно.")
-        return json.loads(response.read().decode())
-    except urllib.error.HTTPError as e:
-        print("[ERROR] Ошибка при получении статуса.")
-        print("Код ошибки: ", e.code)
-        print("Сообщение: ", e.read().decode())
-        return None
-
-# Функция для создания безопасного имени файла
-def create_safe_filename(title):
-    title = re.sub(r'[^\w\s]', '', title)  # Убираем все спецсимволы
-    return title.replace(' ', '_')  # Заменяем пробелы на _
-
-# Функция для создания пути на FTP с проверкой и созданием вложенных директорий
-def create_directory_if_not_exists(ftp, path):
-    # Разбиваем путь на отдельные директории
-    directories = path.split('/')
-    current_path = ""
-    for directory in directories:
-        if directory:  # Пропускаем пустые части
-            current_path += f"/{directory}"
+import argparse
+from collections import deque
+from concurrent import futures
+
+import settings
+from comfy_events import PollBackoff
+from comfy_pool import start_backend_pool
+from ftp_pool import get_ftp_pool
+from workflow import load_template
+from db import connect_to_db, claim_news_batch, extend_claims, reclaim_news, ResultWriter, COUNTED_FAILURES
+from jobs import (queue_news, resolve_prompt, split_outputs, upload_originals, store_variants, take_cached,
+                  resume_jobs, news_profile, upload_failure_cause)
+from journal import JOURNAL
+from result_cache import RenderingKeys
+from metrics import TRACER, PENDING_NEWS, IN_FLIGHT_PROMPTS, start_metrics_server
+from pipeline import run_pipeline
+from warmup import warm_up, keep_hot
+from variants import start_variant_pool, get_variant_pool
+
+# Однократный запуск: одна новость на один запуск скрипта
+def run_once():
+    template = load_template()
+    conn = connect_to_db()
+    if conn:
+        batch = claim_news_batch(conn, settings.WORKER_ID, 1, settings.CLAIM_LEASE_SECONDS, settings.CLAIM_MAX_ATTEMPTS)
+        if batch:
+            pool = start_backend_pool()
+            variant_pool = start_variant_pool()
+            scheduler = InFlightScheduler(conn, template, settings.WORKER_ID, 1, pool)
+            scheduler.resume()
+            scheduler.add(batch)
+            scheduler.submit_pending()
+            while not scheduler.is_idle():
+                # Промпт исключённого сервера возвращается в pending и отправляется заново
+                scheduler.submit_pending()
+                scheduler.wait()
+                scheduler.poll()
+            scheduler.writer.close(conn)
+            JOURNAL.close()
+            pool.stop()
+            if variant_pool:
+                variant_pool.close()
+            get_ftp_pool().close()
+        else:
+            print("[LOG] Нет записей для обработки.")
+        conn.close()
+    else:
+        print("[ERROR] Подключение к базе данных не удалось.")
+
+# Конвейер задач воркера: на сервере ComfyUI всегда стоит до max_in_flight промптов,
+# поэтому пока мы скачиваем и загружаем на FTP готовое изображение, GPU уже считает следующее.
+# pending - захваченные, но ещё не отправленные новости, in_flight - prompt_id -> задача.
+# В один промпт упаковывается до news_per_prompt новостей (отдельные ветки графа).
+# Промпты распределяются между серверами пула (pool, см. comfy_pool.py).
+# О завершении промпта узнаём из событий WebSocket (pool.listener), а если он недоступен -
+# опросом /history с адаптивным интервалом (PollBackoff).
+# Результаты (image_url и ошибки) копятся в writer и записываются в БД пачками.
+# Новости с тем же ключом кэша, что у генерируемой, ждут её результата в rendering.
+# Производные изображения кодируются в пуле процессов, пока воркер ждёт следующие промпты (encoding).
+# Переходы задач записываются в журнал (journal.py), по нему задачи продолжаются после перезапуска (resume)
+class InFlightScheduler:
+    def __init__(self, conn, template, worker_id, max_in_flight, pool,
+                 news_per_prompt=settings.NEWS_PER_PROMPT, writer=None):
+        self.conn = conn
+        self.template = template
+        self.worker_id = worker_id
+        self.max_in_flight = max_in_flight
+        self.news_per_prompt = news_per_prompt
+        self.pool = pool
+        self.listener = pool.listener
+        self.pending = deque()
+        self.in_flight = {}
+        self.rendering = RenderingKeys()
+        # Кодирование производных: Future -> (новость, пути для image_url)
+        self.encoding = {}
+        self.last_lease_extend = time.monotonic()
+        self.writer = writer or ResultWriter(worker_id)
+        self.processed = 0
+        PENDING_NEWS.set_function(lambda: len(self.pending))
+        IN_FLIGHT_PROMPTS.set_function(lambda: len(self.in_flight))
+
+    def is_idle(self):
+        return not self.pending and not self.in_flight and not self.encoding
+
+    # Сколько новостей стоит захватить, чтобы заполнить конвейер
+    def free_slots(self):
+        in_flight_news = sum(len(job["news"]) for job in self.in_flight.values())
+        return max(0, self.max_in_flight * self.news_per_prompt - in_flight_news - len(self.pending))
+
+    def add(self, batch):
+        JOURNAL.claimed(self.worker_id, batch)
+        self.pending.extend(batch)
+
+    # Продолжение задач из журнала: новости снова захватываются в БД и продолжаются
+    # с последнего записанного состояния (см. jobs.resume_jobs)
+    def resume(self):
+        entries = JOURNAL.unfinished()
+        if not entries:
+            return
+        owned = reclaim_news(self.conn, self.worker_id, [entry["news"]["id"] for entry in entries],
+                             {entry["worker_id"] for entry in entries}, settings.CLAIM_LEASE_SECONDS)
+        if owned is None:
+            return
+        resumed = resume_jobs(entries, owned, self.pool, self.worker_id)
+        for news, image_url in resumed["uploaded"]:
+            self.writer.add_image(news['id'], image_url, news.get('variants'))
+            self.processed += 1
+        for news, images, backend in resumed["rendered"]:
+            self.upload(news, images, backend)
+        for prompt_id, backend, news_list, branches in resumed["submitted"]:
+            # События промпта приходят client_id прежнего процесса: ждём его опросом /history
+            self.in_flight[prompt_id] = {"news": news_list, "backend": backend, "branches": branches,
+                                         "submitted_at": time.monotonic(), "poll": PollBackoff(),
+                                         "timeout": self.pool.generation_timeout(backend), "resumed": True}
+        self.pending.extend(resumed["claimed"])
+
+    def events_available(self):
+        return self.listener is not None and self.listener.connected
+
+    # cause - короткая причина для метрик (submit, rejected, timeout, generation, no_images,
+    # upload, upload_rejected).
+    # Попытка расходуется только при причинах из db.COUNTED_FAILURES
+    def fail(self, news, error_message, cause):
+        print(f"[ERROR] {error_message}")
+        TRACER.fail([news['id']], cause)
+        self.writer.add_error(news['id'], error_message, cause in COUNTED_FAILURES)
+        self.processed += 1
+        self.release_waiting(news)
+
+    # Новости, ждавшие результата news, снова проверяют кэш (в начале очереди)
+    def release_waiting(self, news):
+        self.pending.extendleft(reversed(self.rendering.finish(news)))
+
+    def fail_all(self, news_list, error_message, cause):
+        for news in news_list:
+            self.fail(news, error_message, cause)
+
+    # Дозаполнение сервера ComfyUI промптами из pending
+    def submit_pending(self):
+        while self.pending and len(self.in_flight) < self.max_in_flight:
+            # В один промпт попадают только новости с одним профилем (свежие и устаревшие - отдельно)
+            news_list = [self.pending.popleft()]
+            while (self.pending and len(news_list) < self.news_per_prompt
+                   and news_profile(self.pending[0]) == news_profile(news_list[0])):
+                news_list.append(self.pending.popleft())
+            # Новости, изображение для которых уже есть в кэше, не занимают GPU
+            news_list, hits = take_cached(self.template, news_list, self.rendering)
+            for news, image_url in hits:
+                self.writer.add_image(news['id'], image_url, news.get('variants'))
+                self.processed += 1
+            if not news_list:
+                continue
+            for news in news_list:
+                print(f"[LOG] Попытка {news['attempts']} из {settings.CLAIM_MAX_ATTEMPTS} для записи с ID: {news['id']}")
+            # Текст ошибки от queue_news - промпт отклонён, исключение - серверы недоступны
+            cause = "rejected"
             try:
-                ftp.cwd(current_path)
-                print(f"[LOG] Директория {current_path} уже существует на FTP.")
+                prompt_id, backend, branches, error_message = queue_news(self.template, news_list, self.pool)
             except Exception as e:
-                print(f"[LOG] Директория {current_path} не существует. Пытаюсь создать...")
-                try:
-                    ftp.mkd(current_path)
-                    print(f"[LOG] Директория {current_path} успешно создана.")
-                except Exception as e:
-                    print(f"[ERROR] Ошибка при создании директории {current_path}: {e}")
-                    return False  # Возвращаем False в случае ошибки
-    return True
-
-# Функция загрузки изображения на FTP
-def upload_image_to_ftp(ftp_host, ftp_user, ftp_password, image_url, remote_path):
-    print("[LOG] Подключение к FTP серверу...")
-    try:
-        # Подключение к FTP
-        ftp = FTP(ftp_host)
-        ftp.login(user=ftp_user, passwd=ftp_password)
-
-        # Проверка и создание основной директории и поддиректорий, если их нет
-        base_path, filename = remote_path.rsplit('/', 1)
-        if not create_directory_if_not_exists(ftp, base_path):
-            raise Exception(f"Не удалось создать директорию {base_path} на FTP сервере")
-
-        # Скачивание изображения напрямую в поток и загрузка на FTP
-        response = request.urlopen(image_url)
-        image_data = response.read()
-        with io.BytesIO(image_data) as f:
-            ftp.storbinary(f'STOR {remote_path}', f)
-        print(f"[LOG] Изображение {filename} успешно загружено на FTP в {remote_path}.")
-
-        ftp.quit()
-    except Exception as e:
-        print(f"[ERROR] Ошибка при загрузке изображения на FTP: {e}")
-        raise e  # Пробрасываем исключение выше для обработки
+                prompt_id, backend, branches, error_message = None, None, None, f"Общая ошибка в процессе выполнения: {e}"
+                cause = "submit"
+            if error_message:
+                self.fail_all(news_list, error_message, cause)
+                continue
+            poll = PollBackoff()
+            if self.events_available():
+                # При работающем WebSocket /history нужен только как страховка
+                poll.defer(time.monotonic(), settings.SAFETY_POLL_INTERVAL)
+            self.in_flight[prompt_id] = {"news": news_list, "backend": backend, "branches": branches,
+                                         "submitted_at": time.monotonic(), "poll": poll,
+                                         "timeout": self.pool.generation_timeout(backend)}
 
-# Основной процесс
-conn = connect_to_db()
-if conn:
-    news = get_news_without_image(conn)
-    if news:
-        print(f"[LOG] Обработка записи с ID: {news['id']}, заголовок: {news['title']}")
-
-        # Список стилей
-        styles = [
-            "Style Realism.", "Style Surrealism.", "Style Abstract.", "Style Pop Art.", "Style Manga.",
-            "Style Fantasy.", "Style Sci-Fi.", "Style Pixel Art.", "Style Minimalism.", "Style Cyberpunk.",
-            "Style Steampunk.", "Style Cartoon.", "Style Watercolor.", "Style Concept Art."
-        ]
-
-        # Случайный выбор стиля
-        chosen_style = random.choice(styles)
-        print(f"[LOG] Выбран стиль: {chosen_style}")
-
-        # Обновление prompt_workflow["6"]["inputs"]["text"] с добавлением стиля перед заголовком
-        prompt_workflow = json.load(open('/home/xabre/generate_img/workflow_api.json'))
-        prompt_workflow["6"]["inputs"]["text"] = f"{chosen_style} {news['title']}"
-        print(f"[LOG] В prompt_workflow добавлен текст: {prompt_workflow['6']['inputs']['text']}")
-
-        # Создание имени файла и директории
-        date_time = news['date_time']
-        # Используем формат год/месяц
-        date_folder = f"{date_time.year}/{date_time.month:02d}"
-        safe_title = create_safe_filename(news['title'])
-        filename = f"{safe_title}.jpg"
+    # Промпт недоступного сервера снимается, его новости снова ждут отправки (в начале очереди)
+    def reschedule(self, prompt_id, job):
+        del self.in_flight[prompt_id]
+        news_ids = [news['id'] for news in job["news"]]
+        TRACER.mark(news_ids, "wait")
+        self.pool.reschedule(job["backend"], news_ids)
+        self.pending.extendleft(reversed(job["news"]))
 
-        try:
-            # Шаг 1: Отправка запроса на генерацию
-            result = queue_prompt(prompt_workflow)
-            if result:
-                prompt_id = result.get('prompt_id')
-                if prompt_id:
-                    print(f"[LOG] Промпт отправлен, ID: {prompt_id}")
-
-                    # Шаг 2: Проверка статуса генерации каждые 10 секунд до 5 минут
-                    max_wait_time = 300  # Максимальное время ожидания в секундах (5 минут)
-                    interval = 5  # Интервал времени между запросами статуса в секундах
-                    total_wait_time = 0
-                    generation_success = False  # Флаг успешного завершения генерации
-
-                    while total_wait_time < max_wait_time:
-                        print(f"[LOG] Ожидание {interval} секунд перед следующей проверкой статуса...")
-                        time.sleep(interval)
-                        total_wait_time += interval
-
-                        # Шаг 3: Проверка статуса генерации
-                        try:
-                            status_data = get_generation_status(prompt_id)
-                            if status_data and prompt_id in status_data:
-                                task_data = status_data[prompt_id]
-                                status_info = task_data.get("status", {})
-                                print(f"[LOG] Текущий статус: {status_info}")
-
-                                # Шаг 4: Проверка успешности генерации
-                                if status_info.get("status_str") == "success" and status_info.get("completed", False):
-                                    outputs = task_data.get("outputs", {})
-                                    if outputs:
-                                        for node_id, output in outputs.items():
-                                            images = output.get("images", [])
-                                            if images:
-                                                for image_info in images:
-                                                    image_filename = image_info.get("filename", "")
-                                                    subfolder = image_info.get("subfolder", "")
-                                                    # Шаг 5: Загрузка изображения на FTP
-                                                    image_url = f"http://localhost:8888/view?filename={image_filename}&type=output&subfolder={subfolder}"
-                                                    print(f"[LOG] URL для загрузки изображения: {image_url}")
-                                                    
-                                                    # Определение пути для загрузки на FTP
-                                                    remote_path = f"/ftp/images/{date_folder}/{filename}"
-                                                    try:
-                                                        upload_image_to_ftp('localhost', 'user', 'password', image_url, remote_path)
-                                                        # Запись пути в image_url в БД
-                                                        image_save_path = f"/images/{date_folder}/{filename}"
-                                                        update_image_url(conn, news['id'], image_save_path)
-                                                        print(f"[LOG] Путь к изображению записан в БД: {image_save_path}")
-                                                        generation_success = True  # Устанавливаем флаг успешного завершения
-                                                        break
-                                                    except Exception as e:
-                                                        error_message = f"Ошибка при загрузке изображения: {e}"
-                                                        print(f"[ERROR] {error_message}")
-                                                        break
-                        except Exception as e:
-                            print(f"[ERROR] Ошибка при проверке статуса: {e}")
-
-                        if generation_success:
-                            break
-
-                    # Если после всех попыток генерация не была успешной
-                    if not generation_success:
-                        print("[ERROR] Время ожидания истекло, задача не завершена успешно.")
-                        update_error_message(conn, news['id'], "Время ожидания истекло, задача не завершена успешно.")
-                else:
-                    print("[ERROR] ID задачи не получен.")
-                    update_error_message(conn, news['id'], "ID задачи не получен.")
+    # Ожидание до ближайшего события: WebSocket уведомления или времени очередного опроса
+    def wait(self):
+        if not self.in_flight:
+            if self.encoding:
+                futures.wait(list(self.encoding), self.writer.time_to_flush(), futures.FIRST_COMPLETED)
+            return
+        now = time.monotonic()
+        timeout = max(0, min(job["poll"].next_poll for job in self.in_flight.values()) - now)
+        # Не ждём дольше, чем результаты могут лежать в буфере
+        flush_in = self.writer.time_to_flush()
+        if flush_in is not None:
+            timeout = min(timeout, flush_in)
+        # Готовые производные забираются не позже чем через POLL_MIN_INTERVAL
+        if self.encoding:
+            timeout = min(timeout, settings.POLL_MIN_INTERVAL)
+        if self.events_available():
+            self.listener.wait(list(self.in_flight), timeout)
+        else:
+            time.sleep(timeout)
+
+    # Проверка промптов в работе, готовые передаются на загрузку.
+    # Возвращает число завершённых задач
+    def poll(self):
+        self.collect_variants()
+        finished = 0
+        events = self.listener.pop_finished(list(self.in_flight)) if self.listener else {}
+        for prompt_id, job in list(self.in_flight.items()):
+            news_list = job["news"]
+            backend = job["backend"]
+            poll = job["poll"]
+            now = time.monotonic()
+            event = events.get(prompt_id)
+            if event is None and self.pool.should_reschedule(backend):
+                self.reschedule(prompt_id, job)
+                continue
+            if not self.events_available():
+                poll.clamp(now)
+            if event is None and not poll.due(now):
+                state = "pending"
             else:
-                print("[ERROR] Ошибка при отправке запроса.")
-                update_error_message(conn, news['id'], "Ошибка при отправке запроса.")
+                state, task_data = resolve_prompt(prompt_id, event, backend)
+
+            if state == "pending":
+                if now - job["submitted_at"] > job["timeout"]:
+                    del self.in_flight[prompt_id]
+                    self.pool.release(backend)
+                    TRACER.mark([news['id'] for news in news_list], "wait")
+                    self.fail_all(news_list, "Время ожидания истекло, задача не завершена успешно.", "timeout")
+                    finished += 1
+                elif event is not None:
+                    # Промпт завершён, но /history ещё не записан - опрашиваем часто
+                    poll.reset(now)
+                elif poll.due(now):
+                    if self.events_available() and not job.get("resumed"):
+                        poll.defer(now, settings.SAFETY_POLL_INTERVAL)
+                    else:
+                        poll.backoff(now)
+                continue
+
+            del self.in_flight[prompt_id]
+            self.pool.release(backend, state == "success")
+            TRACER.mark([news['id'] for news in news_list], "wait")
+            finished += 1
+            if state == "error":
+                self.fail_all(news_list, "Генерация завершилась с ошибкой.", "generation")
+                continue
+            # Пока загружаем эти изображения, остальные промпты продолжают считаться на GPU
+            per_news = split_outputs(task_data, job["branches"], len(news_list))
+            for news, images in zip(news_list, per_news):
+                if not images:
+                    self.fail(news, "Генерация завершилась без изображений.", "no_images")
+                    continue
+                JOURNAL.rendered(news, images)
+                self.upload(news, images, backend)
+            # Освободившийся слот сразу занимаем следующим промптом
+            self.submit_pending()
+        return finished
+
+    # Загрузка изображений новости на FTP с сервера backend, результат - в буфер записи.
+    # Производные кодируются в пуле процессов без ожидания, результат забирает collect_variants
+    def upload(self, news, images, backend):
+        try:
+            saved_paths, source = upload_originals(news, images, backend)
         except Exception as e:
-            error_message = f"Общая ошибка в процессе выполнения: {e}"
-            update_error_message(conn, news['id'], error_message)
-            print(f"[ERROR] {error_message}")
+            self.fail(news, f"Ошибка при загрузке изображения: {e}", upload_failure_cause(e))
+            return
+        variant_pool = get_variant_pool()
+        if source is not None and variant_pool is not None:
+            try:
+                self.encoding[variant_pool.submit(source)] = (news, saved_paths)
+                return
+            except Exception as e:
+                print(f"[ERROR] Ошибка при создании производных изображений для ID {news['id']}: {e}")
+        self.uploaded(news, saved_paths)
+
+    # Производные, закодированные в пуле процессов, загружаются на FTP, новость - в буфер записи.
+    # wait - дождаться всех (остановка воркера)
+    def collect_variants(self, wait=False):
+        if wait and self.encoding:
+            futures.wait(list(self.encoding))
+        for future in [future for future in self.encoding if future.done()]:
+            news, saved_paths = self.encoding.pop(future)
+            news['variants'] = store_variants(news, future.result, saved_paths[0])
+            self.uploaded(news, saved_paths)
+
+    def uploaded(self, news, saved_paths):
+        JOURNAL.uploaded(news, saved_paths[0])
+        self.writer.add_image(news['id'], saved_paths[0], news.get('variants'))
+        print(f"[LOG] Изображение загружено: {saved_paths[0]}, всего изображений: {len(saved_paths)}")
+        self.processed += 1
+        self.release_waiting(news)
+
+    # Запись накопленных результатов, если буфер заполнен или ждёт слишком долго
+    def flush_results(self, force=False):
+        if force or self.writer.should_flush():
+            self.writer.flush(self.conn)
+
+    # Периодическое продление аренды всех захваченных, но не завершённых строк
+    def extend_leases(self):
+        if time.monotonic() - self.last_lease_extend < settings.CLAIM_LEASE_SECONDS / 3:
+            return
+        news_ids = [n['id'] for n in self.pending]
+        news_ids += [news['id'] for job in self.in_flight.values() for news in job["news"]]
+        news_ids += [news['id'] for news in self.rendering.waiting()]
+        news_ids += [news['id'] for news, _ in self.encoding.values()]
+        extend_claims(self.conn, self.worker_id, news_ids, settings.CLAIM_LEASE_SECONDS)
+        self.last_lease_extend = time.monotonic()
+
+# Режим воркера: одно соединение с БД и один разобранный workflow на всё время работы.
+# Новости захватываются пачками (см. db.claim_news_batch) и прогоняются через
+# конвейер InFlightScheduler, пока очередь не опустеет, затем воркер ждёт
+# с нарастающей паузой (idle_sleep, 2*idle_sleep, ... до idle_max_sleep)
+def run_worker(batch_size, idle_sleep, idle_max_sleep, max_in_flight):
+    template = load_template()
+    worker_id = settings.WORKER_ID
+    pool = start_backend_pool()
+    metrics_server = start_metrics_server()
+    variant_pool = start_variant_pool()
+    conn = None
+    scheduler = None
+    # Буфер результатов переживает переподключение к БД: незаписанные строки запишутся через новое соединение
+    writer = ResultWriter(worker_id)
+    sleep_time = idle_sleep
+    print(f"[LOG] Воркер {worker_id} запущен, промптов в работе: до {max_in_flight}.")
+    try:
+        # Модели загружаются до захвата новостей: первый промпт не упрётся в таймаут
+        if settings.WARMUP:
+            warm_up(pool, template)
+        while True:
+            # Переподключение, если соединения ещё нет или оно было потеряно
+            if conn is None or conn.closed:
+                conn = connect_to_db()
+                if conn is None:
+                    print(f"[LOG] Повторная попытка подключения через {sleep_time} секунд...")
+                    time.sleep(sleep_time)
+                    sleep_time = min(sleep_time * 2, idle_max_sleep)
+                    continue
+                if scheduler is None:
+                    scheduler = InFlightScheduler(conn, template, worker_id, max_in_flight, pool, writer=writer)
+                    # Задачи прежнего процесса продолжаются по журналу
+                    scheduler.resume()
+                else:
+                    # Промпты в работе и ожидающие отправки новости сохраняются, меняется только соединение
+                    scheduler.conn = conn
+
+            # Пока все серверы пула исключены, новости не захватываются: они только вернулись бы с ошибкой
+            if scheduler.free_slots() and pool.healthy_count():
+                batch = claim_news_batch(conn, worker_id, max(batch_size, scheduler.free_slots()),
+                                         settings.CLAIM_LEASE_SECONDS, settings.CLAIM_MAX_ATTEMPTS)
+                if batch:
+                    print(f"[LOG] Захвачено записей для обработки: {len(batch)}")
+                    scheduler.add(batch)
+
+            if scheduler.is_idle():
+                scheduler.flush_results(force=True)
+                print(f"[LOG] Очередь пуста, обработано за сессию: {scheduler.processed}. Ожидание {sleep_time} секунд...")
+                get_ftp_pool().send_keepalive()
+                keep_hot(pool, template)
+                time.sleep(sleep_time)
+                sleep_time = min(sleep_time * 2, idle_max_sleep)
+                continue
+
+            sleep_time = idle_sleep
+            scheduler.submit_pending()
+            scheduler.extend_leases()
+            scheduler.wait()
+            scheduler.poll()
+            scheduler.flush_results()
+    except KeyboardInterrupt:
+        processed = scheduler.processed if scheduler else 0
+        print(f"[LOG] Остановка воркера, обработано за сессию: {processed}.")
+    finally:
+        if scheduler is not None:
+            # Изображения уже на FTP: ждём их производные, чтобы записать результат в БД
+            scheduler.collect_variants(wait=True)
+        writer.close(conn)
+        JOURNAL.close()
+        if metrics_server:
+            metrics_server.shutdown()
+        pool.stop()
+        if variant_pool:
+            variant_pool.close()
+        get_ftp_pool().close()
+        if conn is not None and not conn.closed:
+            conn.close()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Генерация изображений для новостей без картинки")
+    parser.add_argument("--worker", action="store_true",
+                        help="работать постоянно, забирая новости пачками")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="работать постоянно через асинхронный конвейер (pipeline.py)")
+    parser.add_argument("--batch-size", type=int, default=settings.WORKER_BATCH_SIZE,
+                        help="сколько новостей забирать из БД за один запрос")
+    parser.add_argument("--idle-sleep", type=float, default=settings.WORKER_IDLE_SLEEP,
+                        help="начальная пауза при пустой очереди, секунды")
+    parser.add_argument("--idle-max-sleep", type=float, default=settings.WORKER_IDLE_MAX_SLEEP,
+                        help="максимальная пауза при пустой очереди, секунды")
+    parser.add_argument("--max-in-flight", type=int, default=settings.MAX_IN_FLIGHT,
+                        help="сколько промптов одновременно держать в очереди ComfyUI")
+    return parser.parse_args()
+
+# Основной процесс
+if __name__ == "__main__":
+    args = parse_args()
+    if args.pipeline:
+        run_pipeline(args.batch_size, args.idle_sleep, args.idle_max_sleep, args.max_in_flight)
+    elif args.worker:
+        run_worker(args.batch_size, args.idle_sleep, args.idle_max_sleep, args.max_in_flight)
     else:
-        print("[LOG] Нет записей для обработки.")
-    conn.close()
-else:
-    print("[ERROR] Подключение к базе данных не удалось.")
+        run_once()
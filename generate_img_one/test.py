@@ -1,63 +1,33 @@
-import json
+import os
+import sys
 import time
-from urllib import request
-import urllib.error
 
-# Функция отправки промпта
-def queue_prompt(prompt_workflow):
-    print("[LOG] Отправка запроса на генерацию...")
-    p = {"prompt": prompt_workflow}
-    data = json.dumps(p).encode('utf-8')
-    headers = {'Content-Type': 'application/json'}
-    req = request.Request("http://localhost:8888/prompt", data=data, headers=headers)
-    try:
-        response = request.urlopen(req)
-        print("[LOG] Запрос на генерацию отправлен успешно.")
-        return json.loads(response.read().decode())
-    except urllib.error.HTTPError as e:
-        print("[ERROR] Ошибка при отправке запроса на генерацию.")
-        print("Код ошибки: ", e.code)
-        print("Сообщение: ", e.read().decode())
-        return None
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-# Функция для проверки статуса генерации
-def get_generation_status(prompt_id):
-    print(f"[LOG] Проверка статуса генерации для ID: {prompt_id}")
-    try:
-        url = f"http://localhost:8888/history/{prompt_id}"
-        response = request.urlopen(url)
-        print("[LOG] Статус генерации получен успешно.")
-        return json.loads(response.read().decode())
-    except urllib.error.HTTPError as e:
-        print("[ERROR] Ошибка при получении статуса.")
-        print("Код ошибки: ", e.code)
-        print("Сообщение: ", e.read().decode())
-        return None
+from workflow import WorkflowTemplate
+from comfy_client import ComfyHTTPError, get_client, queue_prompt, get_generation_status
 
 # Функция для загрузки изображения
-def download_image(image_url, filename):
-    print(f"[LOG] Скачивание изображения с URL: {image_url}")
+def download_image(image_filename, subfolder, filename):
+    print(f"[LOG] Скачивание изображения: {image_filename}")
     try:
-        response = request.urlopen(image_url)
+        image_data = get_client().get_image(image_filename, subfolder)
         with open(filename, 'wb') as f:
-            f.write(response.read())
+            f.write(image_data)
         print(f"[LOG] Изображение сохранено как {filename}")
-    except urllib.error.HTTPError as e:
+    except ComfyHTTPError as e:
         print("[ERROR] Ошибка при скачивании изображения.")
         print("Код ошибки: ", e.code)
-        print("Сообщение: ", e.read().decode())
+        print("Сообщение: ", e.message)
     except Exception as ex:
         print(f"[ERROR] Произошла ошибка: {ex}")
 
-# Чтение workflow
-print("[LOG] Чтение файла workflow_api.json...")
-prompt_workflow = json.load(open('workflow_api.json'))
+# Чтение и проверка workflow, узлы находятся по типу, а не по ID
+template = WorkflowTemplate.load('workflow_api.json')
 print("[LOG] Файл workflow_api.json успешно прочитан.")
 
 # Настройки изображения
-prompt_workflow["5"]["inputs"]["width"] = 512
-prompt_workflow["5"]["inputs"]["height"] = 640
-prompt_workflow["5"]["inputs"]["batch_size"] = 1
+prompt_workflow = template.render(width=512, height=640, batch_size=1)
 print("[LOG] Настройки изображения установлены: ширина = 512, высота = 640, batch_size = 1")
 
 # Шаг 1: Отправка запроса на генерацию
@@ -95,10 +65,8 @@ if result:
                                     image_filename = image_info.get("filename", "")
                                     subfolder = image_info.get("subfolder", "")
                                     # Шаг 5: Скачивание изображения
-                                    image_url = f"http://localhost:8888/view?filename={image_filename}&type=output&subfolder={subfolder}"
-                                    print(f"[LOG] URL для загрузки изображения: {image_url}")
                                     filename = f"{image_filename}"
-                                    download_image(image_url, filename)
+                                    download_image(image_filename, subfolder, filename)
                                     exit(0)  # Завершение после успешного сохранения изображения
             else:
                 print(f"[ERROR] Не удалось получить данные для prompt_id {prompt_id}")
@@ -1,41 +1,13 @@
-import json
+import os
+import sys
 import time
-from urllib import request
-import urllib.error
 from ftplib import FTP
 from datetime import datetime
-import io
-
-# Функция отправки промпта
-def queue_prompt(prompt_workflow):
-    print("[LOG] Отправка запроса на генерацию...")
-    p = {"prompt": prompt_workflow}
-    data = json.dumps(p).encode('utf-8')
-    headers = {'Content-Type': 'application/json'}
-    req = request.Request("http://localhost:8888/prompt", data=data, headers=headers)
-    try:
-        response = request.urlopen(req)
-        print("[LOG] Запрос на генерацию отправлен успешно.")
-        return json.loads(response.read().decode())
-    except urllib.error.HTTPError as e:
-        print("[ERROR] Ошибка при отправке запроса на генерацию.")
-        print("Код ошибки: ", e.code)
-        print("Сообщение: ", e.read().decode())
-        return None
-
-# Функция для проверки статуса генерации
-def get_generation_status(prompt_id):
-    print(f"[LOG] Проверка статуса генерации для ID: {prompt_id}")
-    try:
-        url = f"http://localhost:8888/history/{prompt_id}"
-        response = request.urlopen(url)
-        print("[LOG] Статус генерации получен успешно.")
-        return json.loads(response.read().decode())
-    except urllib.error.HTTPError as e:
-        print("[ERROR] Ошибка при получении статуса.")
-        print("Код ошибки: ", e.code)
-        print("Сообщение: ", e.read().decode())
-        return None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from workflow import WorkflowTemplate
+from comfy_client import get_client, queue_prompt, get_generation_status
 
 # Функция для создания пути на FTP
 def create_directory_if_not_exists(ftp, path):
@@ -53,7 +25,7 @@ def create_directory_if_not_exists(ftp, path):
             print(f"[ERROR] Ошибка при создании директории {path}: {e}")
 
 # Функция загрузки изображения напрямую на FTP
-def upload_image_to_ftp(ftp_host, ftp_user, ftp_password, image_url, remote_filename):
+def upload_image_to_ftp(ftp_host, ftp_user, ftp_password, image_filename, subfolder, remote_filename):
     print("[LOG] Подключение к FTP серверу...")
     try:
         # Подключение к FTP
@@ -81,27 +53,21 @@ def upload_image_to_ftp(ftp_host, ftp_user, ftp_password, image_url, remote_file
         remote_path = f"{base_path}/{year_folder}/{month_folder}/{remote_filename}"
 
         # Скачивание изображения напрямую в поток и загрузка на FTP
-        response = request.urlopen(image_url)
-        image_data = response.read()
-        with io.BytesIO(image_data) as f:
-            ftp.storbinary(f'STOR {remote_path}', f)
+        with get_client().open_image(image_filename, subfolder) as f:
+            ftp.storbinary(f'STOR {remote_path}', f, 65536)
         print(f"[LOG] Изображение {remote_filename} успешно загружено на FTP в {remote_path}.")
 
         ftp.quit()
     except Exception as e:
         print(f"[ERROR] Ошибка при загрузке изображения на FTP: {e}")
 
-# Чтение workflow
-print("[LOG] Чтение файла workflow_api.json...")
-prompt_workflow = json.load(open('workflow_api.json'))
+# Чтение и проверка workflow, узлы находятся по типу, а не по ID
+template = WorkflowTemplate.load('workflow_api.json')
 print("[LOG] Файл workflow_api.json успешно прочитан.")
 
 # Настройки изображения
-prompt_workflow["5"]["inputs"]["width"] = 1024
-prompt_workflow["5"]["inputs"]["height"] = 512
-prompt_workflow["5"]["inputs"]["batch_size"] = 1
-prompt_workflow["6"]["inputs"]["text"] = "black and white cat of british breed"
-
+prompt_workflow = template.render(width=1024, height=512, batch_size=1,
+                                  prompt="black and white cat of british breed")
 print("[LOG] Настройки изображения установлены: ширина = 1024, высота = 512, batch_size = 1")
 
 # Шаг 1: Отправка запроса на генерацию
@@ -139,10 +105,8 @@ if result:
                                     image_filename = image_info.get("filename", "")
                                     subfolder = image_info.get("subfolder", "")
                                     # Шаг 5: Загрузка изображения напрямую на FTP
-                                    image_url = f"http://localhost:8888/view?filename={image_filename}&type=output&subfolder={subfolder}"
-                                    print(f"[LOG] URL для загрузки изображения: {image_url}")
                                     remote_filename = f"{image_filename}"
-                                    upload_image_to_ftp('localhost', 'user', 'password', image_url, remote_filename)
+                                    upload_image_to_ftp('localhost', 'user', 'password', image_filename, subfolder, remote_filename)
                                     exit(0)  # Завершение после успешного сохранения изображения и загрузки на FTP
             else:
                 print(f"[ERROR] Не удалось получить данные для prompt_id {prompt_id}")
@@ -0,0 +1,369 @@
+import ftplib
+import hashlib
+import os
+import random  # Подключаем модуль для работы со случайными числами
+import shutil
+import tempfile
+
+import settings
+from comfy_client import ComfyHTTPError
+from ftp_pool import get_ftp_pool
+from journal import JOURNAL
+from metrics import TRACER
+from naming import image_filename, image_extension
+from result_cache import get_result_cache, normalize_title, cache_key
+from variants import get_variant_pool, variant_path
+
+# Этапы обработки новостей, общие для воркера (generate.py) и асинхронного конвейера (pipeline.py):
+# подготовка и отправка промпта, разбор статуса, раскладка изображений и загрузка на FTP.
+# Промпт отправляется на один из серверов пула (comfy_pool.BackendPool), статус и изображения
+# запрашиваются у того же сервера (backend)
+
+# Список стилей
+STYLES = [
+    "Style Realism.", "Style Surrealism.", "Style Abstract.", "Style Pop Art.", "Style Manga.",
+    "Style Fantasy.", "Style Sci-Fi.", "Style Pixel Art.", "Style Minimalism.", "Style Cyberpunk.",
+    "Style Steampunk.", "Style Cartoon.", "Style Watercolor.", "Style Concept Art."
+]
+
+# Профиль workflow для новости (см. WorkflowTemplate), None - параметры из файла.
+# Новость с истёкшим сроком (stale, см. db.CLAIM_SQL) генерируется с более дешёвым STALE_PROFILE
+def news_profile(news):
+    if news.get('profile'):
+        return news['profile']
+    if news.get('stale') and settings.STALE_PROFILE:
+        return settings.STALE_PROFILE
+    return settings.WORKFLOW_PROFILE or None
+
+# Стиль новости: стиль профиля, если он задан. При включённом кэше изображений стиль выбирается
+# по хэшу нормализованного заголовка, а не случайно: иначе повторный заголовок почти никогда не попадёт в кэш
+def choose_style(template, news):
+    if 'style' not in news:
+        profile_style = template.profile_style(news_profile(news))
+        if profile_style:
+            news['style'] = profile_style
+        elif get_result_cache() is not None:
+            digest = hashlib.sha256(normalize_title(news['title']).encode('utf-8')).hexdigest()
+            news['style'] = STYLES[int(digest[:8], 16) % len(STYLES)]
+        else:
+            # Случайный выбор стиля
+            news['style'] = random.choice(STYLES)
+    return news['style']
+
+# Подготовка промпта для пачки новостей: стиль + заголовок каждой новости.
+# Все новости пачки отправляются в ComfyUI одним промптом (см. build_batched_workflow)
+# с профилем первой новости (планировщики собирают пачки из новостей с одним профилем). Возвращает (workflow, {id узла сохранения: индекс новости в пачке})
+def build_prompt(template, news_list):
+    texts = []
+    for news in news_list:
+        chosen_style = choose_style(template, news)
+        text = template.prompt_text(news['title'], chosen_style)
+        print(f"[LOG] Выбран стиль: {chosen_style}, текст промпта для ID {news['id']}: {text}")
+        texts.append(text)
+    return template.render_batch(texts, settings.IMAGES_PER_NEWS, news_profile(news_list[0]))
+
+# Отправка пачки новостей на генерацию одним промптом на наименее загруженный сервер пула.
+# Возвращает (prompt_id, backend, branches, текст ошибки). Текст ошибки - промпт не построен
+# или отклонён сервером (4xx): это повторится при любой попытке. Если ни один сервер пула
+# недоступен, выбрасывается исключение - это сбой ComfyUI, а не новости
+def queue_news(template, news_list, pool):
+    for news in news_list:
+        print(f"[LOG] Обработка записи с ID: {news['id']}, заголовок: {news['title']}")
+    try:
+        prompt_workflow, branches = build_prompt(template, news_list)
+    except Exception as e:
+        return None, None, None, f"Ошибка при построении промпта: {e}"
+    news_ids = [news['id'] for news in news_list]
+    TRACER.mark(news_ids, "queued")
+
+    # Шаг 1: Отправка запроса на генерацию
+    try:
+        backend, result = pool.queue_prompt(prompt_workflow)
+    finally:
+        TRACER.mark(news_ids, "submit")
+    if not result:
+        return None, None, None, "Ошибка при отправке запроса."
+    if not result.get('prompt_id'):
+        return None, None, None, "ID задачи не получен."
+    prompt_id = result['prompt_id']
+    print(f"[LOG] Промпт отправлен на {backend.url}, ID: {prompt_id}, новостей в промпте: {len(news_list)}")
+    JOURNAL.submitted(news_list, prompt_id, backend, branches)
+    return prompt_id, backend, branches, None
+
+# Разбор ответа /history: ("success" | "error" | "pending", данные задачи)
+def parse_prompt_status(status_data, prompt_id):
+    if not status_data or prompt_id not in status_data:
+        return "pending", None
+    task_data = status_data[prompt_id]
+    status_info = task_data.get("status", {})
+    print(f"[LOG] Текущий статус: {status_info}")
+    if status_info.get("status_str") == "success" and status_info.get("completed", False):
+        return "success", task_data
+    if status_info.get("status_str") == "error":
+        return "error", task_data
+    return "pending", task_data
+
+# Итог промпта: из события WebSocket, если в нём есть изображения, иначе из /history.
+# event - результат CompletionListener или None, backend - сервер, выполняющий промпт
+def resolve_prompt(prompt_id, event, backend):
+    if event is not None:
+        if event["state"] == "error":
+            return "error", None
+        if event["outputs"]:
+            return "success", {"outputs": event["outputs"]}
+    try:
+        return parse_prompt_status(backend.client.get_generation_status(prompt_id), prompt_id)
+    except Exception as e:
+        print(f"[ERROR] Ошибка при проверке статуса: {e}")
+        backend.failed(e)
+        return "pending", None
+
+# Раскладка изображений промпта по новостям пачки: узел сохранения -> индекс новости
+def split_outputs(task_data, branches, count):
+    per_news = [[] for _ in range(count)]
+    for node_id, output in task_data.get("outputs", {}).items():
+        index = branches.get(node_id)
+        if index is not None:
+            per_news[index].extend(output.get("images", []))
+    return per_news
+
+# Пути изображений новости: [(путь на FTP, путь для image_url)].
+# Имя файла - slug заголовка и id новости (см. naming.py), изображения после первого
+# (batch_size > 1) получают суффикс _2, _3, ...; extension - формат файлов (см. naming.image_extension)
+def image_paths(news, count, extension="jpg"):
+    date_time = news['date_time']
+    # Используем формат год/месяц
+    date_folder = f"{date_time.year}/{date_time.month:02d}"
+    paths = []
+    for index in range(count):
+        filename = image_filename(news, index, extension)
+        # Определение пути для загрузки на FTP
+        paths.append((f"/ftp/images/{date_folder}/{filename}", f"/images/{date_folder}/{filename}"))
+    return paths
+
+# Скачивание изображения ComfyUI в файл кэша (через временный файл, чтобы в кэше не было обрывков).
+# Имя временного файла уникально: одновременные загрузки с одним ключом не пишут в один файл
+def download_to_cache(client, image_info, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(suffix=".part", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            with client.open_image(image_info.get("filename", ""), image_info.get("subfolder", "")) as source:
+                shutil.copyfileobj(source, f, settings.FTP_BLOCKSIZE)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+# Производные первого изображения новости (см. variants.py) из source - байтов или пути к файлу.
+# Загружаются на FTP рядом с изображением url_path. Возвращает {имя: путь для сайта} или None:
+# без производных новость всё равно получает image_url
+def upload_variants(news, source, url_path):
+    pool = get_variant_pool()
+    if pool is None:
+        return None
+    return store_variants(news, lambda: pool.encode(source), url_path)
+
+# Загрузка производных на FTP рядом с url_path. encode возвращает {имя: байты}
+# (кодирование в пуле или результат уже отправленной задачи, см. VariantPool.submit)
+def store_variants(news, encode, url_path):
+    pool = get_variant_pool()
+    try:
+        paths = {}
+        for name, data in encode().items():
+            path = variant_path(url_path, name, pool.specs[name])
+            get_ftp_pool().upload_bytes(f"/ftp{path}", data)
+            paths[name] = path
+        return paths
+    except Exception as e:
+        print(f"[ERROR] Ошибка при создании производных изображений для ID {news['id']}: {e}")
+        return None
+    finally:
+        TRACER.mark([news['id']], "variants")
+
+# Производные для изображения из кэша: уже загруженные на FTP рядом с url_path
+# или созданные заново из локального файла кэша
+def cached_variants(news, local_path, url_path):
+    pool = get_variant_pool()
+    if pool is None:
+        return None
+    paths = {name: variant_path(url_path, name, spec) for name, spec in pool.specs.items()}
+    if all(get_ftp_pool().exists(f"/ftp{path}") for path in paths.values()):
+        return paths
+    return upload_variants(news, local_path, url_path)
+
+# Причина неудачной загрузки для метрик и учёта попыток (см. db.COUNTED_FAILURES).
+# upload_rejected - ошибка повторится при любой попытке: FTP отказал в записи файла
+# (error_perm, кроме 530 - ошибки входа) или ComfyUI не отдал изображение (4xx).
+# upload - сбой соединения с FTP или ComfyUI
+def upload_failure_cause(error):
+    if isinstance(error, ftplib.error_perm) and not str(error).startswith("530"):
+        return "upload_rejected"
+    if isinstance(error, ComfyHTTPError) and 400 <= error.code < 500:
+        return "upload_rejected"
+    return "upload"
+
+# Загрузка всех изображений новости на FTP. Возвращает пути для image_url, при ошибке - исключение.
+# Если для новости посчитан ключ кэша (см. cached_image), изображения сначала сохраняются
+# в кэш и загружаются на FTP из локального файла. Изображения скачиваются с сервера backend.
+# Пути производных изображений записываются в news['variants']
+def upload_images(news, images, backend):
+    saved_paths, source = upload_originals(news, images, backend)
+    if source is not None:
+        news['variants'] = upload_variants(news, source, saved_paths[0])
+    JOURNAL.uploaded(news, saved_paths[0])
+    return saved_paths
+
+# Загрузка изображений без производных: (пути для image_url, источник для производных или None).
+# Производные создаёт и загружает вызывающий код, затем отмечает загрузку в журнале
+def upload_originals(news, images, backend):
+    try:
+        return _upload_images(news, images, backend.client)
+    finally:
+        TRACER.mark([news['id']], "upload")
+
+# Возвращает (пути для image_url, источник для производных изображений или None)
+def _upload_images(news, images, client):
+    cache = get_result_cache() if news.get('cache_key') else None
+    variants = get_variant_pool() is not None
+    cached_files = []
+    saved_paths = []
+    source = None
+    extension = image_extension(images[0].get("filename", "")) if images else "jpg"
+    paths = image_paths(news, len(images), extension)
+    for index, ((remote_path, url_path), image_info) in enumerate(zip(paths, images)):
+        image_filename = image_info.get("filename", "")
+        subfolder = image_info.get("subfolder", "")
+        # Шаг 5: Загрузка изображения на FTP
+        print(f"[LOG] Передача изображения {image_filename} с ComfyUI на FTP")
+        if cache is not None:
+            local_path = cache.file_path(news['cache_key'], index, extension)
+            download_to_cache(client, image_info, local_path)
+            get_ftp_pool().upload_file(remote_path, local_path)
+            cached_files.append(local_path)
+            if variants and index == 0:
+                source = local_path
+        elif variants and index == 0:
+            # Для производных изображение нужно целиком: скачиваем его в память, а не передаём потоком
+            source = client.get_image(image_filename, subfolder)
+            get_ftp_pool().upload_bytes(remote_path, source)
+        else:
+            # Ответ /view передаётся в STOR потоком, без чтения файла в память
+            get_ftp_pool().upload_stream(
+                remote_path, lambda: client.open_image(image_filename, subfolder))
+        saved_paths.append(url_path)
+    if cache is not None:
+        cache.put(news['cache_key'], cached_files, saved_paths)
+    return saved_paths, source
+
+# Изображение для новости из кэша без обращения к ComfyUI. Возвращает путь для image_url
+# или None (кэш отключён, промах или ошибка). При попадании используется уже загруженный
+# файл на FTP, а если его там нет (или RESULT_CACHE_REUSE_REMOTE=0) - файлы из кэша
+# загружаются заново под именем этой новости. Пути производных изображений записываются в news['variants']
+def cached_image(template, news):
+    cache = get_result_cache()
+    if cache is None:
+        return None
+    fingerprint = f"{template.fingerprint(news_profile(news))}:{settings.IMAGES_PER_NEWS}"
+    news['cache_key'] = cache_key(news['title'], choose_style(template, news), fingerprint)
+    entry = cache.get(news['cache_key'])
+    if entry is None:
+        return None
+    try:
+        remote_paths = entry["remote_paths"]
+        if (settings.RESULT_CACHE_REUSE_REMOTE and remote_paths
+                and get_ftp_pool().exists(f"/ftp{remote_paths[0]}")):
+            print(f"[LOG] Изображение для ID {news['id']} взято из кэша: {remote_paths[0]}")
+            news['variants'] = cached_variants(news, entry["files"][0], remote_paths[0])
+            return remote_paths[0]
+        saved_paths = []
+        paths = image_paths(news, len(entry["files"]), image_extension(entry["files"][0]))
+        for (remote_path, url_path), local_path in zip(paths, entry["files"]):
+            get_ftp_pool().upload_file(remote_path, local_path)
+            saved_paths.append(url_path)
+        cache.set_remote_paths(news['cache_key'], saved_paths)
+        print(f"[LOG] Изображение для ID {news['id']} загружено из кэша: {saved_paths[0]}")
+        news['variants'] = upload_variants(news, entry["files"][0], saved_paths[0])
+        return saved_paths[0]
+    except Exception as e:
+        print(f"[ERROR] Ошибка при использовании кэша изображений: {e}")
+        return None
+
+# Разделение пачки на новости, найденные в кэше, и новости для генерации.
+# Если задан rendering (result_cache.RenderingKeys), новость с тем же ключом, что у уже
+# генерируемой, не возвращается: она ждёт в rendering, пока лидер не завершится.
+# Возвращает (новости для генерации, [(новость, путь для image_url)])
+def take_cached(template, news_list, rendering=None):
+    misses, hits = [], []
+    for news in news_list:
+        image_url = cached_image(template, news)
+        if image_url:
+            TRACER.mark([news['id']], "cache")
+            hits.append((news, image_url))
+        elif rendering is not None and news.get('cache_key') and not rendering.lead_or_wait(news['cache_key'], news):
+            print(f"[LOG] Изображение для ID {news['id']} уже генерируется для такой же новости, ожидание результата")
+        else:
+            misses.append(news)
+    return misses, hits
+
+# Промпт из журнала ещё известен серверу: выполнен (/history) или стоит в очереди (/queue).
+# После перезапуска ComfyUI история и очередь пусты - промпт придётся отправить заново
+def prompt_known(prompt_id, backend):
+    try:
+        history = backend.client.get_generation_status(prompt_id)
+        if history and prompt_id in history:
+            return True
+        queue = backend.client.get_json("/queue")
+    except Exception as e:
+        print(f"[ERROR] Ошибка при проверке промпта {prompt_id} на {backend.url}: {e}")
+        return False
+    return any(item[1] == prompt_id for item in queue.get("queue_running", []) + queue.get("queue_pending", []))
+
+# Продолжение задач из журнала после перезапуска (см. journal.py). owned - id новостей, снова
+# захваченных воркером worker_id (db.reclaim_news): остальные уже обработаны или их забрал другой воркер.
+# Задача продолжается с последнего состояния, если её сервер есть в пуле, иначе новость ждёт отправки.
+# Возвращает {"claimed": [новость], "submitted": [(prompt_id, backend, [новость], branches)],
+#             "rendered": [(новость, изображения, backend)], "uploaded": [(новость, image_url)]}
+def resume_jobs(entries, owned, pool, worker_id):
+    resumed = {"claimed": [], "submitted": [], "rendered": [], "uploaded": []}
+    prompts = {}
+    dropped = []
+    for entry in entries:
+        news = entry["news"]
+        if news['id'] not in owned:
+            dropped.append(news['id'])
+            continue
+        backend = pool.find(entry["backend"]) if entry["backend"] else None
+        if entry["state"] == "uploaded":
+            news['variants'] = entry["variants"]
+            resumed["uploaded"].append((news, entry["image_url"]))
+        elif entry["state"] == "rendered" and backend is not None:
+            resumed["rendered"].append((news, entry["images"], backend))
+        elif entry["state"] == "submitted" and backend is not None and entry["branch_index"] is not None:
+            prompts.setdefault(entry["prompt_id"], (backend, [], entry["branches"]))[1].append(
+                (entry["branch_index"], news))
+        else:
+            resumed["claimed"].append(news)
+    for prompt_id, (backend, indexed, branches) in prompts.items():
+        # Новости в порядке веток промпта; ветки новостей, которые воркер больше не держит, пропускаются
+        indexed.sort(key=lambda item: item[0])
+        news_list = [news for _, news in indexed]
+        positions = {index: position for position, (index, _) in enumerate(indexed)}
+        branches = {node_id: positions[index] for node_id, index in branches.items() if index in positions}
+        if prompt_known(prompt_id, backend):
+            pool.acquire(backend)
+            resumed["submitted"].append((prompt_id, backend, news_list, branches))
+        else:
+            resumed["claimed"].extend(news_list)
+    if dropped:
+        print(f"[LOG] Новости из журнала уже обработаны или захвачены другим воркером: {dropped}")
+        JOURNAL.committed(dropped)
+    JOURNAL.reclaimed(worker_id, list(owned))
+    TRACER.start(list(owned))
+    print(f"[LOG] Продолжение задач из журнала: ждут отправки {len(resumed['claimed'])}, "
+          f"промптов в работе {len(resumed['submitted'])}, ждут загрузки {len(resumed['rendered'])}, "
+          f"ждут записи в БД {len(resumed['uploaded'])}")
+    return resumed
@@ -0,0 +1,161 @@
+import datetime
+import json
+import sqlite3
+import threading
+import time
+
+import settings
+
+# Локальный журнал задач воркера для продолжения работы после падения или перезапуска.
+# Для каждой захваченной новости в SQLite (режим WAL) записывается последнее состояние:
+#   claimed   - захвачена из БД
+#   submitted - промпт отправлен: prompt_id, сервер, ветки графа (одни на все новости промпта)
+#               и номер ветки новости в промпте
+#   rendered  - промпт выполнен: изображения новости на сервере ComfyUI
+#   uploaded  - изображения загружены на FTP: image_url и производные изображения
+# После записи результата в БД (ResultWriter.flush) новость удаляется из журнала.
+# При запуске воркер снова захватывает новости из журнала и продолжает каждую с её состояния
+# (см. jobs.resume_jobs): uploaded сразу записывается в БД, rendered загружается на FTP,
+# submitted ждёт уже отправленный промпт через /history, поэтому работа GPU не повторяется.
+# synchronous=NORMAL в режиме WAL переживает падение процесса; при отключении питания
+# могут потеряться последние переходы - тогда новость просто обработается заново.
+# Файл журнала у каждого воркера свой: база открывается в монопольном режиме
+
+class JobJournal:
+    def __init__(self, path=settings.JOB_JOURNAL):
+        self.path = path
+        self._db = None
+        self._lock = threading.Lock()
+
+    # База открывается при первом обращении. Если журнал не задан или занят другим процессом,
+    # воркер работает без него
+    def _open(self):
+        if self._db is None and self.path:
+            try:
+                db = sqlite3.connect(self.path, check_same_thread=False)
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("PRAGMA synchronous=NORMAL")
+                db.execute("PRAGMA locking_mode=EXCLUSIVE")
+                db.execute("""
+                    CREATE TABLE IF NOT EXISTS jobs (
+                        news_id INTEGER PRIMARY KEY,
+                        state TEXT NOT NULL,
+                        worker_id TEXT NOT NULL,
+                        news TEXT NOT NULL,
+                        prompt_id TEXT,
+                        backend TEXT,
+                        branches TEXT,
+                        branch_index INTEGER,
+                        images TEXT,
+                        image_url TEXT,
+                        variants TEXT,
+                        updated REAL NOT NULL
+                    )
+                """)
+                # Журнал, созданный до появления номера ветки
+                columns = {row[1] for row in db.execute("PRAGMA table_info(jobs)")}
+                if "branch_index" not in columns:
+                    db.execute("ALTER TABLE jobs ADD COLUMN branch_index INTEGER")
+                db.commit()
+            except sqlite3.Error as e:
+                print(f"[ERROR] Журнал задач {self.path} недоступен, воркер работает без него: {e}")
+                self.path = ""
+                return None
+            self._db = db
+        return self._db
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _execute(self, sql, rows):
+        if not self.path or not rows:
+            return
+        with self._lock:
+            db = self._open()
+            if db is None:
+                return
+            try:
+                db.executemany(sql, rows)
+                db.commit()
+            except sqlite3.Error as e:
+                print(f"[ERROR] Ошибка записи журнала задач: {e}")
+
+    @staticmethod
+    def _dump_news(news):
+        data = {key: value for key, value in news.items() if key != 'variants'}
+        data['date_time'] = news['date_time'].isoformat()
+        return json.dumps(data, ensure_ascii=False)
+
+    @staticmethod
+    def _load_news(data):
+        news = json.loads(data)
+        news['date_time'] = datetime.datetime.fromisoformat(news['date_time'])
+        return news
+
+    def claimed(self, worker_id, news_list):
+        now = time.time()
+        self._execute(
+            "INSERT OR REPLACE INTO jobs (news_id, state, worker_id, news, updated) VALUES (?, 'claimed', ?, ?, ?)",
+            [(news['id'], worker_id, self._dump_news(news), now) for news in news_list])
+
+    # Номер ветки новости - её позиция в news_list (см. jobs.split_outputs)
+    def submitted(self, news_list, prompt_id, backend, branches):
+        now = time.time()
+        self._execute(
+            "UPDATE jobs SET state = 'submitted', news = ?, prompt_id = ?, backend = ?, branches = ?, "
+            "branch_index = ?, updated = ? WHERE news_id = ?",
+            [(self._dump_news(news), prompt_id, backend.url, json.dumps(branches), index, now, news['id'])
+             for index, news in enumerate(news_list)])
+
+    def rendered(self, news, images):
+        self._execute("UPDATE jobs SET state = 'rendered', images = ?, updated = ? WHERE news_id = ?",
+                      [(json.dumps(images), time.time(), news['id'])])
+
+    def uploaded(self, news, image_url):
+        variants = news.get('variants')
+        self._execute(
+            "UPDATE jobs SET state = 'uploaded', image_url = ?, variants = ?, updated = ? WHERE news_id = ?",
+            [(image_url, json.dumps(variants) if variants else None, time.time(), news['id'])])
+
+    # Новости из журнала снова захвачены воркером worker_id (db.reclaim_news)
+    def reclaimed(self, worker_id, news_ids):
+        self._execute("UPDATE jobs SET worker_id = ? WHERE news_id = ?", [(worker_id, news_id) for news_id in news_ids])
+
+    # Результат записан в БД (изображение или ошибка): новость больше не нужно продолжать
+    def committed(self, news_ids):
+        self._execute("DELETE FROM jobs WHERE news_id = ?", [(news_id,) for news_id in news_ids])
+
+    # Незавершённые новости: [{"state", "worker_id", "news", "prompt_id", "backend", "branches",
+    # "branch_index", "images", "image_url", "variants"}] в порядке последнего изменения
+    def unfinished(self):
+        if not self.path:
+            return []
+        with self._lock:
+            db = self._open()
+            if db is None:
+                return []
+            rows = db.execute(
+                "SELECT state, worker_id, news, prompt_id, backend, branches, branch_index, images, image_url, "
+                "variants FROM jobs ORDER BY updated").fetchall()
+        return [{
+            "state": state,
+            "worker_id": worker_id,
+            "news": self._load_news(news),
+            "prompt_id": prompt_id,
+            "backend": backend,
+            "branches": json.loads(branches) if branches else None,
+            "branch_index": branch_index,
+            "images": json.loads(images) if images else None,
+            "image_url": image_url,
+            "variants": json.loads(variants) if variants else None,
+        } for state, worker_id, news, prompt_id, backend, branches, branch_index, images, image_url, variants
+            in rows]
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+JOURNAL = JobJournal()
@@ -0,0 +1,274 @@
+import json
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import settings
+
+# Метрики и трассировка задач.
+# Счётчики, показатели и гистограммы хранятся в памяти процесса и отдаются в текстовом
+# формате Prometheus по http://METRICS_HOST:METRICS_PORT/metrics (см. start_metrics_server).
+# Для каждой новости ведётся трасса с монотонными отметками времени по этапам:
+#   claim    - захват из БД
+#   cache    - поиск в кэше изображений (при попадании следующий этап - db)
+#   queued   - ожидание отправки (очередь воркера)
+#   submit   - POST /prompt
+#   wait     - генерация и ожидание результата (/history или WebSocket)
+#   upload   - /view -> FTP (при потоковой передаче скачивание и STOR идут одновременно)
+#   variants - кодирование и загрузка производных изображений (при заданном IMAGE_VARIANTS)
+#   db       - ожидание записи в буфере ResultWriter и сама запись
+# Завершённая трасса записывается строкой JSON в METRICS_LOG (если задан)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+def _label_key(labelnames, labels):
+    if set(labels) != set(labelnames):
+        raise ValueError(f"Ожидались метки {labelnames}, получены {sorted(labels)}")
+    return tuple(str(labels[name]) for name in labelnames)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labelnames, key, extra=()):
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(_label_key(self.labelnames, labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, _format_labels(self.labelnames, key), value) for key, value in self._values.items()]
+
+# Текущее значение. Вместо set() можно задать функцию, которая вызывается при чтении метрик
+class Gauge(Counter):
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function):
+        self._function = function
+
+    def samples(self):
+        if self._function is not None:
+            return [(self.name, "", self._function())]
+        return super().samples()
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        result = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                    result.append((f"{self.name}_bucket", labels, cumulative))
+                labels = _format_labels(self.labelnames, key)
+                result.append((f"{self.name}_sum", labels, total))
+                result.append((f"{self.name}_count", labels, cumulative))
+        return result
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    # Все метрики в текстовом формате Prometheus
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.add(Histogram(
+    "generate_stage_seconds", "Время этапа обработки одной новости", ("stage",)))
+JOB_SECONDS = REGISTRY.add(Histogram(
+    "generate_job_seconds", "Время от захвата новости до записи результата в БД", ("status",)))
+JOBS_TOTAL = REGISTRY.add(Counter(
+    "generate_jobs_total", "Новости, результат которых записан в БД", ("status",)))
+FAILURES_TOTAL = REGISTRY.add(Counter(
+    "generate_failures_total", "Неудачные попытки обработки новости по причинам", ("cause",)))
+PENDING_NEWS = REGISTRY.add(Gauge(
+    "generate_pending_news", "Захваченные новости, ожидающие отправки в ComfyUI"))
+IN_FLIGHT_PROMPTS = REGISTRY.add(Gauge(
+    "generate_in_flight_prompts", "Промпты, отправленные в ComfyUI и ещё не завершённые"))
+RETRIES_TOTAL = REGISTRY.add(Counter(
+    "generate_retries_total", "Повторы запросов после ошибок соединения", ("target",)))
+COMFY_REQUEST_SECONDS = REGISTRY.add(Histogram(
+    "comfy_request_seconds", "Время запроса к ComfyUI до получения заголовков ответа", ("endpoint",)))
+FTP_OPERATION_SECONDS = REGISTRY.add(Histogram(
+    "ftp_operation_seconds", "Время операций FTP", ("operation",)))
+FTP_UPLOADED_BYTES = REGISTRY.add(Counter(
+    "ftp_uploaded_bytes_total", "Байт загружено на FTP"))
+DB_WRITE_SECONDS = REGISTRY.add(Histogram(
+    "db_write_seconds", "Время пакетной записи результатов в БД"))
+
+# Трасса одной новости: отметка времени начала и длительности этапов
+class JobTrace:
+    def __init__(self, news_id, started):
+        self.news_id = news_id
+        self.started = started
+        self.last_mark = started
+        self.stages = {}
+        self.cause = None
+
+    # Завершение этапа stage: время с предыдущей отметки
+    def mark(self, stage, now):
+        seconds = max(0.0, now - self.last_mark)
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        self.last_mark = now
+        STAGE_SECONDS.observe(seconds, stage=stage)
+
+# Трассы новостей в работе (news_id -> JobTrace). Повторный захват новости начинает новую трассу
+class Tracer:
+    def __init__(self, log_path=settings.METRICS_LOG):
+        self.log_path = log_path
+        self._traces = {}
+        self._lock = threading.Lock()
+        self._log_lock = threading.Lock()
+
+    def start(self, news_ids, started=None):
+        started = time.monotonic() if started is None else started
+        with self._lock:
+            for news_id in news_ids:
+                self._traces[news_id] = JobTrace(news_id, started)
+
+    def mark(self, news_ids, stage):
+        now = time.monotonic()
+        with self._lock:
+            for news_id in news_ids:
+                trace = self._traces.get(news_id)
+                if trace is not None:
+                    trace.mark(stage, now)
+
+    # Неудачная попытка: причина попадёт в счётчик и в трассу
+    def fail(self, news_ids, cause):
+        with self._lock:
+            for news_id in news_ids:
+                FAILURES_TOTAL.inc(cause=cause)
+                trace = self._traces.get(news_id)
+                if trace is not None:
+                    trace.cause = cause
+
+    # Результат записан в БД: трасса закрывается и пишется в лог
+    def finish(self, news_ids, status):
+        now = time.monotonic()
+        finished = []
+        with self._lock:
+            for news_id in news_ids:
+                JOBS_TOTAL.inc(status=status)
+                trace = self._traces.pop(news_id, None)
+                if trace is None:
+                    continue
+                trace.mark("db", now)
+                JOB_SECONDS.observe(now - trace.started, status=status)
+                finished.append(trace)
+        if self.log_path and finished:
+            self._write(finished, status)
+
+    def _write(self, traces, status):
+        lines = [json.dumps({
+            "ts": time.time(),
+            "id": trace.news_id,
+            "status": status,
+            "cause": trace.cause,
+            "total": round(sum(trace.stages.values()), 6),
+            "stages": {stage: round(seconds, 6) for stage, seconds in trace.stages.items()},
+        }, ensure_ascii=False, default=str) for trace in traces]
+        try:
+            with self._log_lock, open(self.log_path, "a", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+        except OSError as e:
+            print(f"[ERROR] Ошибка записи журнала метрик {self.log_path}: {e}")
+
+TRACER = Tracer()
+
+# Локальный HTTP сервер метрик: GET /metrics
+def start_metrics_server(port=settings.METRICS_PORT, host=settings.METRICS_HOST, registry=REGISTRY):
+    if not port:
+        return None
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    try:
+        server = ThreadingHTTPServer((host, port), Handler)
+    except OSError as e:
+        print(f"[ERROR] Не удалось запустить сервер метрик на {host}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"[LOG] Метрики доступны по адресу http://{host}:{server.server_address[1]}/metrics")
+    return server
@@ -0,0 +1,5 @@
+-- Колонки для конкурентного захвата новостей несколькими воркерами (db.claim_news_batch)
+ALTER TABLE original_news
+    ADD COLUMN IF NOT EXISTS claimed_by text,
+    ADD COLUMN IF NOT EXISTS claimed_until timestamptz,
+    ADD COLUMN IF NOT EXISTS attempts integer NOT NULL DEFAULT 0;
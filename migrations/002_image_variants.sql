@@ -0,0 +1,4 @@
+-- Пути производных изображений (миниатюры, WebP, ...) рядом с image_url: {"имя": "/images/YYYY/MM/..."}
+-- Заполняется при заданном IMAGE_VARIANTS (см. variants.py, db.ResultWriter)
+ALTER TABLE original_news
+    ADD COLUMN IF NOT EXISTS image_variants jsonb;
@@ -0,0 +1,13 @@
+-- Приоритет и срок актуальности новостей (db.CLAIM_SQL): новости захватываются по убыванию
+-- priority, затем от свежих к старым; после deadline (по умолчанию date_time + NEWS_DEADLINE)
+-- новость генерируется с профилем STALE_PROFILE
+ALTER TABLE original_news
+    ADD COLUMN IF NOT EXISTS priority integer NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS deadline timestamptz;
+
+-- Частичный индекс только по строкам без изображения: захват читает его в порядке ORDER BY,
+-- и его размер зависит от очереди, а не от размера всей таблицы.
+-- На большой работающей таблице индекс лучше создать вручную с CREATE INDEX CONCURRENTLY
+CREATE INDEX IF NOT EXISTS original_news_pending_idx
+    ON original_news (priority DESC, date_time DESC)
+    WHERE image_url IS NULL;
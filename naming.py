@@ -0,0 +1,66 @@
+import os
+import re
+import unicodedata
+
+import settings
+
+# Имена файлов изображений на FTP: короткий латинский slug заголовка и id новости,
+# например "v-moskve-otkrylsya-novyy-park-12345.jpg".
+# id новости уникален в original_news, поэтому имена разных новостей не совпадают даже
+# при одинаковых заголовках, и уникальность не нужно проверять запросами к FTP.
+# Длина имени без расширения ограничена settings.IMAGE_NAME_MAX_LENGTH вместе с суффиксом
+# _N дополнительных изображений: slug обрезается по границе слова, id не обрезается никогда
+# (поэтому предел не меньше длины id с суффиксом, см. settings). Кириллица транслитерируется, поэтому имена
+# не зависят от кодировки FTP сервера
+
+TRANSLIT = {
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "e", "ж": "zh", "з": "z",
+    "и": "i", "й": "y", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o", "п": "p", "р": "r",
+    "с": "s", "т": "t", "у": "u", "ф": "f", "х": "kh", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "shch",
+    "ъ": "", "ы": "y", "ь": "", "э": "e", "ю": "yu", "я": "ya",
+    "і": "i", "ї": "yi", "є": "ye", "ґ": "g",
+}
+
+# Имя файла в новой схеме: [slug-]id (см. is_current)
+CURRENT_STEM = re.compile(r"(?:[a-z0-9]+(?:-[a-z0-9]+)*-)?\d+")
+
+# Заголовок -> латиница, цифры и дефисы, не длиннее max_length (по границе слова)
+def slugify(title, max_length):
+    if max_length <= 0:
+        return ""
+    text = "".join(TRANSLIT.get(char, char) for char in title.lower())
+    # Оставшиеся буквы с диакритикой -> ASCII (é -> e), прочие символы отбрасываются
+    text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii")
+    slug = re.sub(r"[^a-z0-9]+", "-", text).strip("-")
+    if len(slug) > max_length:
+        slug = slug[:max_length + 1]
+        slug = slug[:slug.rfind("-")] if "-" in slug else slug[:max_length]
+    return slug.strip("-")
+
+# Имя файла новости без расширения: slug заголовка и id
+def image_stem(news, max_length=None):
+    max_length = settings.IMAGE_NAME_MAX_LENGTH if max_length is None else max_length
+    # Место под суффикс _N дополнительных изображений (см. image_filename)
+    if settings.IMAGES_PER_NEWS > 1:
+        max_length -= len(f"_{settings.IMAGES_PER_NEWS}")
+    suffix = str(news['id'])
+    slug = slugify(news['title'], max_length - len(suffix) - 1)
+    return f"{slug}-{suffix}" if slug else suffix
+
+# Имя файла index-го изображения новости (после первого - с суффиксом _2, _3, ...)
+def image_filename(news, index=0, extension="jpg"):
+    stem = image_stem(news)
+    return f"{stem}.{extension}" if index == 0 else f"{stem}_{index + 1}.{extension}"
+
+# Расширение по имени файла, который записал ComfyUI. Формат задаёт узел сохранения
+# или параметр профиля format, поэтому PNG или WebP не получают имя .jpg:
+# "ComfyUI_00001_.png" -> "png"
+def image_extension(filename, default="jpg"):
+    extension = os.path.splitext(filename)[1].lstrip(".").lower()
+    return {"jpeg": "jpg"}.get(extension, extension) or default
+
+# Имя уже в новой схеме для новости news_id: [slug-]id с её id (см. rename_images.py).
+# Старое имя из одних цифр (заголовок "2024") не считается новым, если это не id новости
+def is_current(stem, news_id):
+    news_id = str(news_id)
+    return CURRENT_STEM.fullmatch(stem) is not None and (stem == news_id or stem.endswith(f"-{news_id}"))
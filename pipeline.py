@@ -0,0 +1,418 @@
+import asyncio
+import time
+from collections import deque
+
+import settings
+from comfy_events import PollBackoff
+from comfy_pool import start_backend_pool
+from db import connect_to_db, claim_news_batch, extend_claims, reclaim_news, ResultWriter, COUNTED_FAILURES
+from ftp_pool import get_ftp_pool
+from metrics import TRACER, PENDING_NEWS, IN_FLIGHT_PROMPTS, start_metrics_server
+from jobs import (queue_news, resolve_prompt, split_outputs, upload_images, take_cached, resume_jobs, news_profile,
+                  upload_failure_cause)
+from journal import JOURNAL
+from result_cache import RenderingKeys
+from workflow import load_template
+from warmup import warm_up, keep_hot
+from variants import start_variant_pool
+
+# Асинхронный конвейер генерации (python generate.py --pipeline).
+# Этапы связаны ограниченными очередями asyncio.Queue и работают независимо:
+#
+#   claim -> claimed -> submit -> in_flight -> await -> completed -> fetch -> uploads -> upload -> results -> db
+#
+# claim   - захват новостей из БД (db.claim_news_batch)
+# submit  - проверка кэша изображений и отправка промптов в ComfyUI, не больше max_in_flight одновременно;
+#           новости с тем же ключом кэша, что у генерируемой, ждут её записи в БД (rendering)
+# await   - ожидание завершения промптов (события WebSocket или опрос /history);
+#           промпты исключённого сервера пула возвращаются на отправку (claimed или retry)
+# fetch   - раскладка изображений готового промпта по новостям
+# upload  - потоковая передача изображений с ComfyUI на FTP
+# db      - запись image_url или error_message пачками (db.ResultWriter)
+# resume  - при запуске задачи из журнала (journal.py) ставятся в очередь своего этапа
+#
+# Блокирующие функции из jobs.py, comfy_client.py, ftp_pool.py и db.py выполняются
+# через asyncio.to_thread, поэтому медленный FTP или БД не задерживают отправку промптов.
+# Число параллельных исполнителей submit и upload задаётся настройками;
+# claim и db работают через одно соединение с БД и выполняются по очереди (db_lock)
+class AsyncPipeline:
+    def __init__(self, conn, template, worker_id, batch_size, idle_sleep, idle_max_sleep,
+                 max_in_flight, pool, news_per_prompt=settings.NEWS_PER_PROMPT,
+                 submit_concurrency=settings.PIPELINE_SUBMIT_CONCURRENCY,
+                 upload_concurrency=settings.PIPELINE_UPLOAD_CONCURRENCY,
+                 queue_size=settings.PIPELINE_QUEUE_SIZE):
+        self.conn = conn
+        self.template = template
+        self.worker_id = worker_id
+        self.batch_size = batch_size
+        self.idle_sleep = idle_sleep
+        self.idle_max_sleep = idle_max_sleep
+        self.pool = pool
+        self.listener = pool.listener
+        self.news_per_prompt = news_per_prompt
+        self.submit_concurrency = submit_concurrency
+        self.upload_concurrency = upload_concurrency
+        self.claimed = asyncio.Queue(maxsize=queue_size)
+        self.completed = asyncio.Queue(maxsize=queue_size)
+        self.uploads = asyncio.Queue(maxsize=queue_size)
+        self.results = asyncio.Queue(maxsize=queue_size)
+        self.in_flight = {}
+        # Новости промптов исключённого сервера, не поместившиеся в claimed: отправляются первыми
+        self.retry = deque()
+        self.rendering = RenderingKeys()
+        self.in_flight_slots = asyncio.Semaphore(max_in_flight)
+        self.db_lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
+        # Захваченные и ещё не записанные в БД новости: id -> новость (для продления аренды)
+        self.active = {}
+        # Начатые загрузки на FTP: задача -> новость (результат не должен потеряться при остановке)
+        self.uploading = {}
+        self.writer = ResultWriter(worker_id)
+        self.processed = 0
+        PENDING_NEWS.set_function(self.claimed.qsize)
+        IN_FLIGHT_PROMPTS.set_function(lambda: len(self.in_flight))
+
+    def events_available(self):
+        return self.listener is not None and self.listener.connected
+
+    # Неудачная попытка: cause - короткая причина для метрик (см. InFlightScheduler.fail)
+    async def fail(self, news_list, error_message, cause):
+        TRACER.fail([news['id'] for news in news_list], cause)
+        for news in news_list:
+            await self.results.put((news, None, error_message, cause))
+
+    # Вызов функции db.py с общим соединением в отдельном потоке
+    async def db_call(self, func, *args):
+        async with self.db_lock:
+            if self.conn is None or self.conn.closed:
+                self.conn = await asyncio.to_thread(connect_to_db)
+                if self.conn is None:
+                    raise ConnectionError("Подключение к базе данных не удалось.")
+            return await asyncio.to_thread(func, self.conn, *args)
+
+    async def claim_stage(self):
+        sleep_time = self.idle_sleep
+        while True:
+            # Пока все серверы пула исключены, новости не захватываются: они только вернулись бы с ошибкой
+            if not self.pool.healthy_count():
+                await asyncio.sleep(self.idle_sleep)
+                continue
+            free = self.claimed.maxsize - self.claimed.qsize()
+            try:
+                batch = await self.db_call(claim_news_batch, self.worker_id, max(1, min(self.batch_size, free)),
+                                           settings.CLAIM_LEASE_SECONDS, settings.CLAIM_MAX_ATTEMPTS)
+            except ConnectionError as e:
+                print(f"[ERROR] {e}")
+                batch = []
+            if not batch:
+                if not self.active:
+                    print(f"[LOG] Очередь пуста, обработано за сессию: {self.processed}. Ожидание {sleep_time} секунд...")
+                    await asyncio.to_thread(get_ftp_pool().send_keepalive)
+                    await asyncio.to_thread(keep_hot, self.pool, self.template)
+                await asyncio.sleep(sleep_time)
+                sleep_time = min(sleep_time * 2, self.idle_max_sleep)
+                continue
+            sleep_time = self.idle_sleep
+            print(f"[LOG] Захвачено записей для обработки: {len(batch)}")
+            await asyncio.to_thread(JOURNAL.claimed, self.worker_id, batch)
+            for news in batch:
+                self.active[news['id']] = news
+                # Ожидание места в очереди: захват не обгоняет отправку промптов
+                await self.claimed.put(news)
+
+    # Новости для следующего промпта: сначала из retry, затем из claimed.
+    # В один промпт попадают только новости с одним профилем, остальные ждут в retry
+    async def take_news(self):
+        if not self.retry:
+            self.retry.append(await self.claimed.get())
+        news_list = [self.retry.popleft()]
+        profile = news_profile(news_list[0])
+        while self.retry and len(news_list) < self.news_per_prompt and news_profile(self.retry[0]) == profile:
+            news_list.append(self.retry.popleft())
+        while len(news_list) < self.news_per_prompt and not self.claimed.empty():
+            news = self.claimed.get_nowait()
+            if news_profile(news) != profile:
+                self.retry.append(news)
+                break
+            news_list.append(news)
+        return news_list
+
+    async def submit_stage(self):
+        while True:
+            news_list = await self.take_news()
+            # Новости, изображение для которых уже есть в кэше, сразу идут на запись в БД
+            news_list, hits = await asyncio.to_thread(take_cached, self.template, news_list, self.rendering)
+            for news, image_url in hits:
+                await self.results.put((news, image_url, None, None))
+            if not news_list:
+                continue
+            await self.in_flight_slots.acquire()
+            for news in news_list:
+                print(f"[LOG] Попытка {news['attempts']} из {settings.CLAIM_MAX_ATTEMPTS} для записи с ID: {news['id']}")
+            # Текст ошибки от queue_news - промпт отклонён, исключение - серверы недоступны
+            cause = "rejected"
+            try:
+                prompt_id, backend, branches, error_message = await asyncio.to_thread(
+                    queue_news, self.template, news_list, self.pool)
+            except Exception as e:
+                prompt_id, backend, branches, error_message = None, None, None, f"Общая ошибка в процессе выполнения: {e}"
+                cause = "submit"
+            if error_message:
+                self.in_flight_slots.release()
+                await self.fail(news_list, error_message, cause)
+                continue
+            poll = PollBackoff()
+            if self.events_available():
+                # При работающем WebSocket /history нужен только как страховка
+                poll.defer(time.monotonic(), settings.SAFETY_POLL_INTERVAL)
+            self.in_flight[prompt_id] = {"news": news_list, "backend": backend, "branches": branches,
+                                         "submitted_at": time.monotonic(), "poll": poll,
+                                         "timeout": self.pool.generation_timeout(backend)}
+            self.wakeup.set()
+
+    async def await_stage(self):
+        while True:
+            # Сброс до проверки событий: уведомление, пришедшее позже, разбудит ожидание ниже
+            self.wakeup.clear()
+            events = self.listener.pop_finished(list(self.in_flight)) if self.listener else {}
+            for prompt_id, job in list(self.in_flight.items()):
+                backend = job["backend"]
+                poll = job["poll"]
+                now = time.monotonic()
+                event = events.get(prompt_id)
+                if event is None and self.pool.should_reschedule(backend):
+                    self.reschedule(prompt_id, job)
+                    continue
+                if not self.events_available():
+                    poll.clamp(now)
+                if event is None and not poll.due(now):
+                    state, task_data = "pending", None
+                else:
+                    state, task_data = await asyncio.to_thread(resolve_prompt, prompt_id, event, backend)
+
+                if state == "pending":
+                    if now - job["submitted_at"] > job["timeout"]:
+                        state = "timeout"
+                    elif event is not None:
+                        # Промпт завершён, но /history ещё не записан - опрашиваем часто
+                        poll.reset(now)
+                        continue
+                    else:
+                        if poll.due(now):
+                            if self.events_available() and not job.get("resumed"):
+                                poll.defer(now, settings.SAFETY_POLL_INTERVAL)
+                            else:
+                                poll.backoff(now)
+                        continue
+
+                del self.in_flight[prompt_id]
+                self.in_flight_slots.release()
+                self.pool.release(backend, state == "success")
+                TRACER.mark([news['id'] for news in job["news"]], "wait")
+                await self.completed.put((job, state, task_data))
+
+            if self.in_flight:
+                timeout = max(0, min(job["poll"].next_poll for job in self.in_flight.values()) - time.monotonic())
+            else:
+                timeout = None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    # Промпт недоступного сервера снимается, его новости снова ждут отправки.
+    # await_stage не должен ждать места в claimed: слоты in_flight освобождает только он сам
+    def reschedule(self, prompt_id, job):
+        del self.in_flight[prompt_id]
+        self.in_flight_slots.release()
+        news_ids = [news['id'] for news in job["news"]]
+        TRACER.mark(news_ids, "wait")
+        self.pool.reschedule(job["backend"], news_ids)
+        self.requeue(job["news"])
+
+    # Возврат новостей на отправку без ожидания места в claimed
+    def requeue(self, news_list):
+        for news in news_list:
+            # Если claimed заполнен, submit_stage не ждёт на нём и заберёт новость из retry
+            if self.claimed.full():
+                self.retry.append(news)
+            else:
+                self.claimed.put_nowait(news)
+
+    async def fetch_stage(self):
+        while True:
+            job, state, task_data = await self.completed.get()
+            news_list = job["news"]
+            if state == "timeout":
+                await self.fail(news_list, "Время ожидания истекло, задача не завершена успешно.", "timeout")
+                continue
+            if state == "error":
+                await self.fail(news_list, "Генерация завершилась с ошибкой.", "generation")
+                continue
+            per_news = split_outputs(task_data, job["branches"], len(news_list))
+            for news, images in zip(news_list, per_news):
+                if images:
+                    await asyncio.to_thread(JOURNAL.rendered, news, images)
+                    await self.uploads.put((news, images, job["backend"]))
+                else:
+                    await self.fail([news], "Генерация завершилась без изображений.", "no_images")
+
+    # Загрузка выполняется под shield: при остановке этап отменяется, а уже начатая передача
+    # доводится до конца, и её результат записывается в БД (см. run)
+    async def upload_stage(self):
+        while True:
+            news, images, backend = await self.uploads.get()
+            upload = asyncio.ensure_future(asyncio.to_thread(upload_images, news, images, backend))
+            self.uploading[upload] = news
+            try:
+                saved_paths = await asyncio.shield(upload)
+                await self.results.put((news, saved_paths[0], None, None))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                await self.fail([news], f"Ошибка при загрузке изображения: {e}", upload_failure_cause(e))
+            del self.uploading[upload]
+
+    # Результат обработки новости - в буфер записи
+    def record(self, news, image_path, error_message, cause):
+        if image_path:
+            self.writer.add_image(news['id'], image_path, news.get('variants'))
+            print(f"[LOG] Изображение загружено: {image_path}")
+        else:
+            print(f"[ERROR] {error_message}")
+            self.writer.add_error(news['id'], error_message, cause in COUNTED_FAILURES)
+        self.processed += 1
+        # Новости, ждавшие результата этой, снова проверяют кэш
+        self.requeue(self.rendering.finish(news))
+
+    # Результаты копятся в буфере и записываются одной транзакцией, когда буфер
+    # заполнен или самый старый результат ждёт дольше RESULT_FLUSH_INTERVAL
+    async def db_stage(self):
+        while True:
+            try:
+                news, image_path, error_message, cause = await asyncio.wait_for(
+                    self.results.get(), self.writer.time_to_flush())
+            except asyncio.TimeoutError:
+                await self.flush_results()
+                continue
+            self.record(news, image_path, error_message, cause)
+            if self.writer.should_flush():
+                await self.flush_results()
+
+    async def flush_results(self):
+        pending_ids = self.writer.pending_ids()
+        try:
+            written = await self.db_call(self.writer.flush)
+        except ConnectionError as e:
+            # Строки остаются в буфере до следующей попытки
+            print(f"[ERROR] {e}")
+            return
+        if written:
+            for news_id in pending_ids:
+                self.active.pop(news_id, None)
+
+    # Периодическое продление аренды всех захваченных, но не записанных новостей
+    async def lease_stage(self):
+        while True:
+            await asyncio.sleep(settings.CLAIM_LEASE_SECONDS / 3)
+            if self.active:
+                try:
+                    await self.db_call(extend_claims, self.worker_id, list(self.active), settings.CLAIM_LEASE_SECONDS)
+                except ConnectionError as e:
+                    print(f"[ERROR] {e}")
+
+    # Продолжение задач из журнала: каждая новость попадает в очередь этапа,
+    # следующего за её последним записанным состоянием (см. jobs.resume_jobs)
+    async def resume_stage(self):
+        entries = await asyncio.to_thread(JOURNAL.unfinished)
+        if not entries:
+            return
+        try:
+            owned = await self.db_call(reclaim_news, self.worker_id, [entry["news"]["id"] for entry in entries],
+                                       {entry["worker_id"] for entry in entries}, settings.CLAIM_LEASE_SECONDS)
+        except ConnectionError as e:
+            print(f"[ERROR] {e}")
+            return
+        if owned is None:
+            return
+        resumed = await asyncio.to_thread(resume_jobs, entries, owned, self.pool, self.worker_id)
+        for entry in entries:
+            if entry["news"]["id"] in owned:
+                self.active[entry["news"]["id"]] = entry["news"]
+        for news, image_url in resumed["uploaded"]:
+            await self.results.put((news, image_url, None, None))
+        for news, images, backend in resumed["rendered"]:
+            await self.uploads.put((news, images, backend))
+        for prompt_id, backend, news_list, branches in resumed["submitted"]:
+            await self.in_flight_slots.acquire()
+            # События промпта приходят client_id прежнего процесса: ждём его опросом /history
+            self.in_flight[prompt_id] = {"news": news_list, "backend": backend, "branches": branches,
+                                         "submitted_at": time.monotonic(), "poll": PollBackoff(),
+                                         "timeout": self.pool.generation_timeout(backend), "resumed": True}
+            self.wakeup.set()
+        for news in resumed["claimed"]:
+            await self.claimed.put(news)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        if self.listener:
+            self.listener.on_change = lambda: loop.call_soon_threadsafe(self.wakeup.set)
+        stages = [self.resume_stage(), self.claim_stage(), self.await_stage(), self.fetch_stage(),
+                  self.db_stage(), self.lease_stage()]
+        stages += [self.submit_stage() for _ in range(self.submit_concurrency)]
+        stages += [self.upload_stage() for _ in range(self.upload_concurrency)]
+        tasks = [asyncio.create_task(stage) for stage in stages]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if self.listener:
+                self.listener.on_change = None
+            await self.drain()
+            # Запись того, что осталось в буфере, до закрытия соединения
+            if self.conn is None or self.conn.closed:
+                self.conn = await asyncio.to_thread(connect_to_db)
+            await asyncio.to_thread(self.writer.close, self.conn)
+            JOURNAL.close()
+
+    # Остановка: начатые загрузки завершаются, их результаты и всё, что осталось в results,
+    # попадают в буфер записи, чтобы загруженные на FTP изображения не потерялись для БД
+    async def drain(self):
+        for upload, news in list(self.uploading.items()):
+            try:
+                saved_paths = await upload
+            except Exception as e:
+                self.record(news, None, f"Ошибка при загрузке изображения: {e}", upload_failure_cause(e))
+            else:
+                self.record(news, saved_paths[0], None, None)
+        self.uploading.clear()
+        while not self.results.empty():
+            self.record(*self.results.get_nowait())
+
+# Запуск конвейера. Параметры те же, что у run_worker в generate.py
+def run_pipeline(batch_size, idle_sleep, idle_max_sleep, max_in_flight):
+    template = load_template()
+    pool = start_backend_pool()
+    metrics_server = start_metrics_server()
+    variant_pool = start_variant_pool()
+    pipeline = AsyncPipeline(connect_to_db(), template, settings.WORKER_ID, batch_size,
+                             idle_sleep, idle_max_sleep, max_in_flight, pool)
+    print(f"[LOG] Конвейер {settings.WORKER_ID} запущен, промптов в работе: до {max_in_flight}.")
+    try:
+        # Модели загружаются до захвата новостей: первый промпт не упрётся в таймаут
+        if settings.WARMUP:
+            warm_up(pool, pipeline.template)
+        asyncio.run(pipeline.run())
+    except KeyboardInterrupt:
+        print(f"[LOG] Остановка конвейера, обработано за сессию: {pipeline.processed}.")
+    finally:
+        if metrics_server:
+            metrics_server.shutdown()
+        pool.stop()
+        if variant_pool:
+            variant_pool.close()
+        get_ftp_pool().close()
+        if pipeline.conn is not None and not pipeline.conn.closed:
+            pipeline.conn.close()
@@ -0,0 +1,180 @@
+import argparse
+import ftplib
+import json
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+
+from psycopg2.extras import execute_values
+
+import settings
+from db import connect_to_db, rollback_quietly
+from ftp_pool import get_ftp_pool
+from naming import image_stem, is_current
+
+# Разовое переименование уже загруженных изображений в схему имён naming.py:
+#
+#   python rename_images.py --dry-run
+#   python rename_images.py --batch-size 500
+#
+# Новости с image_url обходятся по возрастанию id пачками по --batch-size. Для каждой
+# первое изображение, дополнительные (_2 ... _IMAGES_PER_NEWS) и производные из image_variants
+# переименовываются на FTP командами RNFR/RNTO в том же каталоге, затем image_url
+# (и image_variants) всей пачки обновляются одним UPDATE в одной транзакции.
+# Новости с одним файлом (изображение из кэша) получают одно имя - по наименьшему id.
+# Имена, уже соответствующие новой схеме для одной из новостей файла (оканчиваются её id),
+# пропускаются, поэтому прерванный запуск можно
+# просто повторить: если исходного файла нет, а новый уже есть, обновляется только БД
+
+def has_variants_column(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM information_schema.columns "
+                       "WHERE table_name = 'original_news' AND column_name = 'image_variants';")
+        return cursor.fetchone() is not None
+
+# Следующая пачка новостей с изображением: [{"id", "title", "image_url", "variants"}]
+def fetch_batch(conn, after_id, limit, with_variants):
+    with conn.cursor() as cursor:
+        cursor.execute(
+            f"SELECT id, title, image_url, {'image_variants' if with_variants else 'NULL'} FROM original_news "
+            "WHERE image_url IS NOT NULL AND id > %s ORDER BY id LIMIT %s;",
+            (after_id, limit)
+        )
+        rows = cursor.fetchall()
+    conn.commit()
+    return [{"id": row[0], "title": row[1], "image_url": row[2], "variants": row[3]} for row in rows]
+
+# Все новости, ссылающиеся на файлы image_urls: {image_url: [id]}
+def fetch_sharers(conn, image_urls):
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT id, image_url FROM original_news WHERE image_url = ANY(%s);", (list(image_urls),))
+        rows = cursor.fetchall()
+    conn.commit()
+    sharers = {}
+    for news_id, image_url in rows:
+        sharers.setdefault(image_url, []).append(news_id)
+    return sharers
+
+def update_batch(conn, updates, with_variants):
+    with conn.cursor() as cursor:
+        if with_variants:
+            execute_values(cursor, """
+                UPDATE original_news AS n
+                SET image_url = v.image_url, image_variants = COALESCE(v.image_variants::jsonb, n.image_variants)
+                FROM (VALUES %s) AS v(id, image_url, image_variants)
+                WHERE n.id = v.id;
+            """, updates, page_size=len(updates))
+        else:
+            execute_values(cursor, """
+                UPDATE original_news AS n
+                SET image_url = v.image_url
+                FROM (VALUES %s) AS v(id, image_url)
+                WHERE n.id = v.id;
+            """, [(news_id, image_url) for news_id, image_url, _ in updates], page_size=len(updates))
+    conn.commit()
+
+# Новые пути файлов новости: [(старый путь, новый путь)], первым - основное изображение
+def plan_renames(news):
+    directory, filename = posixpath.split(news['image_url'])
+    old_stem, extension = posixpath.splitext(filename)
+    new_stem = image_stem(news)
+    moves = [(news['image_url'], posixpath.join(directory, new_stem + extension))]
+    for index in range(2, settings.IMAGES_PER_NEWS + 1):
+        moves.append((posixpath.join(directory, f"{old_stem}_{index}{extension}"),
+                      posixpath.join(directory, f"{new_stem}_{index}{extension}")))
+    variants = {}
+    for name, path in (news['variants'] or {}).items():
+        variant_dir, variant_name = posixpath.split(path)
+        if variant_dir == directory and variant_name.startswith(old_stem):
+            variants[name] = posixpath.join(directory, new_stem + variant_name[len(old_stem):])
+            moves.append((path, variants[name]))
+        else:
+            variants[name] = path
+    return moves, variants
+
+# Переименование на FTP. Возвращает True, если файл теперь лежит по новому пути
+def move(old_path, new_path, dry_run):
+    if dry_run:
+        print(f"[LOG] {old_path} -> {new_path}")
+        return True
+    ftp_pool = get_ftp_pool()
+    try:
+        ftp_pool.rename(f"/ftp{old_path}", f"/ftp{new_path}")
+        return True
+    except ftplib.error_perm:
+        # Прошлый запуск мог прерваться после переименования, но до записи в БД
+        return ftp_pool.exists(f"/ftp{new_path}")
+
+# Переименование файлов одной новости. Возвращает (новый image_url, image_variants) или None
+def rename_news(news, dry_run):
+    moves, variants = plan_renames(news)
+    try:
+        if not move(*moves[0], dry_run):
+            print(f"[ERROR] Файл {moves[0][0]} для ID {news['id']} не найден на FTP.")
+            return None
+        # Дополнительных изображений и производных может не быть
+        for old_path, new_path in moves[1:]:
+            move(old_path, new_path, dry_run)
+    except Exception as e:
+        print(f"[ERROR] Ошибка при переименовании файлов для ID {news['id']}: {e}")
+        return None
+    return moves[0][1], variants or None
+
+def run(batch_size, limit, dry_run, workers):
+    conn = connect_to_db()
+    if conn is None:
+        return
+    with_variants = has_variants_column(conn)
+    after_id = 0
+    renamed = skipped = failed = 0
+    try:
+        with ThreadPoolExecutor(workers) as executor:
+            while limit is None or renamed + skipped + failed < limit:
+                batch = fetch_batch(conn, after_id, batch_size, with_variants)
+                if not batch:
+                    break
+                after_id = batch[-1]['id']
+                # Из новостей с одним файлом имя даёт первая
+                files = {}
+                for news in batch:
+                    files.setdefault(news['image_url'], news)
+                sharers = fetch_sharers(conn, files)
+                pending = {}
+                for image_url, news in files.items():
+                    stem = posixpath.splitext(posixpath.basename(image_url))[0]
+                    if any(is_current(stem, news_id) for news_id in sharers.get(image_url, [news['id']])):
+                        skipped += 1
+                    else:
+                        pending[image_url] = news
+                updates = []
+                news_list = list(pending.values())
+                for news, result in zip(news_list, executor.map(lambda item: rename_news(item, dry_run), news_list)):
+                    if result is None:
+                        failed += 1
+                        continue
+                    image_url, variants = result
+                    for news_id in sharers.get(news['image_url'], [news['id']]):
+                        updates.append((news_id, image_url, json.dumps(variants) if variants else None))
+                    renamed += 1
+                if updates and not dry_run:
+                    update_batch(conn, updates, with_variants)
+                print(f"[LOG] Обработаны новости до ID {after_id}: переименовано {renamed}, "
+                      f"уже в новой схеме {skipped}, ошибок {failed}.")
+    except Exception as e:
+        print(f"[ERROR] Ошибка при переименовании изображений: {e}")
+        rollback_quietly(conn)
+    finally:
+        get_ftp_pool().close()
+        conn.close()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Переименование загруженных изображений в схему slug-id")
+    parser.add_argument("--batch-size", type=int, default=500, help="новостей в одной пачке (одном UPDATE)")
+    parser.add_argument("--limit", type=int, help="обработать не больше стольких новостей")
+    parser.add_argument("--workers", type=int, default=settings.FTP_POOL_SIZE,
+                        help="параллельных FTP сессий для переименования")
+    parser.add_argument("--dry-run", action="store_true", help="только вывести новые имена")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    run(args.batch_size, args.limit, args.dry_run, args.workers)
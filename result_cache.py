@@ -0,0 +1,180 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+import settings
+
+# Локальный кэш готовых изображений.
+# Ленты часто присылают одну и ту же новость из нескольких источников: если для такого же
+# заголовка (после нормализации) с тем же стилем и теми же параметрами workflow
+# (см. workflow.workflow_fingerprint) изображение уже генерировалось, оно берётся
+# из кэша без обращения к ComfyUI.
+# Файлы лежат в каталоге кэша, индекс - в SQLite (index.sqlite3 там же).
+# Запись индекса: ключ -> локальные файлы, пути на FTP, размер, время последнего использования.
+# При превышении max_bytes удаляются давно не использованные записи (LRU)
+
+# Нормализация заголовка: регистр, ё/е, знаки препинания и лишние пробелы не влияют на ключ
+def normalize_title(title):
+    title = unicodedata.normalize("NFKC", title).lower().replace("ё", "е")
+    title = re.sub(r"[^\w\s]", " ", title)
+    return " ".join(title.split())
+
+def cache_key(title, style, fingerprint):
+    data = json.dumps([normalize_title(title), style, fingerprint], ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+class ResultCache:
+    def __init__(self, directory=settings.RESULT_CACHE_DIR, max_bytes=settings.RESULT_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        # Индекс используется из нескольких потоков (конвейер), доступ - под _lock
+        self._db = sqlite3.connect(os.path.join(directory, "index.sqlite3"), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                files TEXT NOT NULL,
+                remote_paths TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self._db.commit()
+
+    # Путь для нового файла записи key с номером index
+    def file_path(self, key, index, extension="jpg"):
+        return os.path.join(self.directory, key[:2], f"{key}_{index}.{extension}")
+
+    # Запись по ключу: {"files": [...], "remote_paths": [...]} или None.
+    # Запись, у которой пропал хотя бы один локальный файл, считается отсутствующей
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT files, remote_paths FROM entries WHERE key = ?", (key,)).fetchone()
+            files = json.loads(row[0]) if row else []
+            if row and all(os.path.exists(path) for path in files):
+                self._db.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+                self._db.commit()
+                self.hits += 1
+                entry = {"files": files, "remote_paths": json.loads(row[1])}
+            else:
+                if row:
+                    self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                    self._db.commit()
+                self.misses += 1
+                entry = None
+        print(f"[LOG] Кэш изображений: {'попадание' if entry else 'промах'} ({self.stats_line()})")
+        return entry
+
+    # Сохранение записи: файлы уже лежат в каталоге кэша (см. file_path)
+    def put(self, key, files, remote_paths):
+        size = sum(os.path.getsize(path) for path in files)
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries (key, files, remote_paths, size, created, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, json.dumps(files), json.dumps(remote_paths), size, now, now)
+            )
+            self._db.commit()
+            self._evict()
+
+    # Обновление путей на FTP после повторной загрузки файлов из кэша
+    def set_remote_paths(self, key, remote_paths):
+        with self._lock:
+            self._db.execute("UPDATE entries SET remote_paths = ? WHERE key = ?", (json.dumps(remote_paths), key))
+            self._db.commit()
+
+    # Удаление давно не использованных записей, пока кэш больше max_bytes
+    def _evict(self):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        removed = 0
+        for key, files, size in self._db.execute(
+                "SELECT key, files, size FROM entries ORDER BY last_used").fetchall():
+            if total <= self.max_bytes:
+                break
+            for path in json.loads(files):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+            removed += 1
+        self._db.commit()
+        print(f"[LOG] Из кэша изображений удалено записей: {removed}, размер кэша: {total} байт.")
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "bytes": size,
+        }
+
+    def stats_line(self):
+        lookups = self.hits + self.misses
+        rate = 100 * self.hits / lookups if lookups else 0.0
+        return f"попаданий {self.hits}, промахов {self.misses}, доля попаданий {rate:.1f}%"
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+# Ключи кэша, изображения для которых сейчас генерируются: ключ -> (id новости-лидера, [ждущие новости]).
+# Новость с таким же ключом, пришедшая, пока лидер в работе, не отправляется в ComfyUI:
+# она ждёт результата лидера и затем снова проверяет кэш (см. jobs.take_cached)
+class RenderingKeys:
+    def __init__(self):
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    # True, если news - лидер ключа (в том числе снова отправляемый), иначе новость ждёт лидера
+    def lead_or_wait(self, key, news):
+        with self._lock:
+            leader = self._keys.get(key)
+            if leader is None:
+                self._keys[key] = (news['id'], [])
+                return True
+            if leader[0] == news['id']:
+                return True
+            leader[1].append(news)
+            return False
+
+    # Лидер завершён (изображение загружено или ошибка): возвращает ждавшие его новости
+    def finish(self, news):
+        key = news.get('cache_key')
+        with self._lock:
+            leader = self._keys.get(key)
+            if leader is None or leader[0] != news['id']:
+                return []
+            del self._keys[key]
+            return leader[1]
+
+    def waiting(self):
+        with self._lock:
+            return [news for _, followers in self._keys.values() for news in followers]
+
+_default_cache = None
+
+# Общий кэш процесса (None, если RESULT_CACHE_DIR не задан)
+def get_result_cache():
+    global _default_cache
+    if _default_cache is None and settings.RESULT_CACHE_DIR:
+        _default_cache = ResultCache()
+    return _default_cache
@@ -0,0 +1,142 @@
+import json
+import os
+import socket
+
+# Все настройки читаются из переменных окружения, значения по умолчанию
+# соответствуют прежним захардкоженным значениям из generate.py
+
+# Подключение к базе данных PostgreSQL
+DB_USER = os.environ.get("DB_USER", "")
+DB_HOST = os.environ.get("DB_HOST", "")
+DB_NAME = os.environ.get("DB_NAME", "")
+DB_PASSWORD = os.environ.get("DB_PASSWORD", "")
+DB_PORT = int(os.environ.get("DB_PORT", "5432"))
+
+# Путь к файлу workflow (по умолчанию workflow_api.json рядом со скриптами)
+WORKFLOW_PATH = os.environ.get(
+    "WORKFLOW_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "workflow_api.json"))
+# Профили workflow в JSON: {"имя": {"width": ..., "height": ..., "steps": ..., "seed": ..., "format": ..., "style": ...}}
+WORKFLOW_PROFILES = json.loads(os.environ.get("WORKFLOW_PROFILES", "{}"))
+# Профиль, с которым воркер генерирует изображения (пустое значение - параметры из файла)
+WORKFLOW_PROFILE = os.environ.get("WORKFLOW_PROFILE", "")
+
+# Срок актуальности новости в секундах от date_time (0 - только колонка deadline, см. db.CLAIM_SQL)
+NEWS_DEADLINE = int(os.environ.get("NEWS_DEADLINE", "0"))
+# Профиль workflow для новостей с истёкшим сроком, например с меньшим размером и числом шагов
+# (пустое значение - тот же профиль, что и для свежих)
+STALE_PROFILE = os.environ.get("STALE_PROFILE", "")
+
+# Режим воркера: сколько новостей забирать за один запрос к БД
+WORKER_BATCH_SIZE = int(os.environ.get("WORKER_BATCH_SIZE", "10"))
+# Пауза при пустой очереди (секунды), удваивается до WORKER_IDLE_MAX_SLEEP
+WORKER_IDLE_SLEEP = float(os.environ.get("WORKER_IDLE_SLEEP", "10"))
+WORKER_IDLE_MAX_SLEEP = float(os.environ.get("WORKER_IDLE_MAX_SLEEP", "300"))
+
+# Захват новостей несколькими воркерами (см. db.claim_news_batch)
+WORKER_ID = os.environ.get("WORKER_ID", f"{socket.gethostname()}:{os.getpid()}")
+# Срок аренды захваченной строки: после него строку может забрать другой воркер
+CLAIM_LEASE_SECONDS = int(os.environ.get("CLAIM_LEASE_SECONDS", "600"))
+# Максимальное число попыток генерации для одной новости
+CLAIM_MAX_ATTEMPTS = int(os.environ.get("CLAIM_MAX_ATTEMPTS", "3"))
+# Пауза перед повторной попыткой после ошибки (секунды)
+CLAIM_RETRY_DELAY = int(os.environ.get("CLAIM_RETRY_DELAY", "60"))
+
+# Сколько промптов воркер держит в очереди ComfyUI одновременно
+MAX_IN_FLIGHT = int(os.environ.get("MAX_IN_FLIGHT", "3"))
+# Адаптивный опрос /history: интервал растёт от POLL_MIN_INTERVAL до POLL_MAX_INTERVAL (секунды)
+POLL_MIN_INTERVAL = float(os.environ.get("POLL_MIN_INTERVAL", "0.25"))
+POLL_MAX_INTERVAL = float(os.environ.get("POLL_MAX_INTERVAL", "5"))
+# Максимальное время ожидания одной генерации (секунды)
+GENERATION_TIMEOUT = int(os.environ.get("GENERATION_TIMEOUT", "300"))
+# Ожидание промпта на "холодном" сервере ComfyUI, где модели ещё не загружены
+# (прогрев и первый промпт после запуска воркера или восстановления сервера, секунды)
+COLD_START_TIMEOUT = int(os.environ.get("COLD_START_TIMEOUT", "900"))
+# Прогрев моделей при запуске воркера (см. warmup.py): маленький промпт на каждый сервер до захвата новостей
+WARMUP = os.environ.get("WARMUP", "1") == "1"
+WARMUP_PROMPT = os.environ.get("WARMUP_PROMPT", "warm-up")
+# Размер изображения (пиксели) и число шагов прогревающего промпта
+WARMUP_SIZE = int(os.environ.get("WARMUP_SIZE", "64"))
+WARMUP_STEPS = int(os.environ.get("WARMUP_STEPS", "1"))
+# Прогревающий промпт на сервер, простаивающий дольше KEEP_HOT_INTERVAL секунд (0 - не отправлять)
+KEEP_HOT_INTERVAL = float(os.environ.get("KEEP_HOT_INTERVAL", "600"))
+
+# Адрес сервера ComfyUI
+COMFY_URL = os.environ.get("COMFY_URL", "http://localhost:8888")
+# Несколько серверов ComfyUI через запятую: промпты распределяются между ними (см. comfy_pool.py)
+COMFY_URLS = [url.strip() for url in os.environ.get("COMFY_URLS", COMFY_URL).split(",") if url.strip()]
+# Проверка серверов запросом /queue раз в COMFY_HEALTH_INTERVAL секунд. После COMFY_EJECT_AFTER
+# неудачных проверок или отправок подряд сервер исключается, его промпты отправляются на другие
+COMFY_HEALTH_INTERVAL = float(os.environ.get("COMFY_HEALTH_INTERVAL", "5"))
+COMFY_EJECT_AFTER = int(os.environ.get("COMFY_EJECT_AFTER", "2"))
+# Получать события о завершении промптов по WebSocket (0 - только опрос /history)
+USE_WEBSOCKET = os.environ.get("USE_WEBSOCKET", "1") == "1"
+WS_CONNECT_TIMEOUT = float(os.environ.get("WS_CONNECT_TIMEOUT", "5"))
+# При работающем WebSocket /history всё равно опрашивается раз в SAFETY_POLL_INTERVAL
+# секунд на случай потерянного события
+SAFETY_POLL_INTERVAL = float(os.environ.get("SAFETY_POLL_INTERVAL", "15"))
+# Таймаут HTTP запросов к ComfyUI (секунды)
+COMFY_TIMEOUT = float(os.environ.get("COMFY_TIMEOUT", "30"))
+# Повторы запросов к ComfyUI при ошибках соединения, базовая пауза между повторами (секунды)
+COMFY_RETRIES = int(os.environ.get("COMFY_RETRIES", "3"))
+COMFY_RETRY_BACKOFF = float(os.environ.get("COMFY_RETRY_BACKOFF", "0.5"))
+# Сколько keep-alive соединений с ComfyUI держать в пуле
+COMFY_POOL_SIZE = int(os.environ.get("COMFY_POOL_SIZE", "4"))
+
+# Подключение к FTP серверу для загрузки изображений
+FTP_HOST = os.environ.get("FTP_HOST", "localhost")
+FTP_PORT = int(os.environ.get("FTP_PORT", "21"))
+FTP_USER = os.environ.get("FTP_USER", "user")
+FTP_PASSWORD = os.environ.get("FTP_PASSWORD", "password")
+FTP_TIMEOUT = float(os.environ.get("FTP_TIMEOUT", "30"))
+# Сколько FTP сессий держать открытыми одновременно
+FTP_POOL_SIZE = int(os.environ.get("FTP_POOL_SIZE", "2"))
+# Через сколько секунд простоя сессия проверяется командой NOOP
+FTP_KEEPALIVE = float(os.environ.get("FTP_KEEPALIVE", "60"))
+# Повторы загрузки при обрыве FTP соединения
+FTP_RETRIES = int(os.environ.get("FTP_RETRIES", "2"))
+# Размер блока при потоковой передаче изображения с ComfyUI на FTP (байты)
+FTP_BLOCKSIZE = int(os.environ.get("FTP_BLOCKSIZE", "65536"))
+
+# Сколько новостей упаковывать в один промпт ComfyUI (отдельные ветки графа с общими моделями)
+NEWS_PER_PROMPT = int(os.environ.get("NEWS_PER_PROMPT", "1"))
+# Сколько изображений генерировать для каждой новости (batch_size латентного узла)
+IMAGES_PER_NEWS = int(os.environ.get("IMAGES_PER_NEWS", "1"))
+
+# Асинхронный конвейер (generate.py --pipeline): параллельные исполнители этапов
+PIPELINE_SUBMIT_CONCURRENCY = int(os.environ.get("PIPELINE_SUBMIT_CONCURRENCY", "1"))
+PIPELINE_UPLOAD_CONCURRENCY = int(os.environ.get("PIPELINE_UPLOAD_CONCURRENCY", str(FTP_POOL_SIZE)))
+# Размер очередей между этапами конвейера
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", "16"))
+
+# Запись результатов в БД пачками (см. db.ResultWriter): не больше RESULT_BATCH_SIZE строк
+# и не дольше RESULT_FLUSH_INTERVAL секунд ожидания в буфере
+RESULT_BATCH_SIZE = int(os.environ.get("RESULT_BATCH_SIZE", "20"))
+RESULT_FLUSH_INTERVAL = float(os.environ.get("RESULT_FLUSH_INTERVAL", "2"))
+
+# Локальный кэш готовых изображений (см. result_cache.py). Пустое значение - кэш отключён
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", "")
+# Максимальный размер кэша (байты), сверх него удаляются давно не использованные записи
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+# При попадании в кэш использовать уже загруженный файл на FTP (0 - всегда загружать копию)
+RESULT_CACHE_REUSE_REMOTE = os.environ.get("RESULT_CACHE_REUSE_REMOTE", "1") == "1"
+
+# Максимальная длина имени файла изображения без расширения: slug заголовка, id новости и суффикс _N
+# дополнительных изображений (см. naming.py). Не меньше 24: id (bigint, до 19 цифр) не обрезается
+IMAGE_NAME_MAX_LENGTH = max(24, int(os.environ.get("IMAGE_NAME_MAX_LENGTH", "80")))
+
+# Файл журнала задач для продолжения работы после перезапуска (см. journal.py), пусто - журнал не ведётся.
+# У каждого воркера должен быть свой файл
+JOB_JOURNAL = os.environ.get("JOB_JOURNAL", "")
+
+# Производные изображения для сайта (см. variants.py), JSON:
+# {"имя": {"width": ..., "height": ..., "format": "jpeg" | "webp" | "avif" | "png", "quality": ..., "progressive": ...}}
+# Пустой словарь - производные не создаются. Требуется Pillow
+IMAGE_VARIANTS = json.loads(os.environ.get("IMAGE_VARIANTS", "{}"))
+# Число процессов для кодирования производных изображений (0 - по числу ядер)
+VARIANT_WORKERS = int(os.environ.get("VARIANT_WORKERS", "0"))
+
+# Метрики (см. metrics.py): порт HTTP сервера /metrics (0 - сервер не запускается)
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+# Файл журнала трасс задач в формате JSON lines (пустое значение - журнал не пишется)
+METRICS_LOG = os.environ.get("METRICS_LOG", "")
@@ -0,0 +1,63 @@
+import datetime
+
+import pytest
+
+import jobs
+from journal import JobJournal
+
+# Продолжение промптов с несколькими новостями из журнала (jobs.resume_jobs):
+# новости восстанавливаются в порядке веток, а не в порядке строк журнала, и если воркер
+# снова захватил только часть новостей промпта, выходы остальных веток пропускаются
+
+PROMPT_ID = "prompt-1"
+BRANCHES = {"10": 0, "20": 1}
+OUTPUTS = {"outputs": {"10": {"images": [{"filename": "first.png"}]},
+                       "20": {"images": [{"filename": "second.png"}]}}}
+
+# Сервер ComfyUI, которому промпт уже известен (/history)
+class KnownPromptClient:
+    def get_generation_status(self, prompt_id):
+        return {prompt_id: {}}
+
+class Backend:
+    url = "http://comfy:8188"
+    client = KnownPromptClient()
+
+class Pool:
+    def __init__(self):
+        self.backend = Backend()
+
+    def find(self, url):
+        return self.backend if url == self.backend.url else None
+
+    def acquire(self, backend):
+        pass
+
+def make_news(news_id):
+    return {"id": news_id, "title": f"Новость {news_id}", "date_time": datetime.datetime(2024, 5, 1),
+            "attempts": 1, "priority": 0, "stale": False}
+
+@pytest.fixture
+def journal(tmp_path, monkeypatch):
+    journal = JobJournal(str(tmp_path / "journal.sqlite3"))
+    monkeypatch.setattr(jobs, "JOURNAL", journal)
+    yield journal
+    journal.close()
+
+# Изображения новостей промпта после продолжения: {id новости: [имена файлов]}
+def resume(journal, owned):
+    pool = Pool()
+    # Строки журнала в порядке id, а ветки промпта - в порядке захвата [5, 3]
+    journal.claimed("old", [make_news(3), make_news(5)])
+    journal.submitted([make_news(5), make_news(3)], PROMPT_ID, pool.backend, BRANCHES)
+    resumed = jobs.resume_jobs(journal.unfinished(), owned, pool, "new")
+    (prompt_id, _, news_list, branches), = resumed["submitted"]
+    assert prompt_id == PROMPT_ID
+    per_news = jobs.split_outputs(OUTPUTS, branches, len(news_list))
+    return {news['id']: [image["filename"] for image in images] for news, images in zip(news_list, per_news)}
+
+def test_resume_keeps_branch_order(journal):
+    assert resume(journal, {3, 5}) == {5: ["first.png"], 3: ["second.png"]}
+
+def test_resume_partially_owned_prompt(journal):
+    assert resume(journal, {3}) == {3: ["second.png"]}
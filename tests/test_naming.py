@@ -0,0 +1,52 @@
+import datetime
+
+import pytest
+
+import naming
+import settings
+
+def make_news(news_id, title):
+    return {"id": news_id, "title": title, "date_time": datetime.datetime(2024, 5, 1)}
+
+@pytest.mark.parametrize("title, expected", [
+    ("В Москве открылся новый парк", "v-moskve-otkrylsya-novyy-park"),
+    ("Ёлка, щука и «кавычки»!", "elka-shchuka-i-kavychki"),
+    ("Café déjà vu", "cafe-deja-vu"),
+    ("  --Курс 2024--  ", "kurs-2024"),
+    ("???", ""),
+])
+def test_slugify(title, expected):
+    assert naming.slugify(title, 100) == expected
+
+def test_slugify_cuts_on_word_boundary():
+    assert naming.slugify("Курс рубля укрепился", 12) == "kurs-rublya"
+    assert naming.slugify("Сверхдлинноеслово", 5) == "sverk"
+    assert naming.slugify("Курс", 0) == ""
+
+def test_image_stem_keeps_id_within_limit(monkeypatch):
+    monkeypatch.setattr(settings, "IMAGES_PER_NEWS", 1)
+    news = make_news(12345, "Очень длинный заголовок новости " * 5)
+    stem = naming.image_stem(news, 30)
+    assert stem.endswith("-12345") and len(stem) <= 30
+    assert naming.image_stem(make_news(12345, "???"), 30) == "12345"
+
+def test_image_stem_counts_extra_image_suffix(monkeypatch):
+    monkeypatch.setattr(settings, "IMAGES_PER_NEWS", 3)
+    monkeypatch.setattr(settings, "IMAGE_NAME_MAX_LENGTH", 30)
+    news = make_news(12345, "Очень длинный заголовок новости " * 5)
+    filename = naming.image_filename(news, 2, "png")
+    assert filename.endswith("-12345_3.png")
+    assert len(filename.rsplit(".", 1)[0]) <= 30
+
+def test_is_current_requires_row_id():
+    assert naming.is_current("v-moskve-park-42", 42)
+    assert naming.is_current("42", 42)
+    # Старое имя из одних цифр - заголовок, а не id
+    assert not naming.is_current("2024", 42)
+    assert not naming.is_current("v-moskve-park-142", 42)
+    assert not naming.is_current("В_Москве_42", 42)
+
+def test_image_extension():
+    assert naming.image_extension("ComfyUI_00001_.png") == "png"
+    assert naming.image_extension("ComfyUI_00001_.JPEG") == "jpg"
+    assert naming.image_extension("ComfyUI_00001_") == "jpg"
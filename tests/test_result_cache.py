@@ -0,0 +1,31 @@
+from result_cache import RenderingKeys, normalize_title
+
+def news(news_id):
+    return {"id": news_id, "cache_key": "key"}
+
+def test_followers_wait_for_leader():
+    keys = RenderingKeys()
+    leader, first, second = news(1), news(2), news(3)
+    assert keys.lead_or_wait("key", leader)
+    assert not keys.lead_or_wait("key", first)
+    assert not keys.lead_or_wait("key", second)
+    assert keys.waiting() == [first, second]
+    # Завершение новости, которая не лидер, не отпускает ждущих
+    assert keys.finish(first) == []
+    assert keys.finish(leader) == [first, second]
+    assert keys.waiting() == []
+    # Следующая новость с тем же ключом снова становится лидером
+    assert keys.lead_or_wait("key", first)
+
+def test_rescheduled_leader_stays_leader():
+    keys = RenderingKeys()
+    leader = news(1)
+    assert keys.lead_or_wait("key", leader)
+    assert keys.lead_or_wait("key", leader)
+    assert keys.waiting() == []
+
+def test_finish_without_cache_key():
+    assert RenderingKeys().finish({"id": 1}) == []
+
+def test_normalize_title():
+    assert normalize_title("  Ёлка,  ЁЖ!  ") == normalize_title("елка еж")
@@ -0,0 +1,38 @@
+from workflow import build_batched_workflow, is_link
+
+# Минимальный граф: загрузчик -> текст промпта -> сэмплер -> сохранение
+GRAPH = {
+    "1": {"class_type": "CLIPLoader", "inputs": {}},
+    "2": {"class_type": "CLIPTextEncode", "inputs": {"clip": ["1", 0], "text": ""}},
+    "3": {"class_type": "KSampler", "inputs": {"positive": ["2", 0], "latent_image": ["5", 0]}},
+    "4": {"class_type": "SaveImage", "inputs": {"images": ["3", 0], "filename_prefix": "news"}},
+    "5": {"class_type": "EmptyLatentImage", "inputs": {"batch_size": 1}},
+}
+
+# Текст промпта, от которого зависит узел node_id
+def prompt_of(workflow, node_id):
+    node = workflow[node_id]
+    if node["class_type"] == "CLIPTextEncode":
+        return node["inputs"]["text"]
+    texts = {prompt_of(workflow, value[0]) for value in node["inputs"].values() if is_link(value)}
+    texts.discard(None)
+    return texts.pop() if texts else None
+
+def test_branches_map_sinks_to_texts():
+    texts = ["первая", "вторая", "третья"]
+    workflow, branches = build_batched_workflow(GRAPH, texts, "2", "5", images_per_prompt=2)
+    assert sorted(branches.values()) == [0, 1, 2]
+    for sink, index in branches.items():
+        assert workflow[sink]["class_type"] == "SaveImage"
+        assert prompt_of(workflow, sink) == texts[index]
+    # Общие узлы не копируются, префиксы имён файлов веток различаются
+    assert sum(node["class_type"] == "CLIPLoader" for node in workflow.values()) == 1
+    assert len({workflow[sink]["inputs"]["filename_prefix"] for sink in branches}) == 3
+    assert workflow["5"]["inputs"]["batch_size"] == 2
+    # Исходный граф не изменён
+    assert GRAPH["2"]["inputs"]["text"] == "" and GRAPH["5"]["inputs"]["batch_size"] == 1
+
+def test_single_text_keeps_node_ids():
+    workflow, branches = build_batched_workflow(GRAPH, ["одна"], "2", "5")
+    assert branches == {"4": 0}
+    assert set(workflow) == set(GRAPH)
@@ -0,0 +1,117 @@
+import io
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import settings
+from metrics import REGISTRY, Histogram
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Производные изображения для сайта: миниатюры, WebP/AVIF, прогрессивный JPEG.
+# Вместо того чтобы сайт уменьшал исходное изображение при каждом запросе, после загрузки
+# исходного файла на FTP из него создаются варианты из settings.IMAGE_VARIANTS
+# и загружаются в тот же каталог /ftp/images/YYYY/MM с суффиксом имени варианта
+# (см. variant_path). Пути вариантов записываются в image_variants рядом с image_url.
+# Кодирование занимает процессор, поэтому выполняется в пуле процессов (VariantPool):
+# воркер (generate.py --worker) получает Future (submit) и забирает результат в следующих
+# проверках, продолжая работу с промптами, а поток загрузки конвейера ждёт результат (encode).
+# Pillow - необязательная зависимость: без неё варианты не создаются
+
+# Формат варианта -> (формат Pillow, расширение файла)
+FORMATS = {
+    "jpeg": ("JPEG", "jpg"),
+    "webp": ("WEBP", "webp"),
+    "avif": ("AVIF", "avif"),
+    "png": ("PNG", "png"),
+}
+
+VARIANT_SECONDS = REGISTRY.add(Histogram(
+    "image_variants_seconds", "Время кодирования производных изображений одной новости"))
+
+# Путь варианта name рядом с исходным: /images/2024/05/title.jpg -> /images/2024/05/title_thumb.webp
+def variant_path(path, name, spec):
+    stem = path.rsplit(".", 1)[0]
+    return f"{stem}_{name}.{FORMATS[spec.get('format', 'jpeg')][1]}"
+
+# Проверка описаний вариантов: известный формат, который поддерживает установленный Pillow
+def validate_variants(specs):
+    Image.init()
+    for name, spec in specs.items():
+        image_format = spec.get("format", "jpeg")
+        if image_format not in FORMATS:
+            raise ValueError(f"Вариант {name}: неизвестный формат {image_format}, допустимы {sorted(FORMATS)}")
+        if FORMATS[image_format][0] not in Image.SAVE:
+            raise ValueError(f"Вариант {name}: установленный Pillow не поддерживает формат {image_format}")
+
+# Кодирование всех вариантов одного изображения (выполняется в процессе пула).
+# source - байты изображения или путь к файлу. Возвращает {имя варианта: байты}
+def encode_variants(source, specs):
+    with Image.open(io.BytesIO(source) if isinstance(source, bytes) else source) as original:
+        original.load()
+        result = {}
+        for name, spec in specs.items():
+            image = original
+            width, height = spec.get("width"), spec.get("height")
+            if width or height:
+                image = original.copy()
+                # thumbnail сохраняет пропорции и не увеличивает изображение
+                image.thumbnail((width or original.width, height or original.height), Image.LANCZOS)
+            pil_format = FORMATS[spec.get("format", "jpeg")][0]
+            options = {"quality": spec.get("quality", 85)}
+            if pil_format == "JPEG":
+                image = image.convert("RGB")
+                options.update(progressive=spec.get("progressive", True), optimize=True)
+            elif pil_format == "WEBP":
+                options["method"] = 4
+            buffer = io.BytesIO()
+            image.save(buffer, pil_format, **options)
+            result[name] = buffer.getvalue()
+        return result
+
+class VariantPool:
+    def __init__(self, specs=settings.IMAGE_VARIANTS, workers=settings.VARIANT_WORKERS):
+        validate_variants(specs)
+        self.specs = specs
+        # spawn: процессы пула не наследуют потоки и сокеты воркера (WebSocket, FTP, метрики)
+        self._executor = ProcessPoolExecutor(max_workers=workers or None,
+                                             mp_context=multiprocessing.get_context("spawn"))
+
+    # Кодирование в процессе пула без ожидания: Future с {имя варианта: байты}
+    def submit(self, source):
+        started = time.monotonic()
+        future = self._executor.submit(encode_variants, source, self.specs)
+        future.add_done_callback(lambda _: VARIANT_SECONDS.observe(time.monotonic() - started))
+        return future
+
+    # Кодирование в процессе пула, вызывающий поток ждёт результат
+    def encode(self, source):
+        return self.submit(source).result()
+
+    def close(self):
+        global _default_pool
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        if _default_pool is self:
+            _default_pool = None
+
+_default_pool = None
+
+# Запуск пула процессов при заданном IMAGE_VARIANTS. Возвращает VariantPool или None
+def start_variant_pool(specs=None):
+    global _default_pool
+    specs = settings.IMAGE_VARIANTS if specs is None else specs
+    if not specs:
+        return None
+    if Image is None:
+        print("[ERROR] Pillow не установлен, производные изображения (IMAGE_VARIANTS) не создаются.")
+        return None
+    _default_pool = VariantPool(specs)
+    print(f"[LOG] Производные изображения: {', '.join(specs)}")
+    return _default_pool
+
+# Пул процесса (None, если производные изображения не создаются)
+def get_variant_pool():
+    return _default_pool
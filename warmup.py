@@ -0,0 +1,123 @@
+import random
+import time
+
+import settings
+from comfy_events import PollBackoff
+from jobs import resolve_prompt
+from metrics import REGISTRY, Histogram
+
+# Прогрев моделей ComfyUI.
+# После запуска ComfyUI или выгрузки моделей из памяти первый промпт ждёт загрузки UNET,
+# текстовых энкодеров и VAE (узлы-загрузчики workflow), что может занять больше GENERATION_TIMEOUT.
+# Поэтому при запуске воркер отправляет на каждый сервер пула маленький промпт с теми же
+# загрузчиками (WARMUP_SIZE x WARMUP_SIZE, WARMUP_STEPS шагов) и ждёт его до COLD_START_TIMEOUT,
+# а уже потом захватывает новости. Пока очередь новостей пуста, сервер без промптов дольше
+# KEEP_HOT_INTERVAL секунд получает такой же промпт (keep_hot), чтобы модели не выгружались;
+# его результат не ждём.
+# Изображение прогрева не сохраняется: узлы сохранения заменяются на PreviewImage
+
+WARMUP_SECONDS = REGISTRY.add(Histogram(
+    "comfy_warmup_seconds", "Время выполнения прогревающего промпта", ("kind",)))
+
+# Прогревающий промпт. Seed случайный, иначе ComfyUI возьмёт результат из своего кэша
+# и не выполнит сэмплер (модели так и не попадут в память GPU)
+def warmup_workflow(template):
+    params = {"width": settings.WARMUP_SIZE, "height": settings.WARMUP_SIZE, "batch_size": 1,
+              "steps": settings.WARMUP_STEPS, "seed": random.randint(0, 2 ** 32 - 1)}
+    workflow = template.render(prompt=settings.WARMUP_PROMPT,
+                               **{name: value for name, value in params.items() if name in template.params})
+    for node_id in template.sinks:
+        images = workflow[node_id]["inputs"].get("images")
+        if images is not None:
+            workflow[node_id] = {"class_type": "PreviewImage", "inputs": {"images": images}}
+    return workflow
+
+# Отправка прогревающего промпта на сервер backend. Возвращает prompt_id или None
+def send_warmup(pool, template, backend):
+    try:
+        result = backend.client.queue_prompt(warmup_workflow(template), pool.client_id)
+    except Exception as e:
+        print(f"[ERROR] Ошибка отправки прогревающего промпта на {backend.url}: {e}")
+        backend.failed(e)
+        return None
+    return result.get("prompt_id") if result else None
+
+# Отправка прогревающего промпта на серверы backends (по умолчанию все серверы пула)
+# и ожидание их завершения, не дольше timeout секунд. Возвращает число прогретых серверов
+def warm_up(pool, template, backends=None, kind="start", timeout=None):
+    backends = pool.backends if backends is None else backends
+    timeout = settings.COLD_START_TIMEOUT if timeout is None else timeout
+    started = time.monotonic()
+    prompts = {}
+    for backend in backends:
+        prompt_id = send_warmup(pool, template, backend)
+        if prompt_id:
+            pool.acquire(backend)
+            prompts[prompt_id] = backend
+    if prompts:
+        print(f"[LOG] Прогрев моделей на серверах: {', '.join(backend.url for backend in prompts.values())}")
+
+    warmed = 0
+    poll = PollBackoff()
+    if pool.listener and pool.listener.connected:
+        poll.defer(started, settings.SAFETY_POLL_INTERVAL)
+    while prompts:
+        now = time.monotonic()
+        if now - started > timeout:
+            for backend in prompts.values():
+                pool.release(backend)
+            print(f"[ERROR] Прогрев не завершён за {timeout} секунд: {', '.join(b.url for b in prompts.values())}")
+            break
+        events = pool.listener.pop_finished(list(prompts)) if pool.listener else {}
+        due = poll.due(now)
+        for prompt_id, backend in list(prompts.items()):
+            event = events.get(prompt_id)
+            if event is None and not due:
+                continue
+            state, _ = resolve_prompt(prompt_id, event, backend)
+            if state == "pending":
+                if event is not None:
+                    # Промпт завершён, но /history ещё не записан
+                    poll.reset(now)
+                continue
+            del prompts[prompt_id]
+            pool.release(backend, state == "success")
+            seconds = time.monotonic() - started
+            if state == "success":
+                warmed += 1
+                WARMUP_SECONDS.observe(seconds, kind=kind)
+                print(f"[LOG] Сервер ComfyUI {backend.url} прогрет за {seconds:.1f} с.")
+            else:
+                print(f"[ERROR] Прогревающий промпт на {backend.url} завершился с ошибкой.")
+        if due:
+            if pool.listener and pool.listener.connected:
+                poll.defer(now, settings.SAFETY_POLL_INTERVAL)
+            else:
+                poll.backoff(now)
+        if prompts:
+            delay = max(0, min(poll.next_poll, started + timeout) - time.monotonic())
+            if pool.listener and pool.listener.connected:
+                pool.listener.wait(list(prompts), delay)
+            else:
+                time.sleep(delay)
+    return warmed
+
+# Прогрев серверов, простаивающих дольше KEEP_HOT_INTERVAL секунд.
+# Вызывается воркером, когда очередь новостей пуста. Промпт только отправляется: захват
+# новостей не ждёт его выполнения, а сервер не считается занятым (pool.acquire не вызывается).
+# Сервер с промптами других воркеров (foreign) не простаивает, его модели и так в памяти.
+# Возвращает число серверов, получивших промпт
+def keep_hot(pool, template):
+    if not settings.KEEP_HOT_INTERVAL:
+        return 0
+    now = time.monotonic()
+    sent = 0
+    for backend in pool.backends:
+        if (backend.healthy and not backend.in_flight and not backend.foreign
+                and now - backend.last_used >= settings.KEEP_HOT_INTERVAL):
+            if send_warmup(pool, template, backend):
+                print(f"[LOG] Прогревающий промпт отправлен на простаивающий сервер {backend.url}")
+                sent += 1
+            # Следующий прогрев - не раньше чем через KEEP_HOT_INTERVAL, даже после ошибки отправки
+            backend.last_used = now
+    return sent
@@ -0,0 +1,257 @@
+import hashlib
+import json
+
+import settings
+
+# Работа с графом workflow в формате API ComfyUI: {id узла: {"inputs", "class_type", "_meta"}}.
+# Ссылка на выход другого узла во входах записывается как [id узла, номер выхода]
+
+# Чтение workflow. В режиме воркера файл читается один раз за всё время работы
+def load_workflow(path=settings.WORKFLOW_PATH):
+    print(f"[LOG] Чтение файла {path}...")
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def is_link(value):
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[0], str)
+
+# Все узлы, которые прямо или косвенно зависят от start_id (включая сам start_id)
+def downstream_nodes(workflow, start_id):
+    result = {start_id}
+    changed = True
+    while changed:
+        changed = False
+        for node_id, node in workflow.items():
+            if node_id in result:
+                continue
+            if any(is_link(v) and v[0] in result for v in node.get("inputs", {}).values()):
+                result.add(node_id)
+                changed = True
+    return result
+
+# Узлы из nodes, выход которых никто не использует - узлы сохранения изображений
+def sink_nodes(workflow, nodes):
+    used = {v[0] for node_id in nodes for v in workflow[node_id].get("inputs", {}).values() if is_link(v)}
+    return [node_id for node_id in nodes if node_id not in used]
+
+# Копия узла с заменой входов. Остальные узлы графа не копируются
+def replace_inputs(node, **inputs):
+    return {**node, "inputs": {**node["inputs"], **inputs}}
+
+# Workflow с несколькими промптами в одной отправке.
+# Цепочка узлов от текстового узла prompt_node до узла сохранения клонируется для каждого
+# текста, а загрузчики моделей, латент, шум и планировщик остаются общими, поэтому модели
+# загружаются и выполняются в одной задаче ComfyUI. images_per_prompt задаёт batch_size
+# латентного узла latent_node: каждый промпт даёт столько изображений за один проход.
+# Возвращает (workflow, {id узла сохранения: индекс текста})
+# branch_nodes и sinks можно передать заранее посчитанными (см. WorkflowTemplate)
+def build_batched_workflow(base_workflow, texts, prompt_node, latent_node=None, images_per_prompt=1,
+                           branch_nodes=None, sinks=None):
+    workflow = dict(base_workflow)
+    if branch_nodes is None:
+        branch_nodes = downstream_nodes(base_workflow, prompt_node)
+    if sinks is None:
+        sinks = sink_nodes(base_workflow, branch_nodes)
+    branches = {}
+
+    if latent_node in workflow and images_per_prompt != workflow[latent_node]["inputs"].get("batch_size", 1):
+        workflow[latent_node] = replace_inputs(workflow[latent_node], batch_size=images_per_prompt)
+
+    next_id = max(int(node_id) for node_id in base_workflow if node_id.isdigit()) + 1
+    for index, text in enumerate(texts):
+        if index == 0:
+            id_map = {node_id: node_id for node_id in branch_nodes}
+        else:
+            id_map = {}
+            for node_id in sorted(branch_nodes, key=lambda n: (len(n), n)):
+                id_map[node_id] = str(next_id)
+                next_id += 1
+        for node_id in branch_nodes:
+            node = base_workflow[node_id]
+            inputs = {
+                key: [id_map.get(value[0], value[0]), value[1]] if is_link(value) else value
+                for key, value in node.get("inputs", {}).items()
+            }
+            if node_id == prompt_node:
+                inputs["text"] = text
+            if node_id in sinks and index > 0 and "filename_prefix" in inputs:
+                inputs["filename_prefix"] = f"{inputs['filename_prefix']}_{index}"
+            workflow[id_map[node_id]] = {**node, "inputs": inputs}
+        for node_id in sinks:
+            branches[id_map[node_id]] = index
+    return workflow, branches
+
+# Отпечаток параметров workflow, влияющих на изображение: все значения входов узлов
+# (модели, шаги, размер, seed, формат), кроме текста промпта и префикса имени файла
+def workflow_fingerprint(workflow):
+    params = {
+        node_id: {key: value for key, value in node.get("inputs", {}).items()
+                  if not is_link(value) and key not in ("text", "filename_prefix")}
+        for node_id, node in workflow.items()
+    }
+    data = json.dumps(params, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+# Узлы по типу (class_type) и/или заголовку (_meta.title)
+def find_nodes(workflow, class_type=None, title=None):
+    return [
+        node_id for node_id, node in workflow.items()
+        if (class_type is None or node.get("class_type") == class_type)
+        and (title is None or node.get("_meta", {}).get("title") == title)
+    ]
+
+PROMPT_CLASSES = ("CLIPTextEncode",)
+LATENT_CLASSES = ("EmptyLatentImage", "EmptySD3LatentImage")
+
+# Именованные параметры шаблона: имя -> ключи входов, в которых оно хранится.
+# prompt и style задают текст промпта, остальные меняют входы найденных узлов
+PARAMETERS = {
+    "width": ("width",),
+    "height": ("height",),
+    "batch_size": ("batch_size",),
+    "steps": ("steps",),
+    "seed": ("noise_seed", "seed"),
+    "format": ("format",),
+}
+
+# Шаблон workflow: граф читается и проверяется один раз, нужные узлы находятся
+# по class_type и _meta.title, а не по захардкоженным ID. Задание для ComfyUI собирается
+# из общего графа: копируется только словарь узлов, а новые объекты создаются лишь для
+# изменённых узлов (см. replace_inputs). Поэтому узлы self.graph нельзя изменять на месте.
+# Профили - именованные наборы параметров (settings.WORKFLOW_PROFILES), например
+# {"small": {"width": 512, "height": 256, "steps": 2}}: один воркер может генерировать
+# изображения разных размеров и стилей без повторного чтения файла
+class WorkflowTemplate:
+    def __init__(self, graph, profiles=None, prompt_title=None):
+        self.graph = graph
+        self.profiles = profiles or {}
+        self.validate()
+        self.prompt_node = self._find_prompt_node(prompt_title)
+        latent_nodes = [node_id for node_id, node in graph.items() if node["class_type"] in LATENT_CLASSES]
+        self.latent_node = latent_nodes[0] if latent_nodes else None
+        self.branch_nodes = downstream_nodes(graph, self.prompt_node)
+        self.sinks = sink_nodes(graph, self.branch_nodes)
+        self.params = self._find_parameters()
+        self._fingerprints = {}
+        for name, profile in self.profiles.items():
+            unknown = set(profile) - set(self.params) - {"prompt", "style"}
+            if unknown:
+                raise ValueError(f"Профиль {name}: параметры {sorted(unknown)} отсутствуют в workflow")
+
+    @classmethod
+    def load(cls, path=settings.WORKFLOW_PATH, profiles=None):
+        return cls(load_workflow(path), settings.WORKFLOW_PROFILES if profiles is None else profiles)
+
+    # Проверка структуры графа: у каждого узла есть class_type и inputs,
+    # ссылки указывают на существующие узлы
+    def validate(self):
+        if not isinstance(self.graph, dict) or not self.graph:
+            raise ValueError("Workflow должен быть непустым словарём узлов в формате API ComfyUI")
+        for node_id, node in self.graph.items():
+            if not isinstance(node, dict) or "class_type" not in node or not isinstance(node.get("inputs"), dict):
+                raise ValueError(f"Узел {node_id}: нет class_type или inputs")
+            for key, value in node["inputs"].items():
+                if is_link(value) and value[0] not in self.graph:
+                    raise ValueError(f"Узел {node_id}: вход {key} ссылается на отсутствующий узел {value[0]}")
+
+    # Текстовый узел положительного промпта: единственный CLIPTextEncode, узел с заданным
+    # заголовком или CLIPTextEncode, подключённый ко входу positive/conditioning
+    def _find_prompt_node(self, title):
+        if title:
+            found = find_nodes(self.graph, title=title)
+            if not found:
+                raise ValueError(f"В workflow нет узла с заголовком {title}")
+            return found[0]
+        candidates = [node_id for node_id, node in self.graph.items() if node["class_type"] in PROMPT_CLASSES]
+        if len(candidates) == 1:
+            return candidates[0]
+        positive = {
+            value[0] for node in self.graph.values() for key, value in node["inputs"].items()
+            if key in ("positive", "conditioning") and is_link(value)
+        }
+        candidates = [node_id for node_id in candidates if node_id in positive]
+        if len(candidates) != 1:
+            raise ValueError("Не удалось определить текстовый узел промпта, укажите его заголовок")
+        return candidates[0]
+
+    def _find_parameters(self):
+        params = {}
+        for name, keys in PARAMETERS.items():
+            if name in ("width", "height", "batch_size"):
+                nodes = [self.latent_node] if self.latent_node else []
+            elif name == "format":
+                nodes = self.sinks
+            else:
+                nodes = list(self.graph)
+            targets = [(node_id, key) for node_id in nodes for key in keys
+                       if key in self.graph[node_id]["inputs"] and not is_link(self.graph[node_id]["inputs"][key])]
+            if targets:
+                params[name] = targets
+        return params
+
+    def profile_params(self, profile=None):
+        if not profile:
+            return {}
+        if profile not in self.profiles:
+            raise ValueError(f"Неизвестный профиль workflow: {profile}")
+        return self.profiles[profile]
+
+    def get(self, name):
+        node_id, key = self.params[name][0]
+        return self.graph[node_id]["inputs"][key]
+
+    # Стиль профиля (None - стиль выбирает вызывающий код)
+    def profile_style(self, profile=None):
+        return self.profile_params(profile).get("style")
+
+    @staticmethod
+    def prompt_text(prompt, style=None):
+        return f"{style} {prompt}" if style else prompt
+
+    # Задание для ComfyUI с параметрами профиля и явно переданными параметрами
+    def render(self, profile=None, prompt=None, style=None, **params):
+        params = {**self.profile_params(profile), **params}
+        profile_style = params.pop("style", None)
+        profile_prompt = params.pop("prompt", None)
+        style = style or profile_style
+        prompt = profile_prompt if prompt is None else prompt
+        workflow = dict(self.graph)
+        changes = {}
+        for name, value in params.items():
+            if name not in self.params:
+                raise ValueError(f"Параметр {name} отсутствует в workflow")
+            for node_id, key in self.params[name]:
+                changes.setdefault(node_id, {})[key] = value
+        if prompt is not None:
+            changes.setdefault(self.prompt_node, {})["text"] = self.prompt_text(prompt, style)
+        for node_id, inputs in changes.items():
+            workflow[node_id] = replace_inputs(workflow[node_id], **inputs)
+        return workflow
+
+    # Задание с несколькими промптами (см. build_batched_workflow).
+    # Возвращает (workflow, {id узла сохранения: индекс текста})
+    def render_batch(self, texts, images_per_prompt=1, profile=None, **params):
+        return build_batched_workflow(self.render(profile, **params), texts, self.prompt_node, self.latent_node,
+                                      images_per_prompt, self.branch_nodes, self.sinks)
+
+    # Отпечаток параметров профиля для кэша изображений (считается один раз на профиль)
+    def fingerprint(self, profile=None):
+        if profile not in self._fingerprints:
+            self._fingerprints[profile] = workflow_fingerprint(self.render(profile))
+        return self._fingerprints[profile]
+
+_templates = {}
+
+# Шаблон из файла path. Файл читается и проверяется один раз за время работы процесса.
+# Профили из настроек WORKFLOW_PROFILE и STALE_PROFILE проверяются сразу: опечатка в имени
+# останавливает запуск, а не превращается в ошибку каждой новости
+def load_template(path=settings.WORKFLOW_PATH):
+    if path not in _templates:
+        template = WorkflowTemplate.load(path)
+        for setting in ("WORKFLOW_PROFILE", "STALE_PROFILE"):
+            profile = getattr(settings, setting)
+            if profile and profile not in template.profiles:
+                raise ValueError(f"{setting}: профиль {profile} не задан в WORKFLOW_PROFILES "
+                                 f"(доступны {sorted(template.profiles)})")
+        _templates[path] = template
+    return _templates[path]